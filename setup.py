@@ -30,6 +30,9 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.9',
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': ['llv = llv.cli:main'],
     }
@@ -0,0 +1,967 @@
+"""    
+    Reading and writing utility for LLV recordings, either as indexed block
+    container, legacy packed (gzip) stream or as json clearfile.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import mmap
+import math
+import json
+import gzip
+import struct
+import zlib
+import bisect
+import binascii
+import itertools
+import functools
+import collections
+import concurrent.futures
+from .gesicht import FaceFrame, FaceFrameView, FrameBatch, decode_batch, decode_packed, numpy, _require_numpy
+from .spalten import encode_columns, decode_columns, MODE_LOSSLESS, MODE_QUANTIZED
+
+
+# Indexed recording container.
+#
+# header | block* | index
+#
+# The header is written as placeholder and finalized on close, with the total
+# frame count and the offset of the index. Each block holds a run of size
+# prefixed packets, compressed independently, so any frame can be reached by
+# looking up its block in the index and inflating only that block. Takes
+# which were never closed (index offset 0) are recovered by walking the block
+# headers.
+#
+# Blocks hold either the size prefixed packets as received (CODEC_ZLIB) or
+# their columnar encoding (see spalten), lossless or quantized, which needs
+# numpy on both ends. Stored blocks (CODEC_STORED) are not compressed at
+# all; readers map those files into memory and hand out packets as slices of
+# the mapping, without inflating or copying them.
+CONTAINER_MAGIC = b'LLVR'
+CONTAINER_VERSION = 2
+
+CODEC_ZLIB = 0
+CODEC_COLUMNAR = 1
+CODEC_COLUMNAR_QUANTIZED = 2
+CODEC_STORED = 3
+
+_COLUMNAR_MODES = {
+    CODEC_COLUMNAR: MODE_LOSSLESS,
+    CODEC_COLUMNAR_QUANTIZED: MODE_QUANTIZED,
+}
+
+_CONTAINER_HEADER = struct.Struct('>4sBBBxLLQ8x')
+_BLOCK_HEADER = struct.Struct('>LLL')
+# Byte offset, payload size, first frame index and frame count of a block,
+# followed by the frame time of its first frame.
+_INDEX_ENTRY = struct.Struct('>QLLLlfll')
+_PACKET_SIZE = struct.Struct('>L')
+
+FORMAT_CONTAINER = 'container'
+FORMAT_GZIP = 'gzip'
+FORMAT_JSON = 'json'
+
+
+def is_binary_file(file_name):
+    """
+    Tries to open file in text mode and read first 64 bytes. If it fails,
+    we can be fairly certain, this is due to the file being binary encoded.
+    Thanks Sehrii https://stackoverflow.com/a/51495076/949561 for the help.
+    """
+    try:
+        with open(file_name, 'tr') as check_file:
+            check_file.read(32)
+            return False
+    except:
+        return True
+
+
+class _ClearfileStream:
+    """
+    Incremental reader for the clearfile structure {"count": N, "frames": [...]},
+    decoding one json value at a time from a buffered text stream.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.is_exhausted = False
+
+
+    def _fill(self):
+        chunk = self.file.read(_ClearfileStream.CHUNK_SIZE)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.is_exhausted = 0 == len(chunk)
+        return not self.is_exhausted
+
+
+    def next_token(self):
+        """
+        Skips whitespace and returns the next character without consuming it.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise Exception('Clearfile ended unexpectedly!')
+
+
+    def expect(self, token):
+        found = self.next_token()
+        if found != token:
+            raise Exception(f'Clearfile is malformed! Expected "{token}" but found "{found}" at {self.position}.')
+        self.position += 1
+
+
+    def value(self):
+        """
+        Decodes the next json value. A value touching the end of the buffer
+        might be cut short (e.g. a number), so more data is read first.
+        """
+        self.next_token()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.is_exhausted:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.is_exhausted:
+                    raise
+            self._fill()
+
+
+def _read_frames_json(filepath):
+    with open(filepath, 'r', encoding='utf-8', newline='\r\n') as f:
+        stream = _ClearfileStream(f)
+        stream.expect('{')
+
+        header = {}
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if 'frames' == key:
+                break
+            header[key] = stream.value()
+            stream.expect(',')
+
+        if 'count' not in header:
+            # Frame count is stored after the frames, fall back to reading the whole file.
+            yield from _read_frames_json_document(filepath)
+            return
+
+        frame_count = header['count']
+        frame_index = 0
+
+        stream.expect('[')
+        if ']' == stream.next_token():
+            return
+        while True:
+            frame_json = stream.value()
+            yield frame_json, frame_index, frame_count, frame_json['version']
+            frame_index += 1
+
+            if ']' == stream.next_token():
+                break
+            stream.expect(',')
+
+
+def _read_frames_json_document(filepath):
+    with open(filepath, 'r', encoding='utf-8', newline='\r\n') as f:
+        recording_json = json.load(f)
+
+        frame_count = recording_json['count']
+        frame_index = 0
+
+        for frame_json in recording_json['frames']:
+            yield frame_json, frame_index, frame_count, frame_json['version']
+            frame_index += 1
+
+
+def _read_frames_binary(filepath):
+    file_size = os.path.getsize(filepath)
+    with gzip.open(filepath, 'rb') as file:
+        version, = struct.unpack('>B', file.read(1))
+        if version != FaceFrame.VERSION:
+            raise Exception(f'Incompatible frame versions! Recording is at {version}, llv at {FaceFrame.VERSION}.')
+        frame_count, = struct.unpack('>L', file.read(4))
+
+        for frame_index in range(0, frame_count):
+            raw_frame_size = file.read(4)
+            frame_size, = struct.unpack('>L', raw_frame_size)
+            frame_data = file.read(frame_size)
+
+            yield frame_data, frame_index, frame_count, version
+
+        file_pos = file.tell()
+        if file_pos < file_size:
+            raise Exception(f'Recording seems corrupted! Data after last frame! {file_pos}/{file_size}')
+
+
+class BlockIndexEntry:
+    """
+    Location and first frame time of a block within a recording container.
+    """
+    __slots__ = ('offset', 'payload_size', 'first_frame', 'frame_count',
+        'frame_number', 'sub_frame', 'numerator', 'denominator')
+
+    def __init__(self, offset, payload_size, first_frame, frame_count,
+        frame_number = 0, sub_frame = 0.0, numerator = 0, denominator = 0):
+        self.offset = offset
+        self.payload_size = payload_size
+        self.first_frame = first_frame
+        self.frame_count = frame_count
+        self.frame_number = frame_number
+        self.sub_frame = sub_frame
+        self.numerator = numerator
+        self.denominator = denominator
+
+
+def encode_block(content, frame_count, codec = CODEC_ZLIB, compresslevel = 6):
+    """
+    Encodes frame_count size prefixed packets into the payload of a container
+    block. Returns payload and raw (uncompressed) size.
+    """
+    if codec in _COLUMNAR_MODES:
+        _require_numpy()
+        starts, sizes = _locate_packets(content, frame_count, 0)
+        content = encode_columns(decode_packed(content, starts, sizes), _COLUMNAR_MODES[codec])
+    payload = content if CODEC_STORED == codec else zlib.compress(content, compresslevel)
+    return payload, len(content)
+
+
+class RecordingWriter:
+    """
+    Writes packets into an indexed recording container. Frames are grouped
+    into blocks of block_size frames, each compressed on its own. The header
+    is finalized on close, so the frame count is always correct, even for
+    interrupted takes.
+    """
+
+    def __init__(self, filepath, version = FaceFrame.VERSION, block_size = 1024, compresslevel = 6,
+        codec = CODEC_ZLIB):
+        if codec not in (CODEC_ZLIB, CODEC_STORED) and codec not in _COLUMNAR_MODES:
+            raise Exception(f'Unknown recording codec {codec}!')
+        if codec in _COLUMNAR_MODES:
+            _require_numpy()
+        self.filepath = filepath
+        self.version = version
+        self.codec = codec
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.frame_count = 0
+        self.index = []
+
+        self._block = bytearray()
+        self._block_frame_count = 0
+        self._block_frame_time = None
+
+        self.file = open(filepath, 'wb')
+        self._write_header(0)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        return self.frame_count
+
+
+    def _write_header(self, index_offset):
+        self.file.write(_CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, self.version, self.codec,
+            self.frame_count, len(self.index), index_offset))
+
+
+    def write(self, packet):
+        """
+        Appends a raw frame packet (bytes, bytearray or memoryview).
+        """
+        if 0 == self._block_frame_count:
+            self._block_frame_time = FaceFrameView(packet, len(packet)).frame_time
+        self._block += _PACKET_SIZE.pack(len(packet))
+        self._block += packet
+        self._count_frame()
+
+
+    def write_frame(self, frame):
+        """
+        Appends a FaceFrame.
+        """
+        if 0 == self._block_frame_count:
+            self._block_frame_time = frame.frame_time
+        self._block += frame.encode()
+        self._count_frame()
+
+
+    def _count_frame(self):
+        self._block_frame_count += 1
+        self.frame_count += 1
+        if self.block_size <= self._block_frame_count:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Compresses and writes the current block, if any.
+        """
+        if 0 == self._block_frame_count:
+            return
+
+        payload, raw_size = encode_block(self._block, self._block_frame_count, self.codec, self.compresslevel)
+        self._write_block(payload, raw_size, self._block_frame_count, self._block_frame_time)
+
+        self._block = bytearray()
+        self._block_frame_count = 0
+
+
+    def write_block(self, payload, raw_size, frame_count, frame_time):
+        """
+        Appends a block encoded by encode_block with this writer's codec,
+        along with the frame time of its first frame. Pending frames are
+        flushed as block of their own first.
+        """
+        self.flush()
+        self.frame_count += frame_count
+        self._write_block(payload, raw_size, frame_count, frame_time)
+
+
+    def _write_block(self, payload, raw_size, frame_count, frame_time):
+        offset = self.file.tell()
+        self.file.write(_BLOCK_HEADER.pack(len(payload), raw_size, frame_count))
+        self.file.write(payload)
+
+        self.index.append(BlockIndexEntry(offset, len(payload), self.frame_count - frame_count,
+            frame_count, frame_time['frame_number'], frame_time['sub_frame'],
+            frame_time['numerator'], frame_time['denominator']))
+
+
+    def close(self):
+        """
+        Flushes the last block, appends the index and finalizes the header.
+        """
+        if self.file.closed:
+            return
+
+        self.flush()
+
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(_INDEX_ENTRY.pack(entry.offset, entry.payload_size, entry.first_frame, entry.frame_count,
+                entry.frame_number, entry.sub_frame, entry.numerator, entry.denominator))
+
+        self.file.seek(0)
+        self._write_header(index_offset)
+        self.file.close()
+
+
+class RecordingReader:
+    """
+    Random access reader for indexed recording containers. Stored (not
+    compressed) recordings are memory mapped.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, 'rb')
+        self._map = None
+
+        header = self.file.read(_CONTAINER_HEADER.size)
+        if len(header) < _CONTAINER_HEADER.size:
+            raise Exception('Recording seems corrupted! Header is incomplete.')
+        magic, container_version, self.version, self.codec, self.frame_count, block_count, index_offset = \
+            _CONTAINER_HEADER.unpack(header)
+        if CONTAINER_MAGIC != magic:
+            raise Exception(f'{filepath} is not a recording container!')
+        if CONTAINER_VERSION != container_version:
+            raise Exception(f'Incompatible container versions! Recording is at {container_version}, llv at {CONTAINER_VERSION}.')
+        if self.version != FaceFrame.VERSION:
+            raise Exception(f'Incompatible frame versions! Recording is at {self.version}, llv at {FaceFrame.VERSION}.')
+        if self.codec in _COLUMNAR_MODES:
+            _require_numpy()
+        elif CODEC_STORED == self.codec:
+            self._map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        elif CODEC_ZLIB != self.codec:
+            raise Exception(f'Unknown recording codec {self.codec}!')
+
+        if 0 == index_offset:
+            self.index = self._recover_index()
+            self.frame_count = sum(entry.frame_count for entry in self.index)
+        else:
+            self.file.seek(index_offset)
+            index_data = self.file.read(block_count * _INDEX_ENTRY.size)
+            self.index = [BlockIndexEntry(*entry) for entry in _INDEX_ENTRY.iter_unpack(index_data)]
+
+        self._first_frames = [entry.first_frame for entry in self.index]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        return self.frame_count
+
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Packets handed out are still in use, the mapping is
+                # released together with the last of them.
+                pass
+            self._map = None
+        self.file.close()
+
+
+    def _recover_index(self):
+        """
+        Rebuilds the index of a take which was never closed by walking the
+        block headers. An incomplete last block is dropped.
+        """
+        index = []
+        file_size = os.fstat(self.file.fileno()).st_size
+        offset = _CONTAINER_HEADER.size
+        first_frame = 0
+        while offset + _BLOCK_HEADER.size <= file_size:
+            self.file.seek(offset)
+            payload_size, _, frame_count = _BLOCK_HEADER.unpack(self.file.read(_BLOCK_HEADER.size))
+            if file_size < offset + _BLOCK_HEADER.size + payload_size:
+                break
+            entry = BlockIndexEntry(offset, payload_size, first_frame, frame_count)
+            first_packet = next(iter(self._block_packets(entry)), None)
+            if first_packet is not None:
+                frame_time = FaceFrameView(first_packet, len(first_packet)).frame_time
+                entry.frame_number = frame_time['frame_number']
+                entry.sub_frame = frame_time['sub_frame']
+                entry.numerator = frame_time['numerator']
+                entry.denominator = frame_time['denominator']
+            index.append(entry)
+            offset += _BLOCK_HEADER.size + payload_size
+            first_frame += frame_count
+        return index
+
+
+    def read_block(self, block_index):
+        """
+        Returns the inflated content of a block: size prefixed packets.
+        """
+        return self._read_block(self.index[block_index])
+
+
+    def read_batch(self, block_index):
+        """
+        Returns the frames of a block as FrameBatch.
+        """
+        entry = self.index[block_index]
+        if self.codec not in _COLUMNAR_MODES:
+            content = self._inflate_block(entry)
+            starts, sizes = _locate_packets(content, entry.frame_count, 0)
+            return decode_packed(content, starts, sizes)
+        return decode_columns(self._inflate_block(entry))
+
+
+    def _inflate_block(self, entry):
+        if self._map is not None:
+            start = entry.offset + _BLOCK_HEADER.size
+            return memoryview(self._map)[start:start + entry.payload_size]
+        self.file.seek(entry.offset)
+        _, raw_size, _ = _BLOCK_HEADER.unpack(self.file.read(_BLOCK_HEADER.size))
+        payload = self.file.read(entry.payload_size)
+        return zlib.decompress(payload, bufsize=raw_size)
+
+
+    def _read_block(self, entry):
+        if self.codec not in _COLUMNAR_MODES:
+            return self._inflate_block(entry)
+        return decode_columns(self._inflate_block(entry)).to_packed()
+
+
+    def _block_packets(self, entry):
+        content = memoryview(self._read_block(entry))
+        position = 0
+        for _ in range(0, entry.frame_count):
+            size, = _PACKET_SIZE.unpack_from(content, position)
+            position += _PACKET_SIZE.size
+            yield content[position:position + size]
+            position += size
+
+
+    def block_of(self, frame_index):
+        """
+        Returns the index of the block holding frame_index.
+        """
+        if not (0 <= frame_index < self.frame_count):
+            raise IndexError(f'Frame {frame_index} is out of range (0 - {self.frame_count})!')
+        return bisect.bisect_right(self._first_frames, frame_index) - 1
+
+
+    def frame(self, frame_index):
+        """
+        Returns the raw packet of a single frame.
+        """
+        entry = self.index[self.block_of(frame_index)]
+        return next(itertools.islice(self._block_packets(entry), frame_index - entry.first_frame, None))
+
+
+    def frames(self, start_frame = 0):
+        """
+        Yields raw packets and their frame index, starting at start_frame.
+        """
+        if self.frame_count <= start_frame:
+            return
+        first_block = self.block_of(start_frame)
+        for entry in self.index[first_block:]:
+            skip = max(0, start_frame - entry.first_frame)
+            for frame_index, packet in enumerate(itertools.islice(self._block_packets(entry), skip, None),
+                entry.first_frame + skip):
+                yield packet, frame_index
+
+
+def recording_format(filepath):
+    """
+    Determines whether filepath is a recording container, a legacy gzip
+    recording or a json clearfile.
+    """
+    with open(filepath, 'rb') as file:
+        magic = file.read(len(CONTAINER_MAGIC))
+    if CONTAINER_MAGIC == magic:
+        return FORMAT_CONTAINER
+    if magic.startswith(b'\x1f\x8b'):
+        return FORMAT_GZIP
+    return FORMAT_GZIP if is_binary_file(filepath) else FORMAT_JSON
+
+
+def segment_filepath(filepath, segment_index):
+    """
+    Returns the file of segment segment_index of a recording at filepath.
+    """
+    stem, extension = os.path.splitext(filepath)
+    return f'{stem}.{segment_index:04d}{extension}'
+
+
+def recording_segments(filepath):
+    """
+    Returns the files a recording is stored in, in order. Segmented
+    recordings are addressed by the path they were recorded to, their
+    segments are numbered next to it (see segment_filepath).
+    """
+    if os.path.exists(filepath):
+        return [filepath]
+    segments = []
+    while os.path.exists(segment_filepath(filepath, len(segments))):
+        segments.append(segment_filepath(filepath, len(segments)))
+    return segments or [filepath]
+
+
+def _read_frames_segments(segments, loop = False, start_frame = 0, end_frame = None):
+    lengths = [recording_length(segment) for segment in segments]
+    frame_count = sum(lengths)
+    end_frame = frame_count if end_frame is None else min(end_frame, frame_count)
+    keep_reading = start_frame < end_frame
+    while keep_reading:
+        first_frame = 0
+        for segment, length in zip(segments, lengths):
+            segment_start = max(0, start_frame - first_frame)
+            segment_end = min(length, end_frame - first_frame)
+            if segment_start < segment_end:
+                for frame_data, frame_index, _, version in read_frames(segment, False, segment_start, segment_end):
+                    yield frame_data, first_frame + frame_index, frame_count, version
+            first_frame += length
+        keep_reading = loop
+
+
+def _read_frames_container(filepath, loop = False, start_frame = 0, end_frame = None):
+    # The container stays open across passes, stored recordings are mapped
+    # only once.
+    with RecordingReader(filepath) as reader:
+        frame_count = len(reader)
+        keep_reading = 0 < frame_count
+        while keep_reading:
+            frames = reader.frames(start_frame)
+            if end_frame is not None:
+                frames = itertools.islice(frames, max(0, end_frame - start_frame))
+            for frame_data, frame_index in frames:
+                yield frame_data, frame_index, frame_count, reader.version
+            keep_reading = loop
+
+
+def read_frames(filepath, loop = False, start_frame = 0, end_frame = None):
+    """
+    Yields frame data, frame index, frame count and version of every frame in
+    the recording, starting at start_frame and ending before end_frame (if
+    given). When looping, every pass starts at start_frame again. Segmented
+    recordings are read as one, with frame indices running across segments.
+    """
+    segments = recording_segments(filepath)
+    if 1 < len(segments):
+        yield from _read_frames_segments(segments, loop, start_frame, end_frame)
+        return
+    filepath = segments[0]
+
+    recording = recording_format(filepath)
+    if FORMAT_CONTAINER == recording:
+        yield from _read_frames_container(filepath, loop, start_frame, end_frame)
+        return
+
+    keep_reading = True
+    while keep_reading:
+        if FORMAT_GZIP == recording:
+            frame_generator = itertools.islice(_read_frames_binary(filepath), start_frame, end_frame)
+        else:
+            frame_generator = itertools.islice(_read_frames_json(filepath), start_frame, end_frame)
+        
+        for frame_package in frame_generator:
+            yield frame_package
+
+        keep_reading = loop
+
+
+def recording_length(filepath):
+    """
+    Returns the number of frames in a recording. Containers answer from their
+    header, other formats from their stored count.
+    """
+    segments = recording_segments(filepath)
+    if 1 < len(segments):
+        return sum(recording_length(segment) for segment in segments)
+    filepath = segments[0]
+
+    recording = recording_format(filepath)
+    if FORMAT_CONTAINER == recording:
+        with RecordingReader(filepath) as reader:
+            return len(reader)
+    for _, _, frame_count, _ in read_frames(filepath):
+        return frame_count
+    return 0
+
+
+def _locate_packets(content, frame_count, offset):
+    """
+    Finds start and size of every size prefixed packet in content. Recordings
+    of a single device use one packet size, which is verified in one strided
+    pass, otherwise the size prefixes are walked one by one.
+    """
+    _require_numpy()
+    if 0 == frame_count:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+
+    first_size, = struct.unpack_from('>L', content, offset)
+    step = 4 + first_size
+    if offset + frame_count * step == len(content):
+        prefixes = numpy.frombuffer(content, dtype=numpy.uint8, offset=offset).reshape(frame_count, step)[:, :4]
+        if (prefixes.copy().view('>u4') == first_size).all():
+            starts = offset + 4 + numpy.arange(frame_count, dtype=numpy.int64) * step
+            return starts, numpy.full(frame_count, first_size, dtype=numpy.int64)
+
+    starts = numpy.empty(frame_count, dtype=numpy.int64)
+    sizes = numpy.empty(frame_count, dtype=numpy.int64)
+    position = offset
+    for frame_index in range(0, frame_count):
+        frame_size, = struct.unpack_from('>L', content, position)
+        starts[frame_index] = position + 4
+        sizes[frame_index] = frame_size
+        position += 4 + frame_size
+    if position > len(content):
+        raise Exception(f'Recording seems corrupted! Frames exceed recording size! {position}/{len(content)}')
+
+    return starts, sizes
+
+
+def map_ordered(function, items, jobs = 1, initializer = None, initargs = ()):
+    """
+    Yields function(item) for every item, in order. With more than one job
+    the items are processed by a pool of jobs worker processes. Only a few
+    items per worker are in flight, so long inputs are never held in memory
+    as a whole.
+    """
+    if 1 >= jobs:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(function, items)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer = initializer, initargs = initargs) as pool:
+        items = iter(items)
+        pending = collections.deque(pool.submit(function, item) for item in itertools.islice(items, jobs * 2))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.submit(function, item))
+            yield result
+
+
+# Reader of a pool worker process, opened once per process by the pool
+# initializer.
+_pool_reader = None
+
+
+def _open_pool_reader(filepath):
+    global _pool_reader
+    _pool_reader = RecordingReader(filepath)
+
+
+def _read_pool_batch(block_index, function = None):
+    batch = _pool_reader.read_batch(block_index)
+    return batch if function is None else function(batch)
+
+
+def map_batches(function, filepath, jobs = 1):
+    """
+    Yields function(batch) for every container block of a recording, read as
+    FrameBatch, in order. With more than one job, blocks are inflated,
+    decoded and handed to function in a pool of worker processes, which
+    only return the results. Recordings other than containers are taken as
+    single batch. Without function, the batches themselves are yielded.
+    """
+    segments = recording_segments(filepath)
+    if 1 < len(segments):
+        for segment in segments:
+            yield from map_batches(function, segment, jobs)
+        return
+    filepath = segments[0]
+
+    if FORMAT_CONTAINER != recording_format(filepath):
+        batch = load_recording(filepath)
+        yield batch if function is None else function(batch)
+        return
+
+    with RecordingReader(filepath) as reader:
+        block_count = len(reader.index)
+        if 1 >= jobs or 1 >= block_count:
+            for block_index in range(0, block_count):
+                batch = reader.read_batch(block_index)
+                yield batch if function is None else function(batch)
+            return
+
+    yield from map_ordered(functools.partial(_read_pool_batch, function = function), range(0, block_count), jobs,
+        initializer = _open_pool_reader, initargs = (filepath,))
+
+
+def read_batches(filepath, jobs = 1):
+    """
+    Yields a recording as sequence of FrameBatch, one per container block,
+    decoded in jobs worker processes (see map_batches).
+    """
+    return map_batches(None, filepath, jobs)
+
+
+def load_recording(filepath, jobs = 1):
+    """
+    Loads a whole recording into a FrameBatch. Packed recordings are inflated
+    in one go and decoded column wise, clearfiles are parsed frame by frame.
+    Containers are decoded block wise in jobs worker processes.
+    """
+    _require_numpy()
+    segments = recording_segments(filepath)
+    if 1 < len(segments):
+        return FrameBatch.concatenate(load_recording(segment, jobs) for segment in segments)
+    filepath = segments[0]
+
+    recording = recording_format(filepath)
+    if FORMAT_JSON == recording:
+        return FrameBatch.from_frames(FaceFrame.from_json(frame_json)
+            for frame_json, _, _, _ in _read_frames_json(filepath))
+
+    if FORMAT_CONTAINER == recording:
+        with RecordingReader(filepath) as reader:
+            block_wise = CODEC_ZLIB != reader.codec or 1 < jobs
+            if not block_wise:
+                content = b''.join(reader.read_block(block_index) for block_index in range(0, len(reader.index)))
+                frame_count = len(reader)
+        if block_wise:
+            return FrameBatch.concatenate(read_batches(filepath, jobs))
+        offset = 0
+    else:
+        with open(filepath, 'rb') as file:
+            content = gzip.decompress(file.read())
+
+        version, frame_count = struct.unpack_from('>BL', content, 0)
+        if version != FaceFrame.VERSION:
+            raise Exception(f'Incompatible frame versions! Recording is at {version}, llv at {FaceFrame.VERSION}.')
+        offset = struct.calcsize('>BL')
+
+    starts, sizes = _locate_packets(content, frame_count, offset)
+
+    return decode_packed(content, starts, sizes)
+
+
+class ClearfileFormatter:
+    """
+    Formats frames as json clearfile entries. Frames are formatted in one
+    %-format per frame from precomputed key fragments. Blendshape values are
+    float32, so they are written with 9 significant digits, which restores
+    the exact float32 value when packed.
+    """
+
+    # Shortest repr of a float32 widened to double takes up to 17 digits and is
+    # roughly three times slower to produce, without carrying more information.
+    SHAPE_FORMAT = '%.9g'
+    # Integral values would lose their decimal point with %g and read back as
+    # json integers, so they keep one decimal.
+    INTEGRAL_SHAPE_FORMAT = '%.1f'
+
+    def __init__(self, with_shape_values = True, with_raw_frame = False):
+        self.with_shape_values = with_shape_values
+        self.with_raw_frame = with_raw_frame
+        self._subject_prefixes = {}
+        self._templates = {}
+
+
+    def _subject_prefix(self, version, device_id, subject_name):
+        key = (version, device_id, subject_name)
+        prefix = self._subject_prefixes.get(key)
+        if prefix is None:
+            prefix = self._subject_prefixes[key] = (f'{{"version":{json.dumps(version)}'
+                f', "device_id":{json.dumps(device_id)}'
+                f', "subject_name":{json.dumps(subject_name)}'
+                ', "frame_time":{"frame_number": ').replace('%', '%%')
+        return prefix
+
+
+    def _template(self, count, sub_frame_format, shape_format, integral = None):
+        """
+        Returns the format of an entry, with values flagged in integral
+        written in INTEGRAL_SHAPE_FORMAT.
+        """
+        key = (count, sub_frame_format, shape_format, integral)
+        template = self._templates.get(key)
+        if template is None:
+            template = f'%d, "sub_frame": {sub_frame_format}, "numerator": %d, "denominator": %d}}, "blendshape_count":%d'
+            if self.with_shape_values:
+                shape_formats = [ClearfileFormatter.INTEGRAL_SHAPE_FORMAT if integral and integral[index] else shape_format
+                    for index in range(count)]
+                template += ', "blendshapes": {' \
+                    + ', '.join(f'{json.dumps(name)}: {shape_formats[index]}'
+                        for index, name in enumerate(FaceFrame.FACE_BLENDSHAPE_NAMES[:count])) + '}'
+            if self.with_raw_frame:
+                template += ', "raw_frame": { "size": %d, "data": "%s" }'
+            template += '}'
+            self._templates[key] = template
+        return template
+
+
+    def _format(self, prefix, frame_number, sub_frame, numerator, denominator, count, values, packet):
+        sub_frame_format = '%r'
+        shape_format = ClearfileFormatter.SHAPE_FORMAT
+        integral = None
+        if not math.isfinite(sum(values, sub_frame)):
+            # Neither repr nor %g match json for nan and inf, so those frames use json's float format.
+            sub_frame_format = shape_format = '%s'
+            sub_frame = json.dumps(sub_frame)
+            values = [json.dumps(value) for value in values]
+        elif self.with_shape_values:
+            integral = tuple(map(float.is_integer, values))
+            if True not in integral:
+                integral = None
+
+        fields = (frame_number, sub_frame, numerator, denominator, count)
+        if self.with_shape_values:
+            fields += tuple(values)
+        if self.with_raw_frame:
+            fields += (len(packet), binascii.b2a_base64(packet, newline=False).decode())
+        return (prefix + self._template(count, sub_frame_format, shape_format, integral)) % fields
+
+
+    def format(self, frames, packets = None):
+        """
+        Yields the entries of FaceFrames, optionally along with their raw
+        packets for the raw_frame entry (encoded from the frame otherwise).
+        """
+        packets = packets if packets is not None else itertools.repeat(None)
+        for frame, packet in zip(frames, packets):
+            count = frame.blendshape_count
+            if self.with_raw_frame and packet is None:
+                packet = frame.data
+            yield self._format(self._subject_prefix(frame.version, frame.device_id, frame.subject_name),
+                frame.frame_number, frame.sub_frame, frame.numerator, frame.denominator,
+                count, frame.blendshape_array[:count].tolist(), packet)
+
+
+    def format_batch(self, batch, packets = None):
+        """
+        Yields the entries of a FrameBatch, converting its columns in bulk.
+        """
+        if self.with_raw_frame and packets is None:
+            packets = list(batch.packets())
+        prefixes = [self._subject_prefix(*subject) for subject in batch.subjects]
+        columns = zip(batch.subject_index.tolist(), batch.frame_number.tolist(), batch.sub_frame.tolist(),
+            batch.numerator.tolist(), batch.denominator.tolist(), batch.blendshape_count.tolist(),
+            batch.blendshapes.tolist(), packets if packets is not None else itertools.repeat(None))
+        for subject_index, frame_number, sub_frame, numerator, denominator, count, values, packet in columns:
+            yield self._format(prefixes[subject_index], frame_number, sub_frame, numerator, denominator,
+                count, values[:count], packet)
+
+
+class ClearfileWriter:
+    """
+    Writes frames as json clearfile (see ClearfileFormatter), in large
+    blocks of CHUNK_SIZE frames.
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, file, frame_count, with_shape_values = True, with_raw_frame = False):
+        self.file = file
+        self.with_shape_values = with_shape_values
+        self.with_raw_frame = with_raw_frame
+        self.frames_written = 0
+        self.formatter = ClearfileFormatter(with_shape_values, with_raw_frame)
+        self._pieces = []
+
+        self.file.write(f'{{"count": {frame_count}, "frames": [')
+
+
+    def _append(self, text, frame_total = 1):
+        if 0 < self.frames_written:
+            self._pieces.append(',')
+        self._pieces.append(text)
+        self.frames_written += frame_total
+        if ClearfileWriter.CHUNK_SIZE * 2 <= len(self._pieces):
+            self.flush()
+
+
+    def write(self, frames, packets = None):
+        """
+        Writes FaceFrames, optionally along with their raw packets for the
+        raw_frame entry (encoded from the frame otherwise).
+        """
+        for text in self.formatter.format(frames, packets):
+            self._append(text)
+
+
+    def write_formatted(self, text, frame_total):
+        """
+        Writes frame_total entries, formatted by a ClearfileFormatter and
+        joined by commas.
+        """
+        if 0 < frame_total:
+            self._append(text, frame_total)
+
+
+    def flush(self):
+        self.file.write(''.join(self._pieces))
+        self._pieces = []
+
+
+    def close(self):
+        self.flush()
+        self.file.write(']}')
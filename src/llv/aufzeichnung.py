@@ -0,0 +1,415 @@
+"""
+    Recording of received frames on decoupled receive and write threads.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import threading
+from array import array
+from .gesicht import FaceFrame, FaceFrameView
+from .buchse import Empfang
+from .aufnahme import RecordingWriter, segment_filepath
+from .folge import Folge, DEFAULT_REORDER_WINDOW
+from .takt import percentiles_us
+
+
+def _safe_name(name):
+    return re.sub(r'[^\w.-]+', '_', name) or 'unnamed'
+
+
+def track_filepath(output, subject_name, device_id, taken = ()):
+    """
+    Returns the file of a subject's track next to output, named after the
+    subject (and the device, if another device already took the name).
+    """
+    stem, extension = os.path.splitext(output)
+    filepath = f'{stem}-{_safe_name(subject_name)}{extension}'
+    if filepath in taken:
+        filepath = f'{stem}-{_safe_name(subject_name)}-{_safe_name(device_id)}{extension}'
+    return filepath
+
+
+def report_filepath(output):
+    """
+    Returns the file of the loss report of a take next to output.
+    """
+    stem, _ = os.path.splitext(output)
+    return f'{stem}.loss.json'
+
+
+class _Track:
+    """
+    Writer and frame counter of one subject on one device. With a segment
+    size (in frames or seconds) given, the track rotates into numbered
+    segment files (see segment_filepath). The finished segment is closed on
+    a thread of its own, so writing goes on into the next one right away.
+    """
+
+    def __init__(self, filepath, subject_name = None, device_id = None, segment_frames = None,
+        segment_seconds = None):
+        self.filepath = filepath
+        self.subject_name = subject_name
+        self.device_id = device_id
+        self.segment_frames = segment_frames
+        self.segment_seconds = segment_seconds
+        self.segmented = segment_frames is not None or segment_seconds is not None
+        self.frames_written = 0
+        self.segments = 0
+        self.recording = None
+        self._segment_end = None
+        self._closing = []
+        self._open_segment()
+
+
+    def _open_segment(self):
+        filepath = segment_filepath(self.filepath, self.segments) if self.segmented else self.filepath
+        self.recording = RecordingWriter(filepath)
+        self.segments += 1
+        if self.segment_seconds is not None:
+            self._segment_end = time.monotonic() + self.segment_seconds
+
+
+    def write(self, packet):
+        if self.segmented and 0 < len(self.recording) and (
+            (self.segment_frames is not None and self.segment_frames <= len(self.recording))
+            or (self._segment_end is not None and self._segment_end <= time.monotonic())):
+            self.rotate()
+        self.recording.write(packet)
+        self.frames_written += 1
+
+
+    def rotate(self):
+        recording = self.recording
+        self._open_segment()
+        closing = threading.Thread(target = recording.close, name = 'llv-record-segment', daemon = True)
+        closing.start()
+        self._closing = [thread for thread in self._closing if thread.is_alive()] + [closing]
+
+
+    def close(self):
+        self.recording.close()
+        for thread in self._closing:
+            thread.join()
+        self._closing = []
+
+
+class Recorder:
+    """
+    Records the frames received by a server Buchse. A receive thread only
+    drains datagrams into pools of preallocated buffers, timestamps and
+    enqueues each batch. A writer thread validates and writes them, block
+    compression included, and hands the pools back. A slow disk thus only
+    grows the queue (allocating further pools if needed) instead of letting
+    the kernel drop datagrams. Queue depth and the time batches wait in
+    the queue are kept as back-pressure stats.
+
+    With split set, frames are demultiplexed by subject name and device id,
+    read from the packet header only, into one track file per subject
+    (see track_filepath), each counting frames on its own. Recording then
+    ends once min_tracks tracks were seen and all of them hold frames.
+    Without frames, recording goes on until stopped. Tracks rotate into
+    segments of segment_frames frames or segment_seconds seconds, if given.
+
+    Frames of every subject pass a Folge on the writer thread, which puts
+    late packets back in order within reorder_window frames and counts gaps,
+    duplicates and reordered frames. The counts are written as loss report
+    of the take (see report_filepath) once recording stops. With a
+    Filterkette given, frames are filtered in order before being written.
+    """
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, buchse, output, frames = None, verbose = False, batch_size = 16, pools = 64,
+        split = False, min_tracks = 1, segment_frames = None, segment_seconds = None,
+        reorder_window = DEFAULT_REORDER_WINDOW, report = True, filters = None):
+        self.output = output
+        self.frames = frames
+        self.verbose = verbose
+        self.split = split
+        self.min_tracks = min_tracks
+        self.segment_frames = segment_frames
+        self.segment_seconds = segment_seconds
+        self.reorder_window = reorder_window
+        self.filters = filters
+        self.report_filepath = report_filepath(output) if report else None
+        self.tracks = {}
+        self.sequences = {}
+        # One spare byte tells oversized datagrams from frames of max size.
+        self.empfang = Empfang(buchse, FaceFrame.PACKET_MAX_SIZE + 1, batch_size)
+
+        self.frames_invalid = 0
+        self.last_error = None
+        self.pools_allocated = pools
+        self.max_queued = 0
+        self.max_queued_frames = 0
+
+        self._free = queue.SimpleQueue()
+        for _ in range(pools):
+            self._free.put(self.empfang.allocate())
+        self._filled = queue.SimpleQueue()
+        # Each counted by one thread only.
+        self._frames_enqueued = 0
+        self._frames_dequeued = 0
+        self._queue_latency_ns = array('q')
+        self._running = False
+        self._done = threading.Event()
+        self._error = None
+        self._receiver = None
+        self._writer = None
+        self._started = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def start(self, receive = True):
+        """
+        Starts the writer thread and, if receive is set, the receive thread.
+        Otherwise batches are fed from outside with take_pool and put.
+        """
+        self._running = True
+        self._started = time.monotonic()
+        self._writer = threading.Thread(target = self._write, name = 'llv-record-writer', daemon = True)
+        self._writer.start()
+        if receive:
+            self._receiver = threading.Thread(target = self._receive, name = 'llv-record-receiver', daemon = True)
+            self._receiver.start()
+
+
+    def wait(self, timeout = None):
+        """
+        Waits until the requested frames are written. Returns False on
+        timeout. Errors of the writer are raised here.
+        """
+        done = self._done.wait(timeout)
+        if done and self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return done
+
+
+    def stop(self):
+        """
+        Stops receiving, writes all frames received so far and closes the
+        recording.
+        """
+        self._running = False
+        if self._receiver is not None:
+            self._receiver.join()
+            self._receiver = None
+        if self._writer is not None:
+            self._filled.put(None)
+            self._writer.join()
+            self._writer = None
+        self.empfang.close()
+
+
+    @property
+    def queued_frames(self):
+        return self._frames_enqueued - self._frames_dequeued
+
+
+    def take_pool(self):
+        """
+        Returns a free pool of buffers to receive into, allocating a new
+        one if the writer holds all of them.
+        """
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.pools_allocated += 1
+            return self.empfang.allocate()
+
+
+    def put(self, received_ns, pool, packets):
+        """
+        Hands the packets received into pool to the writer, or the pool
+        straight back if there are none. Only call from one thread.
+        """
+        if not packets:
+            self._free.put(pool)
+            return
+        self._frames_enqueued += len(packets)
+        self._filled.put((received_ns, pool, packets))
+
+
+    def _receive(self):
+        while self._running:
+            pool = self.take_pool()
+            packets = self.empfang.horch(0.1, pool)
+            self.put(time.monotonic_ns(), pool, packets)
+
+
+    @property
+    def frames_written(self):
+        return sum(track.frames_written for track in list(self.tracks.values()))
+
+
+    def _track(self, header, frame):
+        if not self.split:
+            return self.tracks[None]
+        subject_name, device_id = frame.subject_name, frame.device_id
+        taken = {track.filepath for track in self.tracks.values()}
+        track = _Track(track_filepath(self.output, subject_name, device_id, taken), subject_name, device_id,
+            self.segment_frames, self.segment_seconds)
+        self.tracks[header] = track
+        if self.verbose:
+            print(f'Recording {subject_name} ({device_id}) to {track.filepath} ...')
+        return track
+
+
+    def _sequence(self, frame):
+        """
+        Returns the sequence of a frame's subject, keyed by the raw packet
+        header. A new subject gets a track of its own if split.
+        """
+        header = bytes(frame.header)
+        sequence = self.sequences.get(header)
+        if sequence is None:
+            track = self._track(header, frame)
+
+            def write(packet):
+                if self.frames is None or track.frames_written < self.frames:
+                    if self.filters is not None:
+                        packet = self.filters.apply(FaceFrameView(packet, len(packet)))
+                    track.write(packet)
+
+            sequence = Folge(write, self.reorder_window, subject_name = frame.subject_name,
+                device_id = frame.device_id)
+            self.sequences[header] = sequence
+        return sequence
+
+
+    def _complete(self):
+        if self.frames is None or len(self.tracks) < self.min_tracks:
+            return False
+        return all(self.frames <= track.frames_written for track in self.tracks.values())
+
+
+    def _write(self):
+        try:
+            if not self.split:
+                self.tracks[None] = _Track(self.output, segment_frames = self.segment_frames,
+                    segment_seconds = self.segment_seconds)
+            self._write_batches()
+            for sequence in self.sequences.values():
+                sequence.flush()
+        except Exception as e:
+            self._error = e
+            self.last_error = str(e)
+        finally:
+            if self.report_filepath is not None:
+                try:
+                    self.write_report()
+                except Exception as e:
+                    self._error = self._error or e
+                    self.last_error = str(e)
+            for track in self.tracks.values():
+                try:
+                    track.close()
+                except Exception as e:
+                    self._error = self._error or e
+                    self.last_error = str(e)
+            self._done.set()
+
+
+    def _write_batches(self):
+        next_progress = time.monotonic() + Recorder.PROGRESS_INTERVAL
+        while True:
+            batch = self._filled.get()
+            if batch is None:
+                return
+            received_ns, pool, packets = batch
+
+            self.max_queued = max(self.max_queued, self._filled.qsize() + 1)
+            self.max_queued_frames = max(self.max_queued_frames, self.queued_frames)
+            self._queue_latency_ns.append(time.monotonic_ns() - received_ns)
+
+            for data in packets:
+                try:
+                    frame = FaceFrameView(data, len(data))
+                    sequence = self._sequence(frame)
+                except Exception as e:
+                    self.frames_invalid += 1
+                    self.last_error = str(e)
+                    continue
+                sequence.push(frame.frame_number, frame.data)
+
+            self._frames_dequeued += len(packets)
+            self._free.put(pool)
+
+            if self.verbose and next_progress <= time.monotonic():
+                next_progress = time.monotonic() + Recorder.PROGRESS_INTERVAL
+                self.print_progress()
+            if self._complete():
+                self._done.set()
+
+
+    def print_progress(self):
+        elapsed = time.monotonic() - self._started
+        budget = f'/{self.frames}' if self.frames is not None else ''
+        tracks = f' ({", ".join(f"{track.subject_name} {track.frames_written}{budget}" for track in list(self.tracks.values()))})' \
+            if self.split else ''
+        print(f'Recorded {self.frames_written}' + ('' if self.split else budget)
+            + f' frames{tracks} in {elapsed:.0f}s, {self.queued_frames} queued, {self.frames_invalid} invalid'
+            + (f' (last: {self.last_error})' if self.last_error else '') + ' ...')
+
+
+    def sequence_stats(self):
+        """
+        Returns the sequence counts of every subject.
+        """
+        return [dict(sequence.stats(), filepath = self.tracks.get(header, self.tracks.get(None)).filepath)
+            for header, sequence in list(self.sequences.items())]
+
+
+    def write_report(self):
+        report = {
+            'output': self.output,
+            'reorder_window': self.reorder_window,
+            'frames_invalid': self.frames_invalid,
+            'subjects': self.sequence_stats(),
+        }
+        with open(self.report_filepath, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+    def stats(self):
+        """
+        Returns receive batching, written and invalid frames, the
+        back-pressure of the writer (queue depth and queue latency) and the
+        sequence counts of every subject.
+        """
+        stats = self.empfang.stats()
+        stats.update({
+            'frames_written': self.frames_written,
+            'tracks': [{
+                'filepath': track.filepath,
+                'subject_name': track.subject_name,
+                'device_id': track.device_id,
+                'frames_written': track.frames_written,
+                'segments': track.segments if track.segmented else 0,
+            } for track in list(self.tracks.values())],
+            'frames_invalid': self.frames_invalid,
+            'subjects': [{key: value for key, value in subject.items() if 'gaps' != key}
+                for subject in self.sequence_stats()],
+            'last_error': self.last_error,
+            'max_queued_batches': self.max_queued,
+            'max_queued_frames': self.max_queued_frames,
+            'pools_allocated': self.pools_allocated,
+            'queue_latency_us': percentiles_us(self._queue_latency_ns),
+        })
+        return stats
@@ -8,15 +8,24 @@
 """
 
 import socket
+import selectors
+import ipaddress
+
+
+# Room for bursts of about two seconds of frames at high rates. The kernel
+# may cap the size (net.core.rmem_max on Linux).
+DEFAULT_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
 
 class Buchse():
     """
     UDP connection utility.
     """
     
-    def __init__(self, host = '', port = 11111, as_server = False):
+    def __init__(self, host = '', port = 11111, as_server = False, multicast_ttl = 1, receive_buffer_size = None):
         """
-        Create an instance of Buchse as either client or server.
+        Create an instance of Buchse as either client or server. Clients
+        sending to a multicast group reach multicast_ttl hops. Servers ask
+        for a kernel receive buffer of receive_buffer_size bytes, if given.
         """
         self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.host = host
@@ -24,6 +33,10 @@ class Buchse():
         self.is_valid = False
 
         try:
+            if not as_server and is_multicast(host):
+                self.s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            if as_server and receive_buffer_size:
+                self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
             if as_server:
                 self.s.bind((host, port))
             else:
@@ -36,6 +49,8 @@ class Buchse():
             "remote": (host, port),
             "local": self.s.getsockname()
         }
+        # Size granted by the kernel, Linux reports twice the usable size.
+        self.receive_buffer_size = self.s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
 
 
     def __del__(self):
@@ -57,4 +72,136 @@ class Buchse():
             if 0 == last_sent:
                 break
             bytes_sent += last_sent
-        return bytes_sent
\ No newline at end of file
+        return bytes_sent
+
+
+class Empfang():
+    """
+    Receives the datagrams of a server Buchse in batches. Waits on a
+    selector until datagrams are queued, then drains all of them without
+    blocking into a pool of preallocated buffers, so nothing is allocated
+    per datagram.
+    """
+
+    def __init__(self, buchse, buffer_size, batch_size = 64):
+        self.buchse = buchse
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.datagrams = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+        self.buffers = self.allocate()
+        self.buchse.s.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.buchse.s, selectors.EVENT_READ)
+
+
+    def close(self):
+        self.selector.close()
+
+
+    def allocate(self):
+        """
+        Returns a new pool of batch_size buffers to receive into.
+        """
+        pool = memoryview(bytearray(self.buffer_size * self.batch_size))
+        return [pool[offset:offset + self.buffer_size] for offset in range(0, len(pool), self.buffer_size)]
+
+
+    def horch(self, timeout = 0.5, buffers = None):
+        """
+        Waits up to timeout seconds for datagrams and returns views onto all
+        of them, at most one per buffer. Datagrams longer than buffer_size
+        are cut off. The views are only valid until the buffers (the own
+        pool, unless given) are received into again.
+        """
+        if not self.selector.select(timeout):
+            return []
+        received = []
+        recv_into = self.buchse.s.recv_into
+        for buffer in buffers if buffers is not None else self.buffers:
+            try:
+                size = recv_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            received.append(buffer[:size])
+        if received:
+            self.datagrams += len(received)
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(received))
+        return received
+
+
+    def stats(self):
+        return {
+            'datagrams': self.datagrams,
+            'batches': self.batches,
+            'largest_batch': self.largest_batch,
+            'mean_batch': self.datagrams / self.batches if 0 < self.batches else 0.0,
+            'receive_buffer_size': self.buchse.receive_buffer_size,
+        }
+
+
+def is_multicast(host):
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        return False
+
+
+def parse_target(target, default_port = 11111):
+    """
+    Splits a host:port target, falling back to default_port.
+    """
+    host, separator, port = target.rpartition(':')
+    if not separator:
+        return target, default_port
+    try:
+        return host, int(port)
+    except ValueError:
+        raise Exception(f'Invalid target {target}! Use host:port.')
+
+
+class Verteiler():
+    """
+    Sends every packet to several targets, one Buchse per target. Send
+    errors are counted per target instead of stopping the others.
+    """
+
+    def __init__(self, targets, multicast_ttl = 1):
+        self.targets = [Buchse(host, port, as_server = False, multicast_ttl = multicast_ttl)
+            for host, port in targets]
+        self.frames_sent = [0] * len(self.targets)
+        self.errors = [0] * len(self.targets)
+        self.last_errors = [None] * len(self.targets)
+
+
+    def sprech(self, data, data_size):
+        """
+        Sends data to all targets. Returns the number of targets reached.
+        """
+        reached = 0
+        for target_index, target in enumerate(self.targets):
+            try:
+                bytes_sent = target.sprech(data, data_size)
+            except OSError as e:
+                self.errors[target_index] += 1
+                self.last_errors[target_index] = str(e)
+                continue
+            if bytes_sent != data_size:
+                self.errors[target_index] += 1
+                self.last_errors[target_index] = f'Error sending full frame! ({bytes_sent}/{data_size})'
+                continue
+            self.frames_sent[target_index] += 1
+            reached += 1
+        return reached
+
+
+    def stats(self):
+        return [{
+            'target': f'{target.host}:{target.port}',
+            'frames_sent': frames_sent,
+            'errors': errors,
+            'last_error': last_error,
+        } for target, frames_sent, errors, last_error in zip(self.targets, self.frames_sent, self.errors, self.last_errors)]
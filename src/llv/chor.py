@@ -0,0 +1,215 @@
+"""
+    Concurrent playback of many recordings on one asyncio event loop.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import time
+import heapq
+import bisect
+import asyncio
+from array import array
+from .gesicht import FaceFrameView
+from .aufnahme import read_frames
+from .takt import FrameClock, RecordedTimeline, POLICY_CATCH_UP, TIMING_FIXED, TIMING_RECORDED
+
+
+class _StimmeProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, stimme):
+        self.stimme = stimme
+
+
+    def error_received(self, exc):
+        self.stimme.errors += 1
+        self.stimme.last_error = str(exc)
+
+
+def load_packets(filepath, subject_name = None, device_id = None):
+    """
+    Loads all packets of a recording into one buffer, renamed if requested.
+    Returns subject name, content, packet offsets and recorded frame times.
+    """
+    name = subject_name
+    content = bytearray()
+    offsets = array('Q', [0])
+    frame_times = []
+    for frame_data, _, _, _ in read_frames(filepath, loop = False):
+        frame = FaceFrameView(frame_data, len(frame_data))
+        frame_time = frame.frame_time
+        frame_times.append((frame_time['frame_number'], frame_time['sub_frame'],
+            frame_time['numerator'], frame_time['denominator']))
+        if subject_name:
+            content += frame.renamed(subject_name, device_id)
+        else:
+            content += frame.data
+            name = frame.subject_name
+        offsets.append(len(content))
+    if 1 == len(offsets):
+        raise Exception(f'Recording {filepath} holds no frames!')
+    return name, memoryview(content), offsets, frame_times
+
+
+class Stimme:
+    """
+    One stream of a Chor: a recording held in memory, with its own clock
+    and transports. Frames are renamed on load, if requested. Packets
+    already loaded by load_packets can be shared between streams.
+    """
+
+    def __init__(self, filepath, subject_name = None, device_id = None, fps = 60, policy = POLICY_CATCH_UP,
+        timing = TIMING_FIXED, speed = 1.0, loop = True, packets = None):
+        self.filepath = filepath
+        self.timing = timing
+        self.loop = loop
+        self.errors = 0
+        self.last_error = None
+        self.transports = []
+
+        if packets is None:
+            packets = load_packets(filepath, subject_name, device_id)
+        self.name, self.content, self.offsets, frame_times = packets
+        self.frame_count = len(self.offsets) - 1
+
+        self.timeline = None
+        if TIMING_RECORDED == timing:
+            self.timeline = RecordedTimeline(frame_times)
+            fps = self.timeline.fps
+            self._pass_duration_ns = self.timeline.pass_duration_ns(0, self.frame_count)
+        self.clock = FrameClock(fps, policy, speed = speed)
+
+        self.tick = 0
+
+
+    async def connect(self, targets):
+        loop = asyncio.get_running_loop()
+        for host, port in targets:
+            transport, _ = await loop.create_datagram_endpoint(lambda: _StimmeProtocol(self),
+                remote_addr = (host, port))
+            self.transports.append(transport)
+
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+
+    def tick_at(self, offset_ns):
+        """
+        Returns the first frame of the recording at or after offset_ns.
+        """
+        if TIMING_RECORDED == self.timing:
+            return min(self.frame_count - 1, bisect.bisect_left(self.timeline.offsets_ns, offset_ns))
+        fps = self.clock.fps
+        return min(self.frame_count - 1, -(-offset_ns * fps.numerator // (1_000_000_000 * fps.denominator)))
+
+
+    def offset_ns(self):
+        """
+        Returns the recording time of the next frame, None once done.
+        """
+        passes, frame_index = divmod(self.tick, self.frame_count)
+        if 0 < passes and not self.loop:
+            return None
+        if TIMING_RECORDED == self.timing:
+            return passes * self._pass_duration_ns + self.timeline.offsets_ns[frame_index]
+        return self.clock.offset_ns(self.tick)
+
+
+    def deadline_ns(self):
+        offset = self.offset_ns()
+        if offset is None:
+            return None
+        return self.clock.start_ns + offset * self.clock.speed.denominator // self.clock.speed.numerator
+
+
+    def send_next(self):
+        """
+        Sends the next frame once due (or drops it if late, according to the
+        policy), to every transport.
+        """
+        frame_index = self.tick % self.frame_count
+        due = self.clock.wait(self.offset_ns())
+        self.tick += 1
+        if not due:
+            return
+        packet = self.content[self.offsets[frame_index]:self.offsets[frame_index + 1]]
+        for transport in self.transports:
+            transport.sendto(packet)
+
+
+    def stats(self):
+        stats = self.clock.stats()
+        stats['name'] = self.name
+        stats['filepath'] = self.filepath
+        stats['errors'] = self.errors
+        stats['last_error'] = self.last_error
+        return stats
+
+
+class Chor:
+    """
+    Plays many Stimmen on one asyncio event loop against a shared clock.
+    A single scheduler always serves the stream due next, frames due at the
+    same time are sent back to back.
+    """
+    MAX_BACK_TO_BACK = 64
+
+    def __init__(self, stimmen, targets):
+        self.stimmen = stimmen
+        self.targets = targets
+
+
+    async def _connect(self):
+        for stimme in self.stimmen:
+            await stimme.connect(self.targets)
+
+
+    async def play(self, duration = None):
+        """
+        Plays all streams until they are done, or for duration seconds.
+        """
+        await self._connect()
+        try:
+            start_ns = time.monotonic_ns()
+            end_ns = start_ns + int(duration * 1e9) if duration is not None else None
+            for stimme in self.stimmen:
+                stimme.clock.start(start_ns)
+
+            due = [(stimme.deadline_ns(), stimme_index) for stimme_index, stimme in enumerate(self.stimmen)]
+            heapq.heapify(due)
+            back_to_back = 0
+            while due:
+                deadline, stimme_index = due[0]
+                if end_ns is not None and end_ns <= deadline:
+                    break
+                # Coarse sleep on the loop, the clock spins the remainder.
+                # Frames already due are sent without a round trip through
+                # the loop, yielding to it only every so often.
+                remaining = deadline - time.monotonic_ns()
+                if FrameClock.SPIN_NS < remaining:
+                    await asyncio.sleep((remaining - FrameClock.SPIN_NS) / 1e9)
+                    back_to_back = 0
+                elif Chor.MAX_BACK_TO_BACK <= back_to_back:
+                    await asyncio.sleep(0)
+                    back_to_back = 0
+                back_to_back += 1
+
+                stimme = self.stimmen[stimme_index]
+                stimme.send_next()
+                next_deadline = stimme.deadline_ns()
+                if next_deadline is None:
+                    heapq.heappop(due)
+                else:
+                    heapq.heapreplace(due, (next_deadline, stimme_index))
+        finally:
+            for stimme in self.stimmen:
+                stimme.close()
+
+
+    def stats(self):
+        return [stimme.stats() for stimme in self.stimmen]
@@ -12,13 +12,27 @@ import time
 import argparse
 import json
 import base64
-import struct
-import os
-import gzip
 import csv
 import math
-from .gesicht import FaceFrame, remap
-from .buchse import Buchse
+import itertools
+import functools
+import asyncio
+from array import array
+from .gesicht import FaceFrame, FaceFrameView, remap, numpy
+from .buchse import Buchse, Verteiler, parse_target, DEFAULT_RECEIVE_BUFFER_SIZE
+from .aufnahme import is_binary_file, read_frames, load_recording, read_batches, recording_length
+from .aufnahme import map_ordered, map_batches, encode_block
+from .aufnahme import ClearfileFormatter, ClearfileWriter, RecordingWriter
+from .aufnahme import CODEC_ZLIB, CODEC_COLUMNAR, CODEC_COLUMNAR_QUANTIZED, CODEC_STORED
+from .vorlauf import ReadAhead
+from .aufzeichnung import Recorder
+from .relais import Relais
+from .glaettung import Filterkette, FILTERS
+from .folge import DEFAULT_REORDER_WINDOW
+from .chor import Stimme, Chor
+from .dienst import Dienst, send_command, DEFAULT_CONTROL_PORT
+from .zwischenbild import interpolate, INTERPOLATIONS, INTERPOLATION_LINEAR
+from .takt import FrameClock, RecordedTimeline, POLICIES, POLICY_CATCH_UP, TIMINGS, TIMING_FIXED, TIMING_RECORDED
 from .__init__ import version as get_version
 
 
@@ -30,214 +44,393 @@ def tween(a, b, frames):
     return [a + i * step for i in range(0, frames)]
 
 
-def clamp(value, min_value, max_value):
-   return max(min(value, max_value), min_value)
+def print_playback_stats(stats):
+    lateness = stats['lateness_us']
+    print(f'Sent {stats["frames_sent"]} frames in {stats["elapsed"]:.3f}s @{stats["rate"]:.3f}fps'
+        f' (target {stats["target_rate"]:.3f}fps), dropped {stats["frames_dropped"]}.')
+    print(f'Lateness p50 {lateness["p50"]:.0f}us, p90 {lateness["p90"]:.0f}us'
+        f', p99 {lateness["p99"]:.0f}us, max {lateness["max"]:.0f}us')
 
 
-def is_binary_file(file_name):
-    """
-    Tries to open file in text mode and read first 64 bytes. If it fails,
-    we can be fairly certain, this is due to the file being binary encoded.
-    Thanks Sehrii https://stackoverflow.com/a/51495076/949561 for the help.
-    """
-    try:
-        with open(file_name, 'tr') as check_file:
-            check_file.read(32)
-            return False
-    except:
-        return True
-
-
-def _read_frames_json(filepath):
-    with open(filepath, 'r', encoding='utf-8', newline='\r\n') as f:
-        recording_json = json.load(f)
-
-        frame_count = recording_json['count']
-        frame_index = 0
+def print_read_ahead_stats(stats):
+    print(f'Read-ahead depth {stats["depth"]}, lowest fill {stats["min_depth"]}, mean fill {stats["mean_depth"]:.1f}'
+        f', underruns {stats["underruns"]}, frames read {stats["frames_read"]}'
+        f', cached {stats["cached_frames"]} frames for {stats["cached_passes"]} passes.')
 
-        for frame_json in recording_json['frames']:
-            yield frame_json, frame_index, frame_count, frame_json['version']
-            frame_index += 1
 
+def print_target_stats(stats):
+    for target in stats:
+        print(f'{target["target"]}: sent {target["frames_sent"]} frames, {target["errors"]} errors'
+            + (f' (last: {target["last_error"]})' if target['last_error'] else ''))
 
-def _read_frames_binary(filepath):
-    file_size = os.path.getsize(filepath)
-    with gzip.open(filepath, 'rb') as file:
-        version, = struct.unpack('>B', file.read(1))
-        if version != FaceFrame.VERSION:
-            raise Exception(f'Incompatible frame versions! Recording is at {version}, llv at {FaceFrame.VERSION}.')
-        frame_count, = struct.unpack('>L', file.read(4))
-
-        for frame_index in range(0, frame_count):
-            raw_frame_size = file.read(4)
-            frame_size, = struct.unpack('>L', raw_frame_size)
-            frame_data = file.read(frame_size)
-
-            yield frame_data, frame_index, frame_count, version
-
-        file_pos = file.tell()
-        if file_pos < file_size:
-            raise Exception(f'Recording seems corrupted! Data after last frame! {file_pos}/{file_size}')
 
+def _recorded_frame_times(filepath):
+    """
+    Yields frame number, sub frame, numerator and denominator of every frame
+    of a recording, for its RecordedTimeline.
+    """
+    for frame_data, _, _, _ in read_frames(filepath, loop = False):
+        frame_time = FaceFrameView(frame_data, len(frame_data)).frame_time
+        yield frame_time['frame_number'], frame_time['sub_frame'], frame_time['numerator'], frame_time['denominator']
+
+
+def playback(host, port, filepath, fps, loop = True, start_frame = 0, policy = POLICY_CATCH_UP,
+    timing = TIMING_FIXED, speed = 1.0, start = None, end = None, buffer_depth = ReadAhead.DEFAULT_DEPTH,
+    cache = False, targets = None, multicast_ttl = 1, resample = None, interpolation = INTERPOLATION_LINEAR,
+    filters = None):
+    timeline = None
+    end_frame = None
+    if TIMING_RECORDED == timing or start is not None or end is not None:
+        timeline = RecordedTimeline(_recorded_frame_times(filepath))
+        if 0 == len(timeline):
+            return -1, 0
+        start_frame, end_frame = timeline.frame_range(start, end, start_frame)
+        if TIMING_RECORDED == timing:
+            fps = timeline.fps
+    source_clock = FrameClock(fps, policy, speed = speed)
+    clock = FrameClock(resample, policy, speed = speed) if resample else source_clock
+
+    verteiler = Verteiler(targets if targets else [(host, port)], multicast_ttl)
+    for buchse in verteiler.targets:
+        print(f'Establish connection ({buchse.connection_info}) ...')
 
-def read_frames(filepath, loop = False):
-    is_binary = is_binary_file(filepath)
-    keep_reading = True
-    while keep_reading:
-        if is_binary:
-            frame_generator = _read_frames_binary(filepath)
+    frame_index = -1
+    frame_count = -1
+    read_ahead = ReadAhead(filepath, loop, start_frame, end_frame, buffer_depth, cache)
+
+    def frames():
+        """
+        Yields the presentation offset and the packet of every frame read.
+        """
+        nonlocal frame_index, frame_count
+        pass_offset = 0
+        for tick, frame_package in enumerate(read_ahead):
+            frame, frame_index, frame_count, version = frame_package
+            if start_frame == frame_index:
+                if 0 < tick and TIMING_RECORDED == timing:
+                    pass_offset += timeline.pass_duration_ns(start_frame, end_frame)
+                print(f'Start sending {frame_count} frames of version {version} @{float(fps * speed):g}fps ({timing} timing)'
+                    + (f' resampled to {float(clock.fps * speed):g}fps ({interpolation})' if resample else '') + ' ...')
+
+            if TIMING_RECORDED == timing:
+                yield pass_offset + timeline.offsets_ns[frame_index] - timeline.offsets_ns[start_frame], frame
+            else:
+                yield source_clock.offset_ns(tick), frame
+
+    with read_ahead:
+        if resample:
+            packets = interpolate(frames(), resample, interpolation)
         else:
-            frame_generator = _read_frames_json(filepath)
-        
-        for frame_package in frame_generator:
-            yield frame_package
+            packets = ((offset, frame.data) for offset, frame in frames())
+        if filters is not None:
+            packets = ((offset, filters.apply(FaceFrameView(packet, len(packet)))) for offset, packet in packets)
+        try:
+            for offset, packet in packets:
+                if clock.wait(offset):
+                    verteiler.sprech(packet, len(packet))
+        except KeyboardInterrupt:
+            print('Stopping playback ...')
 
-        keep_reading = loop
+    print_playback_stats(clock.stats())
+    print_read_ahead_stats(read_ahead.stats())
+    print_target_stats(verteiler.stats())
 
+    return frame_index, frame_count
 
-def playback(host, port, filepath, fps, loop = True):
-    fps = clamp(fps, 1, 76) # https://stackoverflow.com/a/1133888
 
-    sleep_time = 1/fps
+def play_many(recordings, targets, fps, loop = True, policy = POLICY_CATCH_UP, timing = TIMING_FIXED,
+    speed = 1.0, duration = None):
+    stimmen = []
+    for recording in recordings:
+        # Recordings are given as path, or as path=subject name to rename them.
+        filepath, separator, subject_name = recording.rpartition('=')
+        if not separator:
+            filepath, subject_name = recording, None
+        stimmen.append(Stimme(filepath, subject_name, 'DEADC0DE-1337-1337-1337-CAFEBABE' if subject_name else None,
+            fps, policy, timing, speed, loop))
 
-    buchse = Buchse(host, port, as_server = False)
-    print(f'Establish connection ({buchse.connection_info}) ...')
+    chor = Chor(stimmen, targets)
+    print(f'Start sending {len(stimmen)} streams to {", ".join(f"{host}:{port}" for host, port in targets)} ({timing} timing) ...')
+    try:
+        asyncio.run(chor.play(duration))
+    except KeyboardInterrupt:
+        print('Stopping playback ...')
 
-    frame_index = -1
-    frame_count = -1
-    for frame_package in read_frames(filepath, loop=loop):
-        frame_data, frame_index, frame_count, version = frame_package
-        if 0 == frame_index:
-            print(f'Start sending {frame_count} frames of version {version} @{fps}fps ...')
+    for stats in chor.stats():
+        lateness = stats['lateness_us']
+        print(f'{stats["name"]} ({stats["filepath"]}): sent {stats["frames_sent"]} @{stats["rate"]:.3f}fps'
+            f', dropped {stats["frames_dropped"]}, errors {stats["errors"]}'
+            f', lateness p50 {lateness["p50"]:.0f}us p99 {lateness["p99"]:.0f}us max {lateness["max"]:.0f}us')
 
-        frame = FaceFrame.from_raw(frame_data, len(frame_data))
+    return chor
 
-        bytes_sent = buchse.sprech(frame.data, frame.size)
-        if bytes_sent != frame.size:
-            raise Exception(f'Error sending full frame! ({bytes_sent}/{frame.size})')
 
-        try:
-            time.sleep(sleep_time)
-        except KeyboardInterrupt:
-            print('Stopping playback ...')
-            break
+def serve(targets, fps = 60, policy = POLICY_CATCH_UP, socket_path = None, control_port = DEFAULT_CONTROL_PORT):
+    dienst = Dienst(targets, fps, policy)
+    print(f'Serving commands on {socket_path or f"127.0.0.1:{control_port}"} ...')
+    try:
+        asyncio.run(dienst.serve(socket_path, port = control_port))
+    except KeyboardInterrupt:
+        print('Stopping daemon ...')
 
-    return frame_index, frame_count
 
+def control(command, arguments, socket_path = None, control_port = DEFAULT_CONTROL_PORT):
+    """
+    Sends a command with key=value arguments (JSON values) to the daemon.
+    """
+    request = {'command': command}
+    for argument in arguments:
+        key, separator, value = argument.partition('=')
+        if not separator:
+            raise Exception(f'Invalid argument {argument}! Use key=value.')
+        try:
+            request[key] = json.loads(value)
+        except ValueError:
+            request[key] = value
+    response, round_trip = send_command(request, socket_path, port = control_port)
+    print(json.dumps(response, indent = 2))
+    print(f'Answered in {round_trip * 1e6:.0f}us')
+    return response
 
-def record(host, port, frames, output, with_raw_frame = False):
-    sleep_time = 1/76 # https://stackoverflow.com/a/1133888
-    buchse = Buchse(host, port, as_server = True)
 
-    print(f'Waiting for {frames} frames to write ...')
+def open_receiver(host, port, receive_buffer_size = DEFAULT_RECEIVE_BUFFER_SIZE):
+    """
+    Returns a server Buchse, warning if the kernel granted a smaller
+    receive buffer than requested.
+    """
+    buchse = Buchse(host, port, as_server = True, receive_buffer_size = receive_buffer_size)
+    if buchse.receive_buffer_size < receive_buffer_size:
+        print(f'Kernel granted a receive buffer of only {buchse.receive_buffer_size} bytes'
+            f' (requested {receive_buffer_size}), bursts may be dropped.')
+    return buchse
 
-    with gzip.open(output, 'wb') as file:
-        file.write(struct.pack('>B', FaceFrame.VERSION)) # version of the binary protocol
-        file.write(struct.pack('>L', frames)) # how many frames are in the recording?
 
-        current_data_frame = 0
-        while current_data_frame < frames:
-            try:
-                time.sleep(sleep_time)
-            except KeyboardInterrupt:
-                print('Stopping playback ...')
-                break
+def print_receive_stats(stats):
+    print(f'Received {stats["datagrams"]} datagrams in {stats["batches"]} batches'
+        f' (mean {stats["mean_batch"]:.1f}, largest {stats["largest_batch"]}), {stats["frames_invalid"]} invalid'
+        + (f' (last: {stats["last_error"]})' if stats['last_error'] else '') + '.')
 
-            data, size = buchse.horch(FaceFrame.PACKET_MAX_SIZE)
-            if not data or 0 == size:
-                print(f'Received empty frame, skipping ...')
-                continue
 
-            try:
-                frame = FaceFrame.from_raw(data, size)
-            except Exception as e:
-                print(f'Encountered: {e}')
-                print(f'Skipping frame ...')
-                continue
+def record(host, port, frames, output, with_raw_frame = False, receive_buffer_size = DEFAULT_RECEIVE_BUFFER_SIZE,
+    verbose = False, split = False, min_tracks = 1, duration = None, segment_frames = None, segment_seconds = None,
+    reorder_window = DEFAULT_REORDER_WINDOW, filters = None):
+    buchse = open_receiver(host, port, receive_buffer_size)
 
-            print(f'Processing frame {current_data_frame+1} ({frame.frame_time["frame_number"]}) ...')
+    # Without a frame count, recording goes on until stopped or for duration.
+    frames = frames or None
+    until = f' for {duration:g}s' if duration else ' until stopped' if frames is None else ''
+    if split:
+        print(f'Waiting for {frames or "all"} frames per subject of at least {min_tracks} subjects to write{until} ...')
+    else:
+        print(f'Waiting for {frames or "all"} frames to write{until} ...')
+    if segment_frames or segment_seconds:
+        print(f'Rotating segments every ' + ' or '.join(limit for limit in (
+            f'{segment_frames} frames' if segment_frames else None,
+            f'{segment_seconds:g}s' if segment_seconds else None) if limit) + ' ...')
+
+    recorder = Recorder(buchse, output, frames, verbose, split = split, min_tracks = min_tracks,
+        segment_frames = segment_frames or None, segment_seconds = segment_seconds or None,
+        reorder_window = reorder_window, filters = filters)
+    deadline = time.monotonic() + duration if duration else None
+    with recorder:
+        try:
+            while not recorder.wait(0.5 if deadline is None else max(0, min(0.5, deadline - time.monotonic()))):
+                if deadline is not None and deadline <= time.monotonic():
+                    break
+        except KeyboardInterrupt:
+            print('Stopping recording ...')
+
+    stats = recorder.stats()
+    latency = stats['queue_latency_us']
+    print_receive_stats(stats)
+    print(f'Writer queued up to {stats["max_queued_frames"]} frames in {stats["max_queued_batches"]} batches'
+        f' ({stats["pools_allocated"]} buffer pools), queue latency p50 {latency["p50"]:.0f}us'
+        f', p99 {latency["p99"]:.0f}us, max {latency["max"]:.0f}us')
+    for track in stats['tracks']:
+        if split:
+            print(f'{track["subject_name"]} ({track["device_id"]}): {track["frames_written"]}/{frames or "-"} frames'
+                f' written to {track["filepath"]}' + (f' in {track["segments"]} segments' if track['segments'] else ''))
+        elif track['segments']:
+            print(f'Written {track["segments"]} segments next to {track["filepath"]}')
+    for subject in stats['subjects']:
+        print(f'{subject["subject_name"]} ({subject["device_id"]}): frames {subject["first_frame"]}'
+            f' to {subject["last_frame"]}, {subject["lost"]} lost in {subject["gap_count"]} gaps ({subject["loss"]:.2%}),'
+            f' {subject["reordered"]} reordered, {subject["late"]} late, {subject["duplicates"]} duplicates'
+            + (f', {subject["restarts"]} restarts' if subject['restarts'] else '') + '.')
+    print(f'Written loss report to {recorder.report_filepath}')
+    if frames is None:
+        return recorder.frames_written, recorder.frames_written, output
+    if split:
+        return recorder.frames_written, frames * len(stats['tracks']), output
+
+    return recorder.frames_written, frames, output
+
+
+def relay(host, port, targets, multicast_ttl = 1, output = None, receive_buffer_size = DEFAULT_RECEIVE_BUFFER_SIZE,
+    verbose = False, split = False, duration = None, reorder_window = DEFAULT_REORDER_WINDOW, filters = None):
+    """
+    Forwards received frames to targets until interrupted or for duration
+    seconds, recording them to output as well, if given. Forwarded frames
+    pass filters, if given, recorded ones do not.
+    """
+    if not targets:
+        raise Exception('Relaying needs at least one target!')
+    buchse = open_receiver(host, port, receive_buffer_size)
+
+    recorder = Recorder(buchse, output, split = split, reorder_window = reorder_window) if output else None
+    relais = Relais(buchse, targets, recorder, multicast_ttl, filters = filters)
+    print(f'Relaying frames from port {port} to {", ".join(f"{host}:{port}" for host, port in targets)}'
+        + (f', recording to {output}' if output else '')
+        + (f' for {duration:g}s' if duration else '') + ' ...')
+    deadline = time.monotonic() + duration if duration else None
+    with relais:
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                timeout = 1.0 if deadline is None else max(0, min(1.0, deadline - time.monotonic()))
+                # Errors of the recording writer are raised by wait.
+                if recorder is None:
+                    time.sleep(timeout)
+                elif recorder.wait(timeout):
+                    break
+                if verbose:
+                    relais.print_progress()
+        except KeyboardInterrupt:
+            print('Stopping relay ...')
+    if recorder is not None:
+        recorder.wait(0)
 
-            frame_packet = frame.encode()
-            file.write(frame_packet)
+    stats = relais.stats()
+    latency = stats['forward_latency_us']
+    print_receive_stats(stats)
+    print(f'Forwarded {stats["frames_forwarded"]} frames, forward latency p50 {latency["p50"]:.0f}us'
+        f', p99 {latency["p99"]:.0f}us, max {latency["max"]:.0f}us')
+    print_target_stats(stats['targets'])
+    if recorder is not None:
+        for subject in recorder.stats()['subjects']:
+            print(f'{subject["subject_name"]} ({subject["device_id"]}): {subject["written"]} frames'
+                f' written to {subject["filepath"]}, {subject["lost"]} lost ({subject["loss"]:.2%}).')
+        print(f'Written loss report to {recorder.report_filepath}')
+    return stats
 
-            current_data_frame += 1
 
-    return current_data_frame, frames, output
+def _chunks(items, size):
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
 
 
-def unpack(raw_file, output, retain_raw_frame = True, rename = ''):
-    with open(output, 'w', encoding='utf-8', newline='\r\n') as file:
-        frame_index = -1
-        frame_count = -1
-        for frame_data, frame_index, frame_count, version in read_frames(raw_file, loop = False):
-            if 0 == frame_index:
-                file.write(f'{{"count": {frame_count}, "frames": [')
+def _rename_subjects(subjects, rename):
+    return [(version, 'DEADC0DE-1337-1337-1337-CAFEBABE', rename) for version, _, _ in subjects]
 
-            frame = FaceFrame.from_raw(frame_data, len(frame_data))
 
-            if 0 < len(rename):
-                frame.subject_name = rename
-                frame.device_id = 'DEADC0DE-1337-1337-1337-CAFEBABE'
+def _format_batch(batch, retain_raw_frame, rename):
+    """
+    Formats a FrameBatch as clearfile entries (pipeline worker).
+    """
+    formatter = ClearfileFormatter(with_raw_frame = retain_raw_frame)
+    if 0 < len(rename):
+        batch.subjects = _rename_subjects(batch.subjects, rename)
+    return ','.join(formatter.format_batch(batch)), len(batch)
 
-            file.write(frame.to_json(with_raw_frame = retain_raw_frame))
 
-            if frame_index < (frame_count - 1):
-                file.write(',')
+def _format_packets(packets, retain_raw_frame, rename):
+    """
+    Formats a chunk of raw packets as clearfile entries, without numpy
+    (pipeline worker).
+    """
+    formatter = ClearfileFormatter(with_raw_frame = retain_raw_frame)
+    frames = [FaceFrame.from_raw(packet, len(packet)) for packet in packets]
+    if 0 < len(rename):
+        for frame in frames:
+            frame.subject_name = rename
+            frame.device_id = 'DEADC0DE-1337-1337-1337-CAFEBABE'
+    return ','.join(formatter.format(frames, None if rename else packets)), len(packets)
 
-        file.write(']}')
 
+def _encode_frames(frame_jsons, rename, codec, compresslevel):
+    """
+    Encodes a chunk of json frames into a container block (pipeline worker).
+    """
+    content = bytearray()
+    for frame_json in frame_jsons:
+        if 0 < len(rename):
+            frame_json['subject_name'] = rename
+            frame_json['device_id'] = 'DEADC0DE-1337-1337-1337-CAFEBABE'
+        frame = FaceFrame.from_json(frame_json)
+        if 0 == len(content):
+            frame_time = frame.frame_time
+        content += frame.encode()
+    payload, raw_size = encode_block(content, len(frame_jsons), codec, compresslevel)
+    return payload, raw_size, len(frame_jsons), frame_time
+
+
+def _encode_legacy_lines(lines, rename, codec, compresslevel):
+    """
+    Decodes a chunk of base64 json lines and encodes them into a container
+    block (pipeline worker).
+    """
+    frame_jsons = [json.loads(base64.b64decode(line).decode('utf8')) for line in lines]
+    return _encode_frames(frame_jsons, rename, codec, compresslevel)
 
-def pack(clear_filepath, output, rename = ''):
-    print(f'Generating packed recording at {clear_filepath} from clearfile {clear_filepath} ...')
-    with gzip.open(output, 'wb') as outfile:
-        outfile.write(struct.pack('>B', FaceFrame.VERSION)) # version of the binary protocol
 
-        for frame_json, frame_index, frame_count, version in read_frames(clear_filepath, is_binary = False, loop = False):
-            if 0 == frame_index:
-                # how many frames are in the recording?
-                outfile.write(struct.pack('>L', frame_count))
+def unpack(raw_file, output, retain_raw_frame = True, rename = '', jobs = 1):
+    with open(output, 'w', encoding='utf-8', newline='\r\n', buffering=1 << 20) as file:
+        writer = ClearfileWriter(file, recording_length(raw_file), with_raw_frame = retain_raw_frame)
+        if numpy is not None:
+            format_batch = functools.partial(_format_batch, retain_raw_frame = retain_raw_frame, rename = rename)
+            entries = map_batches(format_batch, raw_file, jobs)
+        else:
+            packets = (bytes(frame_data) for frame_data, _, _, _ in read_frames(raw_file, loop = False))
+            format_chunk = functools.partial(_format_packets, retain_raw_frame = retain_raw_frame, rename = rename)
+            entries = map_ordered(format_chunk, _chunks(packets, ClearfileWriter.CHUNK_SIZE), jobs)
+        for text, frame_total in entries:
+            writer.write_formatted(text, frame_total)
+        writer.close()
 
-            if 0 < len(rename):
-                frame_json['subject_name'] = rename
-                frame_json['device_id'] = 'DEADC0DE-1337-1337-1337-CAFEBABE'
 
-            frame = FaceFrame.from_json(frame_json)
-            outfile.write(frame.encode())
+def pack(clear_filepath, output, rename = '', jobs = 1):
+    print(f'Generating packed recording at {clear_filepath} from clearfile {clear_filepath} ...')
+    with RecordingWriter(output) as recording:
+        frame_jsons = (frame_json for frame_json, _, _, _ in read_frames(clear_filepath, loop = False))
+        encode_chunk = functools.partial(_encode_frames, rename = rename,
+            codec = recording.codec, compresslevel = recording.compresslevel)
+        for block in map_ordered(encode_chunk, _chunks(frame_jsons, recording.block_size), jobs):
+            recording.write_block(*block)
 
     print(f'Done.')
 
 
-def migrate(legacy_file, output, rename = ''):
-    with gzip.open(output, 'wb') as outfile:
-        outfile.write(struct.pack('>B', FaceFrame.VERSION)) # version of the binary protocol
-
-        line_count = 0
+def migrate(legacy_file, output, rename = '', jobs = 1):
+    with RecordingWriter(output) as recording:
         with open(legacy_file, 'r', encoding='utf-8', newline='\r\n') as infile:
-            for _ in infile.readlines():
-                line_count += 1
-
-            outfile.write(struct.pack('>L', line_count)) # how many frames are in the recording?
+            encode_chunk = functools.partial(_encode_legacy_lines, rename = rename,
+                codec = recording.codec, compresslevel = recording.compresslevel)
+            for block in map_ordered(encode_chunk, _chunks(infile, recording.block_size), jobs):
+                recording.write_block(*block)
 
-        print(f'Processing {line_count} legacy frames ...')
-
-        with open(legacy_file, 'r', encoding='utf-8', newline='\r\n') as infile:
-            line_index = 0
-            for l in infile.readlines():
-                line_index += 1
+        print(f'Migrated {len(recording)} legacy frames.')
 
-                decoded_line = base64.b64decode(l)
-                decoded_line_string = decoded_line.decode('utf8')
-                frame_json = json.loads(decoded_line_string)
 
-                if 0 < len(rename):
-                    frame_json['subject_name'] = rename
-                    frame_json['device_id'] = 'DEADC0DE-1337-1337-1337-CAFEBABE'
+def convert(recording_filepath, output, codec = CODEC_ZLIB, jobs = 1):
+    print(f'Converting recording {recording_filepath} to {output} ...')
+    with RecordingWriter(output, codec = codec) as recording:
+        if 1 < jobs and numpy is not None:
+            for batch in read_batches(recording_filepath, jobs):
+                for packet in batch.packets():
+                    recording.write(packet)
+        else:
+            for frame_data, frame_index, frame_count, version in read_frames(recording_filepath, loop = False):
+                if isinstance(frame_data, dict):
+                    recording.write_frame(FaceFrame.from_json(frame_data))
+                else:
+                    recording.write(frame_data)
 
-                frame = FaceFrame.from_json(frame_json)
-                outfile.write(frame.encode())
+    print(f'Done.')
 
 
-def _write_frames_for_shape(file, shape_name, frames_per_shape, total_number_of_shapes, min_value = -1.0, max_value = 1.0):
+def _write_frames_for_shape(recording, shape_name, frames_per_shape, total_number_of_shapes, min_value = -1.0, max_value = 1.0):
     shape_index = 0
     for shape_frame_index in range(0, frames_per_shape):
         frame_index = shape_index*total_number_of_shapes + shape_frame_index
@@ -245,7 +438,7 @@ def _write_frames_for_shape(file, shape_name, frames_per_shape, total_number_of_
         frame = FaceFrame.from_default(frame_index)
         frame.blendshapes[shape_name] = remap(shape_frame_index, 0, frames_per_shape-1, min_value, max_value)
 
-        file.write(frame.encode())
+        recording.write_frame(frame)
 
 
 def sequence(output, time_per_shape = 1.1, fps = 60, single_shape = '', min_value = -1.0, max_value = 1.0):
@@ -259,20 +452,17 @@ def sequence(output, time_per_shape = 1.1, fps = 60, single_shape = '', min_valu
 
     print(f'Creating {output} with a total of {total_number_of_frames}')
 
-    with gzip.open(output, 'wb') as file:
-        file.write(struct.pack('>B', FaceFrame.VERSION)) # version of the binary protocol
-        file.write(struct.pack('>L', total_number_of_frames)) # how many frames are in the recording?
-
+    with RecordingWriter(output) as recording:
         if 0 < len(single_shape):
             print(f'Preparing animtion of a single shape ({single_shape}) ...')
             if not single_shape in FaceFrame.FACE_BLENDSHAPE_NAMES:
                 raise Exception(f'Could not find {single_shape} in shape blendshape defintion!')
-            _write_frames_for_shape(file, single_shape, frames_per_shape, total_number_of_shapes, min_value, max_value)
+            _write_frames_for_shape(recording, single_shape, frames_per_shape, total_number_of_shapes, min_value, max_value)
         else:
             print(f'Preparing sequence of all available shapes ...')
             for shape_index in range(0, total_number_of_shapes):
                 shape_name = FaceFrame.FACE_BLENDSHAPE_NAMES[shape_index]
-                _write_frames_for_shape(file, shape_name, frames_per_shape, total_number_of_shapes, min_value, max_value)
+                _write_frames_for_shape(recording, shape_name, frames_per_shape, total_number_of_shapes, min_value, max_value)
 
     return frames_written
 
@@ -286,11 +476,14 @@ def create_modifier(output_path, default_value = 1.0):
         f.write(json.dumps(modifiers))
 
 
-def apply_modifiers(recording_filepath, modifiers_filepath, default_value = 1.0):
-    is_binary_recording = is_binary_file(recording_filepath)
-    for frame_data, frame_index, frame_count, version \
-        in read_frames(recording_filepath, is_binary = is_binary_recording, loop = False):
-        raise Exception('Not implemented yet!')
+def apply_modifiers(recording_filepath, modifiers_filepath, default_value = 1.0, jobs = 1):
+    with open(modifiers_filepath, 'r', encoding='utf-8', newline='\r\n') as f:
+        modifiers = json.load(f)
+
+    batch = load_recording(recording_filepath, jobs)
+    batch.scale([modifiers.get(shape_name, default_value) for shape_name in FaceFrame.FACE_BLENDSHAPE_NAMES])
+
+    return batch
 
 
 def create_remap_library(csv_filepath, library_filepath, dialect = 'excel'):
@@ -379,26 +572,18 @@ def fbx_meta(fbx_meta_filepath, library_filepath, output_path):
 
     total_number_of_frames = (options['samples']-1) * options['tweens']
     print(f'Processing {total_number_of_frames} frames ...')
-    with open(output_path, 'w', encoding='utf-8', newline='\r\n') as file:
-        file.write(f'{{"count": {total_number_of_frames}, "frames": [')
-        for frame_index in range(0, total_number_of_frames):
-            frame = FaceFrame.from_default(frame_index)
-            for shape_name in FaceFrame.FACE_BLENDSHAPE_NAMES:
-                shape_value = 0
-                if shape_name in shape_values:
-                    try:
-                        shape_value = shape_values[shape_name][frame_index]
-                    except Exception as e:
-                        print(f'Got {e} when accessing {frame_index} / len {len(shape_values[shape_name])}')
-                        raise e
-                frame.blendshapes[shape_name] = shape_value
-
-            file.write(frame.to_json())
-
-            if frame_index < (total_number_of_frames - 1):
-                file.write(',')
-
-        file.write(']}')
+    shape_rows = zip(*(shape_values[shape_name] for shape_name in FaceFrame.FACE_BLENDSHAPE_NAMES))
+    with open(output_path, 'w', encoding='utf-8', newline='\r\n', buffering=1 << 20) as file:
+        writer = ClearfileWriter(file, total_number_of_frames)
+        writer.write(_frames_from_rows(shape_rows, total_number_of_frames))
+        writer.close()
+
+
+def _frames_from_rows(shape_rows, total_number_of_frames):
+    for frame_index, shape_row in zip(range(0, total_number_of_frames), shape_rows):
+        frame = FaceFrame.from_default(frame_index)
+        frame.blendshape_array[:] = array('f', shape_row)
+        yield frame
         
 
 def create_arg_parser():
@@ -425,12 +610,39 @@ def create_arg_parser():
         , help='Port to host server on.'
         , default=11111)
     record_args.add_argument('--frames', metavar='f', type=int
-        , help='Frame count to record.'
+        , help='Frame count to record, 0 to record until stopped.'
         , default=300)
+    record_args.add_argument('--duration', metavar='s', type=float
+        , help='Seconds to record for, at most.'
+        , default=None)
+    record_args.add_argument('--segment-frames', metavar='n', type=int
+        , help='Rotate the recording into a new segment file every n frames.'
+        , default=None)
+    record_args.add_argument('--segment-minutes', metavar='m', type=float
+        , help='Rotate the recording into a new segment file every m minutes.'
+        , default=None)
     record_args.add_argument('--with-raw'
         , action='store_true'
         , help='Flag to configure if recording should retain raw binary network frame. (false by default)'
         , default=False)
+    record_args.add_argument('--receive-buffer', metavar='b', type=int
+        , help='Size of the kernel receive buffer in bytes, absorbing bursts of frames.'
+        , default=DEFAULT_RECEIVE_BUFFER_SIZE)
+    record_args.add_argument('--split'
+        , action='store_true'
+        , help='Record every subject (and device) into a track file of its own, next to --output,'
+            ' counting --frames per track. (false by default)'
+        , default=False)
+    record_args.add_argument('--tracks', metavar='n', type=int
+        , help='Number of subjects to wait for with --split.'
+        , default=1)
+    record_args.add_argument('--reorder-window', metavar='n', type=int
+        , help='Frames to hold back at most, restoring the order of late packets by frame number.'
+        , default=DEFAULT_REORDER_WINDOW)
+    record_args.add_argument('--filter', metavar='name:key=value,...', type=str, action='append'
+        , help='Filter applied to the blendshapes of recorded frames, may be given several times to chain filters.'
+            f' One of {", ".join(FILTERS)}, optionally limited to channels=Name+Name.'
+        , default=[])
     record_args.add_argument('--output', metavar='o', type=str
         , help='Path where recording is stored.'
         , default=f'./recording-{time.strftime("%Y-%m-%d-%H-%M-%S")}.gesichter')
@@ -448,6 +660,154 @@ def create_arg_parser():
     play_args.add_argument('--port', metavar='p', type=int
         , help='Port to target.'
         , default=11111)
+    play_args.add_argument('--target', metavar='host:port', type=str, action='append'
+        , help='Target to send data to, may be given several times. (replaces --host and --port)'
+        , default=[])
+    play_args.add_argument('--multicast', metavar='group:port', type=str, action='append'
+        , help='Multicast group to send data to, may be given several times.'
+        , default=[])
+    play_args.add_argument('--ttl', metavar='n', type=int
+        , help='Time to live (hops) of multicast packets.'
+        , default=1)
+    play_args.add_argument('--start-frame', metavar='s', type=int
+        , help='Index of the frame to start (and loop) playback from.'
+        , default=0)
+    play_args.add_argument('--policy', type=str, choices=POLICIES
+        , help='Handling of late frames, either sent right away (catch-up) or skipped (drop).'
+        , default=POLICY_CATCH_UP)
+    play_args.add_argument('--timing', type=str, choices=TIMINGS
+        , help='Send frames at --fps (fixed) or at their recorded frame time (recorded).'
+        , default=TIMING_FIXED)
+    play_args.add_argument('--buffer', metavar='n', type=int
+        , help='Number of frames read ahead of playback.'
+        , default=ReadAhead.DEFAULT_DEPTH)
+    play_args.add_argument('--cache'
+        , action='store_true'
+        , help='Keep the recording in memory after the first pass, looping without file access. (false by default)'
+        , default=False)
+    play_args.add_argument('--speed', metavar='x', type=float
+        , help='Playback speed multiplier.'
+        , default=1.0)
+    play_args.add_argument('--start', metavar='t', type=str
+        , help='Timecode (HH:MM:SS:FF) or frame number of the first frame to play.'
+        , default=None)
+    play_args.add_argument('--end', metavar='t', type=str
+        , help='Timecode (HH:MM:SS:FF) or frame number of the last frame to play.'
+        , default=None)
+    play_args.add_argument('--resample', metavar='f', type=float
+        , help='Output rate to resample playback to, interpolating blendshapes between frames. (requires numpy)'
+        , default=None)
+    play_args.add_argument('--interpolation', type=str, choices=INTERPOLATIONS
+        , help='Interpolation used by --resample, linear or a smoothed cubic.'
+        , default=INTERPOLATION_LINEAR)
+    play_args.add_argument('--filter', metavar='name:key=value,...', type=str, action='append'
+        , help='Filter applied to the blendshapes of sent frames, may be given several times to chain filters.'
+            f' One of {", ".join(FILTERS)}, optionally limited to channels=Name+Name.'
+        , default=[])
+
+    # Setup serve command and options.
+    serve_args = subparsers.add_parser('serve')
+    serve_args.add_argument('--socket', metavar='path', type=str
+        , help='Unix socket to receive commands on. (replaces --control-port)'
+        , default=None)
+    serve_args.add_argument('--control-port', metavar='p', type=int
+        , help='Loopback port to receive commands on.'
+        , default=DEFAULT_CONTROL_PORT)
+    serve_args.add_argument('--fps', metavar='f', type=float
+        , help='Default playback speed for animation frames.'
+        , default=60)
+    serve_args.add_argument('--host', metavar='h', type=str
+        , help='Default target host to send data to.'
+        , default='localhost')
+    serve_args.add_argument('--port', metavar='p', type=int
+        , help='Default port to target.'
+        , default=11111)
+    serve_args.add_argument('--target', metavar='host:port', type=str, action='append'
+        , help='Default target to send data to, may be given several times. (replaces --host and --port)'
+        , default=[])
+    serve_args.add_argument('--policy', type=str, choices=POLICIES
+        , help='Handling of late frames, either sent right away (catch-up) or skipped (drop).'
+        , default=POLICY_CATCH_UP)
+
+    # Setup relay command and options.
+    relay_args = subparsers.add_parser('relay')
+    relay_args.add_argument('--host', metavar='h', type=str
+        , help='Host address to listen on.'
+        , default='')
+    relay_args.add_argument('--port', metavar='p', type=int
+        , help='Port to listen on.'
+        , default=11111)
+    relay_args.add_argument('--target', metavar='host:port', type=str, action='append'
+        , help='Target to forward frames to, may be given several times.'
+        , default=[])
+    relay_args.add_argument('--multicast', metavar='group:port', type=str, action='append'
+        , help='Multicast group to forward frames to, may be given several times.'
+        , default=[])
+    relay_args.add_argument('--ttl', metavar='n', type=int
+        , help='Time to live (hops) of multicast packets.'
+        , default=1)
+    relay_args.add_argument('--receive-buffer', metavar='b', type=int
+        , help='Size of the kernel receive buffer in bytes, absorbing bursts of frames.'
+        , default=DEFAULT_RECEIVE_BUFFER_SIZE)
+    relay_args.add_argument('--duration', metavar='s', type=float
+        , help='Seconds to relay, until interrupted by default.'
+        , default=None)
+    relay_args.add_argument('--output', metavar='o', type=str
+        , help='Path to record the relayed frames to as well.'
+        , default=None)
+    relay_args.add_argument('--split'
+        , action='store_true'
+        , help='Record every subject (and device) into a track file of its own, next to --output. (false by default)'
+        , default=False)
+    relay_args.add_argument('--reorder-window', metavar='n', type=int
+        , help='Frames to hold back at most when recording, restoring the order of late packets.'
+        , default=DEFAULT_REORDER_WINDOW)
+    relay_args.add_argument('--filter', metavar='name:key=value,...', type=str, action='append'
+        , help='Filter applied to the blendshapes of forwarded frames, may be given several times to chain filters.'
+            f' One of {", ".join(FILTERS)}, optionally limited to channels=Name+Name.'
+        , default=[])
+
+    # Setup ctl command and options.
+    control_args = subparsers.add_parser('ctl')
+    control_args.add_argument('control_command', metavar='command', type=str
+        , help='Command to send (load, unload, play, pause, seek, rate, stop, record, stats, shutdown).')
+    control_args.add_argument('arguments', metavar='key=value', type=str, nargs='*'
+        , help='Arguments of the command, values are parsed as JSON if possible.')
+    control_args.add_argument('--socket', metavar='path', type=str
+        , help='Unix socket of the daemon. (replaces --control-port)'
+        , default=None)
+    control_args.add_argument('--control-port', metavar='p', type=int
+        , help='Loopback port of the daemon.'
+        , default=DEFAULT_CONTROL_PORT)
+
+    # Setup play-many command and options.
+    play_many_args = subparsers.add_parser('play-many')
+    play_many_args.add_argument('recordings', metavar='in_path', type=str, nargs='+'
+        , help='Paths to recording files, optionally renamed as path=subject_name.')
+    play_many_args.add_argument('--fps', metavar='f', type=float
+        , help='Playback speed for animation frames.'
+        , default=60)
+    play_many_args.add_argument('--host', metavar='h', type=str
+        , help='Target host to send data to.'
+        , default='localhost')
+    play_many_args.add_argument('--port', metavar='p', type=int
+        , help='Port to target.'
+        , default=11111)
+    play_many_args.add_argument('--target', metavar='host:port', type=str, action='append'
+        , help='Target to send data to, may be given several times. (replaces --host and --port)'
+        , default=[])
+    play_many_args.add_argument('--policy', type=str, choices=POLICIES
+        , help='Handling of late frames, either sent right away (catch-up) or skipped (drop).'
+        , default=POLICY_CATCH_UP)
+    play_many_args.add_argument('--timing', type=str, choices=TIMINGS
+        , help='Send frames at --fps (fixed) or at their recorded frame time (recorded).'
+        , default=TIMING_FIXED)
+    play_many_args.add_argument('--speed', metavar='x', type=float
+        , help='Playback speed multiplier.'
+        , default=1.0)
+    play_many_args.add_argument('--duration', metavar='s', type=float
+        , help='Seconds to play, until interrupted by default.'
+        , default=None)
 
     # Setup unpack command and options.
     unpack_args = subparsers.add_parser('unpack')
@@ -462,6 +822,9 @@ def create_arg_parser():
     unpack_args.add_argument('--rename', metavar='n', type=str
         , help='Rename subject name and anonymizes device id.'
         , default='')
+    unpack_args.add_argument('--jobs', metavar='j', type=int
+        , help='Worker processes decoding frames in parallel.'
+        , default=1)
 
     # Setup pack command and options.
     pack_args = subparsers.add_parser('pack')
@@ -472,6 +835,9 @@ def create_arg_parser():
     pack_args.add_argument('--rename', metavar='n', type=str
         , help='Rename subject name and anonymizes device id.'
         , default='')
+    pack_args.add_argument('--jobs', metavar='j', type=int
+        , help='Worker processes encoding frames in parallel.'
+        , default=1)
 
     # Setup pack command and options.
     migrate_args = subparsers.add_parser('migrate')
@@ -482,6 +848,31 @@ def create_arg_parser():
     migrate_args.add_argument('--rename', metavar='n', type=str
         , help='Rename subject name and anonymizes device id.'
         , default='')
+    migrate_args.add_argument('--jobs', metavar='j', type=int
+        , help='Worker processes encoding frames in parallel.'
+        , default=1)
+
+    # Setup convert command and options.
+    convert_args = subparsers.add_parser('convert')
+    convert_args.add_argument('recording_path', metavar='in_file', type=str
+        , help='Path to a recording or clearfile.')
+    convert_args.add_argument('output_path', metavar='out_file', type=str
+        , help='Path where converted recording is stored.')
+    convert_args.add_argument('--columnar'
+        , action='store_true'
+        , help='Store blocks column wise and delta encoded, lossless. (requires numpy)'
+        , default=False)
+    convert_args.add_argument('--quantize'
+        , action='store_true'
+        , help='Store blocks column wise with blendshapes quantized to 16 bit. (requires numpy)'
+        , default=False)
+    convert_args.add_argument('--mmap'
+        , action='store_true'
+        , help='Store blocks uncompressed, to be memory mapped for playback.'
+        , default=False)
+    convert_args.add_argument('--jobs', metavar='j', type=int
+        , help='Worker processes decoding blocks in parallel.'
+        , default=1)
 
     debug_args = subparsers.add_parser('sequence')
     debug_args.add_argument('output_path', metavar='out_file', type=str
@@ -532,17 +923,45 @@ def main():
         sys.exit(0)
 
     if 'play' == args.command:
-        frames_read, frames_total = playback(args.host, args.port, args.recording_path, args.fps)
+        frames_read, frames_total = playback(args.host, args.port, args.recording_path, args.fps,
+            start_frame=args.start_frame, policy=args.policy, timing=args.timing, speed=args.speed,
+            start=args.start, end=args.end, buffer_depth=args.buffer, cache=args.cache,
+            targets=[parse_target(target, args.port) for target in args.target + args.multicast],
+            multicast_ttl=args.ttl, resample=args.resample, interpolation=args.interpolation,
+            filters=Filterkette(args.filter) if args.filter else None)
         print(f'Stopped at frame {frames_read}/{frames_total}')
+    elif 'play-many' == args.command:
+        targets = [parse_target(target, args.port) for target in args.target] or [(args.host, args.port)]
+        play_many(args.recordings, targets, args.fps, policy=args.policy, timing=args.timing, speed=args.speed,
+            duration=args.duration)
+    elif 'serve' == args.command:
+        targets = [parse_target(target, args.port) for target in args.target] or [(args.host, args.port)]
+        serve(targets, args.fps, args.policy, args.socket, args.control_port)
+    elif 'relay' == args.command:
+        relay(args.host, args.port, [parse_target(target) for target in args.target + args.multicast], args.ttl,
+            args.output, args.receive_buffer, args.verbose, args.split, args.duration, args.reorder_window,
+            Filterkette(args.filter) if args.filter else None)
+    elif 'ctl' == args.command:
+        response = control(args.control_command, args.arguments, args.socket, args.control_port)
+        if not response['ok']:
+            sys.exit(1)
     elif 'record' == args.command:
-        frames_read, frames_requested, filepath = record(args.host, args.port, args.frames, args.output, args.with_raw)
-        print(f'Stopped at frame {frames_read}/{frames_requested}, written file to {filepath}')
+        frames_read, frames_requested, filepath = record(args.host, args.port, args.frames, args.output, args.with_raw,
+            args.receive_buffer, args.verbose, args.split, args.tracks, args.duration, args.segment_frames,
+            args.segment_minutes * 60 if args.segment_minutes else None, args.reorder_window,
+            Filterkette(args.filter) if args.filter else None)
+        print(f'Stopped at frame {frames_read}/{frames_requested}'
+            + (f', written tracks next to {filepath}' if args.split else f', written file to {filepath}'))
     elif 'unpack' == args.command:
-        unpack(args.recording_path, args.output_path, args.retain, args.rename)
+        unpack(args.recording_path, args.output_path, args.retain, args.rename, args.jobs)
     elif 'pack' == args.command:
-        pack(args.clearfile_path, args.output_path, args.rename)
+        pack(args.clearfile_path, args.output_path, args.rename, args.jobs)
     elif 'migrate' == args.command:
-        migrate(args.legacy_file, args.output_path, args.rename)
+        migrate(args.legacy_file, args.output_path, args.rename, args.jobs)
+    elif 'convert' == args.command:
+        codec = CODEC_STORED if args.mmap else CODEC_COLUMNAR_QUANTIZED if args.quantize \
+            else CODEC_COLUMNAR if args.columnar else CODEC_ZLIB
+        convert(args.recording_path, args.output_path, codec, args.jobs)
     elif 'sequence' == args.command:
         fps = 60
         sequence(args.output_path, args.time_per_shape, fps, args.single_shape, args.min, args.max)
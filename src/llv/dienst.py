@@ -0,0 +1,496 @@
+"""
+    Long-running daemon, playing and recording sessions on command.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import time
+import json
+import queue
+import socket
+import asyncio
+import threading
+from array import array
+from .gesicht import FaceFrameView
+from .aufnahme import RecordingWriter
+from .buchse import parse_target
+from .chor import Stimme, load_packets
+from .takt import FrameClock, POLICY_CATCH_UP, TIMING_FIXED, percentiles_us
+
+
+DEFAULT_CONTROL_PORT = 11112
+
+
+class Wiedergabe:
+    """
+    Playback session of the daemon. Runs a Stimme as task on the event loop,
+    which can be paused, moved to another frame or sped up while running.
+    Every command wakes the task, so frames due under the new state are
+    sent right away. The time from receiving a command to sending the
+    first frame under it is kept as effect latency.
+    """
+
+    def __init__(self, name, stimme, targets):
+        self.name = name
+        self.stimme = stimme
+        self.targets = targets
+        self.paused = False
+        self.task = None
+        self._wake = asyncio.Event()
+        self._command_ns = None
+        self._effect_latency_ns = array('q')
+
+
+    async def start(self):
+        await self.stimme.connect(self.targets)
+        self.stimme.clock.start()
+        self.stimme.clock.rebase(self.stimme.offset_ns())
+        self._run_task()
+
+
+    def _run_task(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.stimme.close()
+
+
+    @property
+    def done(self):
+        return self.task is not None and self.task.done()
+
+
+    def pause(self):
+        self.paused = True
+        self._wake.set()
+
+
+    def play(self, received_ns):
+        if self.paused:
+            self.paused = False
+            self.stimme.clock.rebase(self.stimme.offset_ns() or 0)
+            self._applied(received_ns)
+
+
+    def seek(self, tick, received_ns):
+        self.stimme.tick = tick
+        self.stimme.clock.rebase(self.stimme.offset_ns())
+        self._applied(received_ns)
+
+
+    def rate(self, speed, received_ns):
+        offset = self.stimme.offset_ns()
+        self.stimme.clock.rebase(offset if offset is not None else 0, speed)
+        self._applied(received_ns)
+
+
+    def _applied(self, received_ns):
+        if not self.paused:
+            self._command_ns = received_ns
+            # Sessions played to the end run again once moved.
+            self._run_task()
+        self._wake.set()
+
+
+    async def _sleep(self, timeout):
+        """
+        Sleeps up to timeout seconds. Returns True if woken by a command.
+        """
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._wake.clear()
+        return True
+
+
+    async def _run(self):
+        stimme = self.stimme
+        while True:
+            if self.paused:
+                await self._sleep(None)
+                continue
+            deadline = stimme.deadline_ns()
+            if deadline is None:
+                return
+            # Coarse sleep on the loop, the clock spins the remainder.
+            remaining = deadline - time.monotonic_ns()
+            if FrameClock.SPIN_NS < remaining:
+                await self._sleep((remaining - FrameClock.SPIN_NS) / 1e9)
+                continue
+            if self._wake.is_set():
+                self._wake.clear()
+                continue
+
+            stimme.send_next()
+            if self._command_ns is not None:
+                self._effect_latency_ns.append(time.monotonic_ns() - self._command_ns)
+                self._command_ns = None
+
+
+    def stats(self):
+        stats = self.stimme.stats()
+        stats['session'] = self.name
+        stats['kind'] = 'play'
+        stats['state'] = 'done' if self.done else 'paused' if self.paused else 'playing'
+        stats['frame'] = self.stimme.tick % self.stimme.frame_count
+        stats['frame_count'] = self.stimme.frame_count
+        stats['speed'] = float(self.stimme.clock.speed)
+        stats['targets'] = [f'{host}:{port}' for host, port in self.targets]
+        stats['effect_latency_us'] = percentiles_us(self._effect_latency_ns)
+        return stats
+
+
+class _MitschnittProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, mitschnitt):
+        self.mitschnitt = mitschnitt
+
+
+    def datagram_received(self, data, addr):
+        self.mitschnitt.receive(data)
+
+
+class Mitschnitt:
+    """
+    Record session of the daemon. Frames are received on the event loop and
+    handed to a writer thread, so compressing blocks never stalls playback.
+    """
+
+    def __init__(self, name, output, frames = None):
+        self.name = name
+        self.output = output
+        self.frames = frames
+        self.frames_received = 0
+        self.frames_invalid = 0
+        self.last_error = None
+        self.transport = None
+        self._packets = queue.SimpleQueue()
+        self._writer = None
+
+
+    async def start(self, host, port):
+        try:
+            self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _MitschnittProtocol(self), local_addr = (host or '0.0.0.0', port))
+        except OSError as e:
+            raise Exception(f'Could not listen on {host or "0.0.0.0"}:{port}. ({e})')
+        try:
+            recording = RecordingWriter(self.output)
+        except Exception:
+            self.transport.close()
+            self.transport = None
+            raise
+        self._writer = threading.Thread(target = self._write, args = (recording,), name = f'llv-record-{self.name}',
+            daemon = True)
+        self._writer.start()
+
+
+    async def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self._writer is not None:
+            self._packets.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+            self._writer = None
+
+
+    @property
+    def done(self):
+        return self.transport is None or (self.frames is not None and self.frames <= self.frames_received)
+
+
+    def receive(self, data):
+        if self.done:
+            return
+        try:
+            frame = FaceFrameView(data, len(data))
+        except Exception as e:
+            self.frames_invalid += 1
+            self.last_error = str(e)
+            return
+        self._packets.put(frame.data)
+        self.frames_received += 1
+
+
+    def _write(self, recording):
+        try:
+            with recording:
+                while True:
+                    packet = self._packets.get()
+                    if packet is None:
+                        return
+                    recording.write(packet)
+        except Exception as e:
+            self.last_error = str(e)
+
+
+    def stats(self):
+        return {
+            'session': self.name,
+            'kind': 'record',
+            'state': 'done' if self.done else 'recording',
+            'output': self.output,
+            'frames_received': self.frames_received,
+            'frames_requested': self.frames,
+            'frames_invalid': self.frames_invalid,
+            'last_error': self.last_error,
+        }
+
+
+class Dienst:
+    """
+    Keeps recordings cached and runs playback and record sessions
+    concurrently on one event loop. Commands are JSON objects, one per line,
+    received on a Unix socket or a loopback TCP port. Every command is
+    answered by one JSON line, holding ok and either the result or error.
+    """
+
+    def __init__(self, targets, fps = 60, policy = POLICY_CATCH_UP):
+        self.targets = targets
+        self.fps = fps
+        self.policy = policy
+        self.recordings = {}
+        self.sessions = {}
+        self._stopped = None
+        self._clients = {}
+        self._commands = {
+            'load': self._load,
+            'unload': self._unload,
+            'play': self._play,
+            'pause': self._pause,
+            'seek': self._seek,
+            'rate': self._rate,
+            'stop': self._stop,
+            'record': self._record,
+            'stats': self._stats,
+            'shutdown': self._shutdown,
+        }
+
+
+    async def serve(self, socket_path = None, host = '127.0.0.1', port = DEFAULT_CONTROL_PORT):
+        """
+        Serves commands until shut down.
+        """
+        self._stopped = asyncio.Event()
+        if socket_path:
+            server = await asyncio.start_unix_server(self._client, path = socket_path)
+        else:
+            server = await asyncio.start_server(self._client, host, port)
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            # Hang up on connected clients, their handlers end on the EOF.
+            for writer in self._clients.values():
+                writer.close()
+            await asyncio.gather(*self._clients, return_exceptions = True)
+            await server.wait_closed()
+            for session in list(self.sessions.values()):
+                await session.stop()
+            self.sessions = {}
+
+
+    async def _client(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(json.dumps(await self.handle(line, time.monotonic_ns())).encode('utf8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self._clients[task]
+            writer.close()
+
+
+    async def handle(self, line, received_ns):
+        """
+        Runs one command line and returns its response.
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise Exception('Commands are JSON objects!')
+            command = self._commands.get(request.get('command'))
+            if command is None:
+                raise Exception(f'Unknown command {request.get("command")}! Use one of {", ".join(self._commands)}.')
+            result = await command(request, received_ns)
+        except KeyError as e:
+            return {'ok': False, 'error': f'Command {request.get("command")} needs {e}!'}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+        response = {'ok': True}
+        response.update(result or {})
+        return response
+
+
+    async def _packets(self, recording, subject_name = None):
+        """
+        Loads a recording on a worker thread, so running sessions go on
+        meanwhile. The load is cached as future, commands arriving while
+        it runs wait for the same load. Failed loads are not cached.
+        """
+        key = (recording, subject_name)
+        packets = self.recordings.get(key)
+        if packets is None:
+            packets = self.recordings[key] = asyncio.get_running_loop().run_in_executor(None, load_packets,
+                recording, subject_name, 'DEADC0DE-1337-1337-1337-CAFEBABE' if subject_name else None)
+        try:
+            return await asyncio.shield(packets)
+        except Exception:
+            if self.recordings.get(key) is packets:
+                del self.recordings[key]
+            raise
+
+
+    def _session(self, request, kind = None):
+        name = request.get('session', 'default')
+        session = self.sessions.get(name)
+        if session is None:
+            raise Exception(f'No session {name}!')
+        if kind is not None and not isinstance(session, kind):
+            raise Exception(f'Session {name} does not support {request["command"]}!')
+        return session
+
+
+    async def _load(self, request, received_ns):
+        name, _, offsets, _ = await self._packets(request['recording'], request.get('subject'))
+        return {'recording': request['recording'], 'subject': name, 'frame_count': len(offsets) - 1}
+
+
+    async def _unload(self, request, received_ns):
+        self.recordings.pop((request['recording'], request.get('subject')), None)
+        return {}
+
+
+    async def _play(self, request, received_ns):
+        """
+        Resumes a paused session, or starts a new one on a recording.
+        """
+        name = request.get('session', 'default')
+        session = self.sessions.get(name)
+        if session is not None and not session.done and 'recording' not in request:
+            if not isinstance(session, Wiedergabe):
+                raise Exception(f'Session {name} does not support play!')
+            session.play(received_ns)
+            return {'session': name}
+        if 'recording' not in request:
+            raise Exception(f'No session {name}, play needs a recording!')
+
+        subject_name = request.get('subject')
+        packets = await self._packets(request['recording'], subject_name)
+        session = self.sessions.pop(name, None)
+        if session is not None:
+            await session.stop()
+        stimme = Stimme(request['recording'], subject_name, None, request.get('fps', self.fps),
+            request.get('policy', self.policy), request.get('timing', TIMING_FIXED), request.get('speed', 1.0),
+            request.get('loop', True), packets)
+        if 'frame' in request:
+            stimme.tick = min(stimme.frame_count - 1, max(0, int(request['frame'])))
+        targets = [parse_target(target) for target in request['targets']] if 'targets' in request else self.targets
+        session = self.sessions[name] = Wiedergabe(name, stimme, targets)
+        await session.start()
+        return {'session': name, 'frame_count': stimme.frame_count}
+
+
+    async def _pause(self, request, received_ns):
+        self._session(request, Wiedergabe).pause()
+        return {}
+
+
+    async def _seek(self, request, received_ns):
+        """
+        Moves a session to a frame index, or to seconds into the recording.
+        """
+        session = self._session(request, Wiedergabe)
+        stimme = session.stimme
+        if 'frame' in request:
+            tick = int(request['frame'])
+        elif 'seconds' in request:
+            tick = stimme.tick_at(int(float(request['seconds']) * 1_000_000_000))
+        else:
+            raise Exception('Seek needs a frame or seconds!')
+        session.seek(min(stimme.frame_count - 1, max(0, tick)), received_ns)
+        return {'frame': stimme.tick}
+
+
+    async def _rate(self, request, received_ns):
+        self._session(request, Wiedergabe).rate(float(request['speed']), received_ns)
+        return {}
+
+
+    async def _stop(self, request, received_ns):
+        session = self._session(request)
+        await session.stop()
+        del self.sessions[session.name]
+        return session.stats()
+
+
+    async def _record(self, request, received_ns):
+        name = request.get('session', 'default')
+        if name in self.sessions:
+            raise Exception(f'Session {name} exists already!')
+        output = request.get('output', f'./recording-{time.strftime("%Y-%m-%d-%H-%M-%S")}.gesichter')
+        session = Mitschnitt(name, output, request.get('frames'))
+        await session.start(request.get('host', ''), request.get('port', 11111))
+        self.sessions[name] = session
+        return {'session': name, 'output': output}
+
+
+    async def _stats(self, request, received_ns):
+        if 'session' in request:
+            return self._session(request).stats()
+        return {
+            'recordings': [{'recording': recording, 'subject': subject_name, 'frame_count': len(packets.result()[2]) - 1}
+                for (recording, subject_name), packets in self.recordings.items()
+                if packets.done() and not packets.cancelled() and packets.exception() is None],
+            'sessions': [session.stats() for session in self.sessions.values()],
+        }
+
+
+    async def _shutdown(self, request, received_ns):
+        self._stopped.set()
+        return {}
+
+
+def send_command(request, socket_path = None, host = '127.0.0.1', port = DEFAULT_CONTROL_PORT, timeout = 10):
+    """
+    Sends one command to a running daemon. Returns its response and the
+    round trip time in seconds.
+    """
+    if socket_path:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = socket_path
+    else:
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (host, port)
+    with connection:
+        connection.settimeout(timeout)
+        try:
+            connection.connect(address)
+        except OSError as e:
+            raise Exception(f'Could not connect to daemon at {address}. ({e})')
+        sent = time.perf_counter()
+        connection.sendall(json.dumps(request).encode('utf8') + b'\n')
+        response = connection.makefile('rb').readline()
+        round_trip = time.perf_counter() - sent
+    if not response:
+        raise Exception('Daemon closed the connection without response!')
+    return json.loads(response), round_trip
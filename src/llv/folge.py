@@ -0,0 +1,225 @@
+"""
+    Sequence tracking of incoming frames: gaps, duplicates and reordering.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+
+# Frames held back to restore the order of late packets, at most.
+DEFAULT_REORDER_WINDOW = 8
+# Frame numbers behind the highest one seen, remembered for telling
+# duplicates from late packets. Anything further back starts a new sequence.
+SEEN_FRAMES = 64
+# Forward jumps of more frames start a new sequence instead of counting as
+# loss, like a phone changing its timecode source.
+DEFAULT_MAX_GAP = 3600
+# Gaps listed in a report, at most.
+MAX_REPORTED_GAPS = 1000
+# Frame numbers are signed 32 bit and wrap around.
+_FRAME_NUMBER_RANGE = 1 << 32
+_FRAME_NUMBER_MIN = -(1 << 31)
+
+
+def _wrap(frame_number):
+    """
+    Returns frame_number wrapped into the signed 32 bit range.
+    """
+    return (frame_number - _FRAME_NUMBER_MIN) % _FRAME_NUMBER_RANGE + _FRAME_NUMBER_MIN
+
+
+class Folge:
+    """
+    Tracks the frame numbers of one subject. Frames are handed to write in
+    order of their frame number: in order frames right away, frames after a
+    gap are held until the missing ones arrive or the window of held frames
+    is full, at which point the missing frames are given up as lost. Frames
+    arriving after that are counted late and dropped, repeated frames are
+    counted as duplicates and dropped. Duplicates are told apart using a
+    bitmask of the frames seen, so every packet takes constant work.
+
+    A jump backwards beyond the seen frames, or forward by more than max_gap
+    frames, is taken as the start of a new sequence (a restarted capture or
+    timecode) and counted as restart, once the next frame follows it.
+
+    Frame numbers wrapping around at 32 bit continue the sequence. They are
+    tracked unwrapped, relative to the frame received before, and reported
+    as received.
+    """
+
+    def __init__(self, write, window = DEFAULT_REORDER_WINDOW, max_gap = DEFAULT_MAX_GAP, subject_name = None,
+        device_id = None):
+        if not (0 <= window < SEEN_FRAMES):
+            raise Exception(f'Reorder window has to be between 0 and {SEEN_FRAMES - 1} frames! ({window})')
+        self.write = write
+        self.subject_name = subject_name
+        self.device_id = device_id
+        self.window = window
+        self.max_gap = max_gap
+
+        self.received = 0
+        self.written = 0
+        self.reordered = 0
+        self.late = 0
+        self.duplicates = 0
+        self.lost = 0
+        self.restarts = 0
+        self.max_held = 0
+        self.gaps = []
+        self.gap_count = 0
+
+        self.first = None
+        self.last = None
+        self._next = None
+        self._highest = None
+        self._seen = 0
+        self._held = {}
+        self._jumped = None
+        self._received_last = None
+
+
+    def push(self, frame_number, packet):
+        """
+        Takes the next received packet of the subject. Held packets are
+        copied, packet may be reused once push returns.
+        """
+        self.received += 1
+        if self._received_last is not None:
+            frame_number = self._received_last + _wrap(frame_number - self._received_last)
+        self._received_last = frame_number
+        self._push(frame_number, packet)
+
+
+    def _push(self, frame_number, packet):
+        if self._highest is None:
+            self._begin(frame_number, packet)
+            return
+
+        delta = frame_number - self._highest
+        if 0 < delta <= self.max_gap:
+            self._seen = ((self._seen << delta) | 1) & ((1 << SEEN_FRAMES) - 1)
+            self._highest = frame_number
+        elif -SEEN_FRAMES < delta <= 0:
+            seen = 1 << -delta
+            if self._seen & seen:
+                self.duplicates += 1
+                return
+            self._seen |= seen
+            if frame_number < self._next:
+                self.late += 1
+                return
+            self.reordered += 1
+        else:
+            self._jump(frame_number, packet)
+            return
+        if self._jumped is not None:
+            self._jumped = None
+            self.late += 1
+
+        if frame_number == self._next:
+            self._write(packet)
+            if self._held:
+                self._release()
+        else:
+            self._held[frame_number] = bytes(packet)
+            self.max_held = max(self.max_held, len(self._held))
+        if self._held and self.window <= self._highest - self._next:
+            self._give_up(self._highest - self.window + 1)
+
+
+    def flush(self):
+        """
+        Writes all held frames, giving up on the frames still missing.
+        """
+        if self._jumped is not None:
+            self._jumped = None
+            self.late += 1
+        if self._held:
+            self._give_up(self._highest + 1)
+
+
+    def _begin(self, frame_number, packet):
+        self._next = frame_number
+        self._highest = frame_number
+        self._seen = 1
+        if self.first is None:
+            self.first = frame_number
+        self._write(packet)
+
+
+    def _jump(self, frame_number, packet):
+        """
+        Starts a new sequence once the frame after a jump follows it, a
+        single stray packet is counted late instead.
+        """
+        if self._jumped is None or frame_number != self._jumped[0] + 1:
+            if self._jumped is not None:
+                self.late += 1
+            self._jumped = (frame_number, bytes(packet))
+            return
+        jumped_frame_number, jumped_packet = self._jumped
+        self._jumped = None
+        self.flush()
+        self.restarts += 1
+        self._begin(jumped_frame_number, jumped_packet)
+        self._push(frame_number, packet)
+
+
+    def _write(self, packet):
+        self.write(packet)
+        self.written += 1
+        self.last = self._next
+        self._next += 1
+
+
+    def _release(self):
+        while self._next in self._held:
+            self._write(self._held.pop(self._next))
+
+
+    def _give_up(self, until):
+        """
+        Skips missing frames up to until, writing the held frames in between.
+        """
+        for frame_number in sorted(frame_number for frame_number in self._held if frame_number < until):
+            self._lose(frame_number)
+            self._write(self._held.pop(frame_number))
+        self._lose(until)
+        self._release()
+
+
+    def _lose(self, until):
+        if self._next < until:
+            missing = until - self._next
+            self.lost += missing
+            self.gap_count += 1
+            if len(self.gaps) < MAX_REPORTED_GAPS:
+                self.gaps.append([_wrap(self._next), missing])
+            self._next = until
+
+
+    def stats(self):
+        """
+        Returns counts of received, written, reordered, late, duplicate and
+        lost frames, along with the gaps as [first missing frame, count].
+        """
+        expected = self.written + self.lost
+        return {
+            'subject_name': self.subject_name,
+            'device_id': self.device_id,
+            'first_frame': _wrap(self.first) if self.first is not None else None,
+            'last_frame': _wrap(self.last) if self.last is not None else None,
+            'received': self.received,
+            'written': self.written,
+            'reordered': self.reordered,
+            'late': self.late,
+            'duplicates': self.duplicates,
+            'lost': self.lost,
+            'loss': self.lost / expected if 0 < expected else 0.0,
+            'restarts': self.restarts,
+            'max_held': self.max_held,
+            'gap_count': self.gap_count,
+            'gaps': list(self.gaps),
+        }
@@ -8,9 +8,17 @@
     https://think-biq.com
 """
 
+import sys
 import struct
 import json
 import base64
+from array import array
+from collections.abc import MutableMapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def remap(x, in_min, in_max, out_min, out_max):
@@ -21,6 +29,111 @@ def fract(x):
     return x - float(xi)
 
 
+# Precompiled codecs for the fixed parts of a frame packet.
+_SIZE = struct.Struct('>L')
+_VERSION_AND_LENGTH = struct.Struct('>Bl')
+_LENGTH = struct.Struct('>l')
+_FRAMETIME_AND_COUNT = struct.Struct('>lfllB')
+_FLOAT = struct.Struct('>f')
+_FLOAT_SIZE = _FLOAT.size
+
+# Packets are big endian, array('f') uses native byte order.
+_NATIVE_IS_LITTLE_ENDIAN = 'little' == sys.byteorder
+
+_packet_structs = {}
+
+
+def _packet_struct(device_id_length, subject_name_length, count, with_size):
+    key = (device_id_length, subject_name_length, count, with_size)
+    codec = _packet_structs.get(key)
+    if codec is None:
+        size_prefix = 'L' if with_size else ''
+        codec = _packet_structs[key] = struct.Struct(
+            f'>{size_prefix}Bl{device_id_length}sl{subject_name_length}slfllB{count}f')
+    return codec
+
+
+def decode_header(data, size):
+    """
+    Decodes everything but the blendshape values of a raw frame packet with a
+    handful of unpack_from calls over the packet buffer (bytes or memoryview).
+    Returns a tuple of version, device id, subject name, frame number, sub
+    frame, numerator, denominator, blendshape count and the offset of the
+    blendshape values.
+    """
+    version, device_id_length = _VERSION_AND_LENGTH.unpack_from(data, 0)
+    position = _VERSION_AND_LENGTH.size
+    if not (0 <= device_id_length <= size - position):
+        raise Exception(f"Read invalid string length! (str_l:{device_id_length}, bytes_left:{size - position})")
+    device_id = sys.intern(str(data[position:position + device_id_length], 'utf8'))
+    position += device_id_length
+
+    subject_name_length, = _LENGTH.unpack_from(data, position)
+    position += _LENGTH.size
+    if not (0 <= subject_name_length <= size - position):
+        raise Exception(f"Read invalid string length! (str_l:{subject_name_length}, bytes_left:{size - position})")
+    subject_name = sys.intern(str(data[position:position + subject_name_length], 'utf8'))
+    position += subject_name_length
+
+    frame_number, sub_frame, numerator, denominator, count = _FRAMETIME_AND_COUNT.unpack_from(data, position)
+    position += _FRAMETIME_AND_COUNT.size
+    if FaceFrame.FACE_BLENDSHAPE_COUNT < count:
+        raise Exception(f"Read invalid blendshape count! ({count} > {FaceFrame.FACE_BLENDSHAPE_COUNT})")
+    if position + count * _FLOAT_SIZE > size:
+        raise Exception(f"Trying to access beyond package size! data_end:{position + count * _FLOAT_SIZE}, size:{size}")
+
+    return version, device_id, subject_name, frame_number, sub_frame, numerator, denominator, count, position
+
+
+def _pack_packet_into(codec, buffer, offset, version, device_id_bytes, subject_name_bytes,
+    frame_number, sub_frame, numerator, denominator, values, with_size):
+    size_prefix = (codec.size - _SIZE.size,) if with_size else ()
+    codec.pack_into(buffer, offset, *size_prefix,
+        version, len(device_id_bytes), device_id_bytes, len(subject_name_bytes), subject_name_bytes,
+        frame_number, sub_frame, numerator, denominator,
+        len(values), *values)
+    return codec.size
+
+
+class BlendshapeView(MutableMapping):
+    """
+    Dict-like view onto the blendshape values of a FaceFrame, keyed by the
+    names in FaceFrame.FACE_BLENDSHAPE_NAMES.
+    """
+    __slots__ = ('_frame',)
+
+    def __init__(self, frame):
+        self._frame = frame
+
+    def __getitem__(self, name):
+        index = _BLENDSHAPE_INDICES[name]
+        if self._frame.blendshape_count <= index:
+            raise KeyError(name)
+        return self._frame._blendshape_values[index]
+
+    def __setitem__(self, name, value):
+        index = _BLENDSHAPE_INDICES[name]
+        self._frame._blendshape_values[index] = value
+        if self._frame.blendshape_count <= index:
+            self._frame.blendshape_count = index + 1
+
+    def __delitem__(self, name):
+        raise TypeError('Blendshapes of a frame can not be removed!')
+
+    def __iter__(self):
+        return iter(FaceFrame.FACE_BLENDSHAPE_NAMES[:self._frame.blendshape_count])
+
+    def __len__(self):
+        return self._frame.blendshape_count
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        count = self._frame.blendshape_count
+        return dict(zip(FaceFrame.FACE_BLENDSHAPE_NAMES[:count], self._frame._blendshape_values[:count].tolist()))
+
+
 class FaceFrame:
     """
     Represents a ARKit face frame.
@@ -100,18 +213,23 @@ class FaceFrame:
     FACE_BLENDSHAPE_COUNT = len(FACE_BLENDSHAPE_NAMES)
 
 
+    __slots__ = ('version', 'device_id', 'subject_name',
+        'frame_number', 'sub_frame', 'numerator', 'denominator',
+        'blendshape_count', '_blendshape_values')
+
+
     @staticmethod
     def from_default(frame_number = 0, fps = 60):
         frame = FaceFrame()
 
-        sub_frame = frame_number * 0.000614 + 0.121
-        frame.frame_time = {"frame_number":1337 + frame_number, "sub_frame":sub_frame, "numerator":60, "denominator":1}
-      
-        for name in FaceFrame.FACE_BLENDSHAPE_NAMES:
-            frame.blendshapes[name] = 0.0
-        frame.blendshape_count = len(frame.blendshapes)
+        frame.frame_number = 1337 + frame_number
+        frame.sub_frame = frame_number * 0.000614 + 0.121
+        frame.numerator = 60
+        frame.denominator = 1
+
+        frame.blendshape_count = FaceFrame.FACE_BLENDSHAPE_COUNT
 
-        frame._serialize()
+        frame._check_size()
 
         return frame
 
@@ -125,100 +243,133 @@ class FaceFrame:
         frame.subject_name = frame_json['subject_name']
         frame.frame_time = frame_json['frame_time']
 
-        frame.blendshape_count = frame_json['blendshape_count']
         frame.blendshapes = frame_json['blendshapes']
+        frame.blendshape_count = frame_json['blendshape_count']
 
-        frame._serialize()
+        frame._check_size()
 
         return frame
 
 
     @staticmethod
     def from_raw(data, data_size):
-
-        frame = FaceFrame()
-        frame.data = data
-        frame.size = data_size
-        frame.current_position = 0
-
-        frame._deserialize()
+        if FaceFrame.PACKET_MIN_SIZE > data_size:
+            raise Exception(f"Trying to read frame (size: {data_size}) smaller than min size of {FaceFrame.PACKET_MIN_SIZE} bytes!")
+        if FaceFrame.PACKET_MAX_SIZE < data_size:
+            raise Exception(f"Trying to read frame (size: {data_size}) bigger than max size of {FaceFrame.PACKET_MAX_SIZE} bytes!")
+
+        frame = FaceFrame.__new__(FaceFrame)
+        frame.version, frame.device_id, frame.subject_name, \
+            frame.frame_number, frame.sub_frame, frame.numerator, frame.denominator, \
+            frame.blendshape_count, position = decode_header(data, data_size)
+
+        packet_size = position + frame.blendshape_count * _FLOAT_SIZE
+        values = array('f')
+        values.frombytes(data[position:packet_size])
+        if _NATIVE_IS_LITTLE_ENDIAN:
+            values.byteswap()
+        if frame.blendshape_count < FaceFrame.FACE_BLENDSHAPE_COUNT:
+            values.extend(_ZERO_BLENDSHAPES[frame.blendshape_count:])
+        frame._blendshape_values = values
+
+        unused_padding = data_size - packet_size
+        if 0 != unused_padding:
+            print(f'Left over data after serialization! {packet_size}/{data_size} => ({bytes(data[packet_size:data_size])})')
 
         return frame
 
 
     def __init__(self):
-        self.data = b''
-        self.size = 0
-        self.current_position = 0
-
         self.version = FaceFrame.VERSION
         self.device_id = 'DEADC0DE-1337-1337-1337-CAFEBABE'
         self.subject_name = 'LLV Default Device'
-        self.frame_time = {"frame_number":0, "sub_frame":0, "numerator":0, "denominator":0}
+
+        self.frame_number = 0
+        self.sub_frame = 0
+        self.numerator = 0
+        self.denominator = 0
 
         self.blendshape_count = 0
-        self.blendshapes = {}
+        self._blendshape_values = array('f', _ZERO_BLENDSHAPES)
 
 
-    def _check_size(self):
-        if FaceFrame.PACKET_MIN_SIZE > self.size:
-            raise Exception(f"Trying to read frame (size: {self.size}) smaller than min size of {FaceFrame.PACKET_MIN_SIZE} bytes!")
-        if FaceFrame.PACKET_MAX_SIZE < self.size:
-            raise Exception(f"Trying to read frame (size: {self.size}) bigger than max size of {FaceFrame.PACKET_MAX_SIZE} bytes!")
+    @property
+    def frame_time(self):
+        return {"frame_number":self.frame_number, "sub_frame":self.sub_frame, "numerator":self.numerator, "denominator":self.denominator}
 
+    @frame_time.setter
+    def frame_time(self, value):
+        self.frame_number = value['frame_number']
+        self.sub_frame = value['sub_frame']
+        self.numerator = value['numerator']
+        self.denominator = value['denominator']
 
-    def _deserialize(self):
-        self._check_size()
 
-        self.current_position = 0
+    @property
+    def blendshapes(self):
+        return BlendshapeView(self)
 
-        self.version = self._read_uint8()
-        self.device_id = self._read_string()
-        self.subject_name = self._read_string()
-        self.frame_time = self._read_frametime()
+    @blendshapes.setter
+    def blendshapes(self, value):
+        self._blendshape_values = array('f', _ZERO_BLENDSHAPES)
+        self.blendshape_count = 0
+        view = BlendshapeView(self)
+        for name in value:
+            view[name] = value[name]
 
-        self.blendshape_count = self._read_uint8()
-        for blendshape_index in range(0, self.blendshape_count):
-            blendshape_name = FaceFrame.FACE_BLENDSHAPE_NAMES[blendshape_index]
-            self.blendshapes[blendshape_name] = self._read_float()
 
-        unused_padding = self.size - self.current_position
-        if 0 != unused_padding:
-            print(f'Left over data after serialization! {self.current_position}/{self.size} => ({self.data[self.current_position:]})')
-            self.data = self.data[:-unused_padding]
-            self.size = len(self.data)
+    @property
+    def blendshape_array(self):
+        """
+        The blendshape values as float32 array, indexed by the position of
+        each name in FACE_BLENDSHAPE_NAMES.
+        """
+        return self._blendshape_values
+
+
+    @property
+    def size(self):
+        return _packet_struct(len(self.device_id.encode('utf8')), len(self.subject_name.encode('utf8')),
+            self.blendshape_count, False).size
 
-        return self
 
+    @property
+    def data(self):
+        return bytes(self._serialize())
 
-    def _serialize(self):
-        self.data = b''
-        self.size = 0
-        self.current_position = 0
 
-        self._write_uint8(self.version)
-        self._write_string(self.device_id)
-        self._write_string(self.subject_name)
-        self._write_frametime(self.frame_time)
+    def _check_size(self, size = None):
+        size = self.size if size is None else size
+        if FaceFrame.PACKET_MIN_SIZE > size:
+            raise Exception(f"Trying to read frame (size: {size}) smaller than min size of {FaceFrame.PACKET_MIN_SIZE} bytes!")
+        if FaceFrame.PACKET_MAX_SIZE < size:
+            raise Exception(f"Trying to read frame (size: {size}) bigger than max size of {FaceFrame.PACKET_MAX_SIZE} bytes!")
 
+
+    def _serialize(self, with_size = False):
+        device_id_bytes = self.device_id.encode('utf8')
+        subject_name_bytes = self.subject_name.encode('utf8')
         count = self.blendshape_count
-        self._write_uint8(count)
-        for blendshape_name in self.blendshapes:
-            self._write_float(self.blendshapes[blendshape_name])
+        codec = _packet_struct(len(device_id_bytes), len(subject_name_bytes), count, with_size)
+        self._check_size(codec.size - (_SIZE.size if with_size else 0))
 
-        self.size = len(self.data)
+        values = self._blendshape_values
+        if count < FaceFrame.FACE_BLENDSHAPE_COUNT:
+            values = values[:count]
 
-        self._check_size()
+        buffer = bytearray(codec.size)
+        _pack_packet_into(codec, buffer, 0, self.version, device_id_bytes, subject_name_bytes,
+            self.frame_number, self.sub_frame, self.numerator, self.denominator, values, with_size)
 
+        return buffer
 
-    def encode(self):
-        self._serialize()
-        
-        frame_packet = b''
-        frame_packet += struct.pack('>L', self.size)
-        frame_packet += self.data
 
-        return frame_packet
+    def encode(self):
+        """
+        Serializes the frame and returns it as size prefixed packet, ready to
+        be written to a recording.
+        """
+        return self._serialize(with_size = True)
 
 
     def equals(self, other):
@@ -248,9 +399,10 @@ class FaceFrame:
         value += f', "frame_time":{json.dumps(self.frame_time)}'
         value += f', "blendshape_count":{json.dumps(self.blendshape_count)}'
         if with_shape_values:
-            value += f', "blendshapes": {json.dumps(self.blendshapes)}'
+            value += f', "blendshapes": {json.dumps(self.blendshapes.to_dict())}'
         if with_raw_frame:
-            value += f', "raw_frame": {{ "size": {self.size}, "data": {json.dumps(base64.b64encode(self.data).decode())} }}'
+            data = self.data
+            value += f', "raw_frame": {{ "size": {len(data)}, "data": {json.dumps(base64.b64encode(data).decode())} }}'
 
         value += '}'
 
@@ -261,113 +413,427 @@ class FaceFrame:
         return self.to_json()
 
 
-    def _read_raw_slice(self, data_size):
-        self._raise_if_invalid()
-        data_start = self.current_position
-        data_end = self.current_position + data_size
-        if not (data_end <= self.size):
-            raise Exception(f"Trying to access beyond package size! data_end:{data_end}, size:{self.size}")
-        data_slice = self.data[data_start:data_end]
-        self.current_position = data_end
-        return data_slice
+class FaceFrameView:
+    """
+    Lazy, read-only view onto a raw frame packet. Only the size bounds and
+    the packet layout are validated up front, fields are decoded on access.
+    The underlying memoryview can be handed to a socket or file without
+    copying the packet.
+    """
+    __slots__ = ('data', 'size', '_subject_name_offset', '_frametime_offset')
+
+
+    def __init__(self, data, data_size):
+        if FaceFrame.PACKET_MIN_SIZE > data_size:
+            raise Exception(f"Trying to read frame (size: {data_size}) smaller than min size of {FaceFrame.PACKET_MIN_SIZE} bytes!")
+        if FaceFrame.PACKET_MAX_SIZE < data_size:
+            raise Exception(f"Trying to read frame (size: {data_size}) bigger than max size of {FaceFrame.PACKET_MAX_SIZE} bytes!")
+
+        view = memoryview(data)
+
+        _, device_id_length = _VERSION_AND_LENGTH.unpack_from(view, 0)
+        position = _VERSION_AND_LENGTH.size
+        if not (0 <= device_id_length <= data_size - position - _LENGTH.size):
+            raise Exception(f"Read invalid string length! (str_l:{device_id_length}, bytes_left:{data_size - position})")
+        position += device_id_length
+        subject_name_offset = position
+
+        subject_name_length, = _LENGTH.unpack_from(view, position)
+        position += _LENGTH.size
+        if not (0 <= subject_name_length <= data_size - position - _FRAMETIME_AND_COUNT.size):
+            raise Exception(f"Read invalid string length! (str_l:{subject_name_length}, bytes_left:{data_size - position})")
+        position += subject_name_length
+        frametime_offset = position
+
+        count = view[position + _FRAMETIME_AND_COUNT.size - 1]
+        if FaceFrame.FACE_BLENDSHAPE_COUNT < count:
+            raise Exception(f"Read invalid blendshape count! ({count} > {FaceFrame.FACE_BLENDSHAPE_COUNT})")
+        packet_size = position + _FRAMETIME_AND_COUNT.size + count * _FLOAT_SIZE
+        if packet_size > data_size:
+            raise Exception(f"Trying to access beyond package size! data_end:{packet_size}, size:{data_size}")
+
+        # Drop any padding after the packet, like FaceFrame.from_raw does.
+        self.data = view[:packet_size]
+        self.size = packet_size
+        self._subject_name_offset = subject_name_offset
+        self._frametime_offset = frametime_offset
+
+
+    @property
+    def version(self):
+        return self.data[0]
+
+    @property
+    def device_id(self):
+        return str(self.data[_VERSION_AND_LENGTH.size:self._subject_name_offset], 'utf8')
+
+    @property
+    def subject_name(self):
+        return str(self.data[self._subject_name_offset + _LENGTH.size:self._frametime_offset], 'utf8')
+
+    @property
+    def frame_number(self):
+        return _LENGTH.unpack_from(self.data, self._frametime_offset)[0]
+
+    @property
+    def frame_time(self):
+        frame_number, sub_frame, numerator, denominator, _ = _FRAMETIME_AND_COUNT.unpack_from(self.data, self._frametime_offset)
+        return {"frame_number":frame_number, "sub_frame":sub_frame, "numerator":numerator, "denominator":denominator}
 
+    @property
+    def blendshape_count(self):
+        return self.data[self._frametime_offset + _FRAMETIME_AND_COUNT.size - 1]
 
-    def _write_raw_slice(self, data):
-        slice_size = len(data)
-        self.data += data
-        self.size += slice_size
-        return slice_size
+    @property
+    def header(self):
+        """
+        Version, device id and subject name as packed in front of the frame time.
+        """
+        return self.data[:self._frametime_offset]
 
 
-    def _raise_if_invalid(self):        
-        if not self._is_valid():
-            raise Exception(f"FaceFrame invalid! (current_position:{self.current_position}, size:{self.size})")
+    def blendshape(self, name):
+        """
+        Decodes the value of a single blendshape.
+        """
+        index = _BLENDSHAPE_INDICES[name]
+        if self.blendshape_count <= index:
+            raise KeyError(name)
+        return _FLOAT.unpack_from(self.data, self._frametime_offset + _FRAMETIME_AND_COUNT.size + index * _FLOAT_SIZE)[0]
 
 
-    def _is_valid(self):
-        return 0 < self.size \
-            and -1 < self.current_position \
-            and self.current_position < self.size
+    def to_frame(self):
+        """
+        Fully decodes the packet into a FaceFrame.
+        """
+        return FaceFrame.from_raw(self.data, self.size)
 
 
-    def _read_uint8(self):
-        data_slice = self._read_raw_slice(1)
-        value, = struct.unpack(">B", data_slice)
-        return value
+    def encode(self):
+        """
+        Returns the packet with its size prefix, as stored in recordings.
+        """
+        return _SIZE.pack(self.size) + self.data
 
-    def _write_uint8(self, value):
-        data_slice = struct.pack('>B', value)
-        bytes_written = self._write_raw_slice(data_slice)
-        return bytes_written
 
+    def renamed(self, subject_name, device_id = None):
+        """
+        Returns the packet with subject name (and device id) replaced, frame
+        time and blendshapes are copied as they are.
+        """
+        device_id_bytes = (device_id if device_id is not None else self.device_id).encode('utf8')
+        subject_name_bytes = subject_name.encode('utf8')
+        packet = _VERSION_AND_LENGTH.pack(self.version, len(device_id_bytes)) + device_id_bytes \
+            + _LENGTH.pack(len(subject_name_bytes)) + subject_name_bytes + self.data[self._frametime_offset:]
+        if FaceFrame.PACKET_MAX_SIZE < len(packet):
+            raise Exception(f"Renamed frame (size: {len(packet)}) exceeds max size of {FaceFrame.PACKET_MAX_SIZE} bytes!")
+        return packet
 
-    def _read_uint32(self):
-        data_slice = self._read_raw_slice(4)
-        value, = struct.unpack('>L', data_slice)
-        return value
 
-    def _write_uint32(self, value):
-        data_slice = struct.pack('>L', value)
-        bytes_written = self._write_raw_slice(data_slice)
-        return bytes_written
+_BLENDSHAPE_INDICES = {name: index for index, name in enumerate(FaceFrame.FACE_BLENDSHAPE_NAMES)}
+_ZERO_BLENDSHAPES = array('f', [0.0] * FaceFrame.FACE_BLENDSHAPE_COUNT)
+_ZERO_FRAMETIME_AND_COUNT = _FRAMETIME_AND_COUNT.pack(0, 0.0, 0, 0, 0)
 
 
-    def _read_int32(self):
-        data_slice = self._read_raw_slice(4)
-        value, = struct.unpack(">l", data_slice)
-        return value
+def _require_numpy():
+    if numpy is None:
+        raise Exception('Batch processing of frames requires numpy! (pip install llv[numpy])')
 
-    def _write_int32(self, value):
-        data_slice = struct.pack('>l', value)
-        bytes_written = self._write_raw_slice(data_slice)
-        return bytes_written
 
+class FrameBatch:
+    """
+    Columnar representation of a sequence of frames. Blendshape values are
+    held as (N, FACE_BLENDSHAPE_COUNT) float32 matrix, the frame time as
+    parallel arrays. Version, device id and subject name are stored once per
+    distinct combination in subjects and referenced by subject_index.
+    """
 
-    def _read_float(self):
-        data_slice = self._read_raw_slice(4)
-        value, = struct.unpack(">f", data_slice)
-        return value
+    def __init__(self, blendshapes, frame_number, sub_frame, numerator, denominator,
+        blendshape_count = None, subjects = None, subject_index = None):
+        _require_numpy()
+        frame_total = len(blendshapes)
+        self.blendshapes = blendshapes
+        self.frame_number = frame_number
+        self.sub_frame = sub_frame
+        self.numerator = numerator
+        self.denominator = denominator
+        self.blendshape_count = blendshape_count if blendshape_count is not None \
+            else numpy.full(frame_total, FaceFrame.FACE_BLENDSHAPE_COUNT, dtype=numpy.uint8)
+        default_frame = FaceFrame()
+        self.subjects = subjects if subjects is not None \
+            else [(default_frame.version, default_frame.device_id, default_frame.subject_name)]
+        self.subject_index = subject_index if subject_index is not None \
+            else numpy.zeros(frame_total, dtype=numpy.int32)
 
-    def _write_float(self, value):
-        data_slice = struct.pack('>f', value)
-        bytes_written = self._write_raw_slice(data_slice)
-        return bytes_written
-
-
-    def _read_string(self):
-        string_length = self._read_int32()
-        bytes_left = self.size - self.current_position
-        is_length_ok = (0 <= string_length) and (string_length <= bytes_left)
-        if not is_length_ok:
-            raise Exception(f"Read invalid string length! (str_l:{string_length}, bytes_left:{bytes_left})")
-        data_slice = self._read_raw_slice(string_length)
-        value, = struct.unpack(f">{string_length}s", data_slice)
-        return value.decode('utf8')
-
-    def _write_string(self, value):
-        string_bytes = value.encode('utf8')
-        string_bytes_length = len(string_bytes)
-        self._write_int32(string_bytes_length)
-        data_slice = struct.pack(f'>{string_bytes_length}s', string_bytes)
-        bytes_written = self._write_raw_slice(data_slice)
-        return bytes_written
-
-
-    def _read_frametime(self):
-        # The value of the frame number
-        frame_number = self._read_int32()
-        # ??
-        sub_frame = self._read_float()
-        # The numerator of the framerate represented as a number of frames per second (e.g. 60 for 60 fps)
-        numerator = self._read_int32()
-        # The denominator of the framerate represented as a number of frames per second (e.g. 1 for 60 fps)
-        denominator = self._read_int32()
-        return {"frame_number":frame_number, "sub_frame":sub_frame, "numerator":numerator, "denominator":denominator}
 
-    def _write_frametime(self, value):
-        bytes_written = 0
-        bytes_written += self._write_int32(value['frame_number'])
-        bytes_written += self._write_float(value['sub_frame'])
-        bytes_written += self._write_int32(value['numerator'])
-        bytes_written += self._write_int32(value['denominator'])
-        return bytes_written
+    @staticmethod
+    def from_frames(frames):
+        _require_numpy()
+        frames = list(frames)
+        frame_total = len(frames)
+        blendshapes = numpy.empty((frame_total, FaceFrame.FACE_BLENDSHAPE_COUNT), dtype=numpy.float32)
+        frame_time = numpy.empty((frame_total, 4), dtype=numpy.float64)
+        blendshape_count = numpy.empty(frame_total, dtype=numpy.uint8)
+        subject_index = numpy.empty(frame_total, dtype=numpy.int32)
+        subjects = {}
+        for frame_index, frame in enumerate(frames):
+            blendshapes[frame_index] = frame.blendshape_array
+            frame_time[frame_index] = (frame.frame_number, frame.sub_frame, frame.numerator, frame.denominator)
+            blendshape_count[frame_index] = frame.blendshape_count
+            subject = (frame.version, frame.device_id, frame.subject_name)
+            subject_index[frame_index] = subjects.setdefault(subject, len(subjects))
+
+        return FrameBatch(blendshapes,
+            frame_time[:, 0].astype(numpy.int32), frame_time[:, 1].astype(numpy.float32),
+            frame_time[:, 2].astype(numpy.int32), frame_time[:, 3].astype(numpy.int32),
+            blendshape_count, list(subjects), subject_index)
+
+
+    @staticmethod
+    def concatenate(batches):
+        """
+        Joins batches in order into one, merging their subject tables.
+        """
+        _require_numpy()
+        batches = list(batches)
+        if 0 == len(batches):
+            return FrameBatch(numpy.empty((0, FaceFrame.FACE_BLENDSHAPE_COUNT), dtype=numpy.float32),
+                *[numpy.empty(0, dtype=dtype) for dtype in (numpy.int32, numpy.float32, numpy.int32, numpy.int32)])
+        subjects = {}
+        subject_indices = []
+        for batch in batches:
+            remap = numpy.array([subjects.setdefault(subject, len(subjects)) for subject in batch.subjects],
+                dtype=numpy.int32)
+            subject_indices.append(remap[batch.subject_index])
+
+        return FrameBatch(numpy.concatenate([batch.blendshapes for batch in batches]),
+            numpy.concatenate([batch.frame_number for batch in batches]),
+            numpy.concatenate([batch.sub_frame for batch in batches]),
+            numpy.concatenate([batch.numerator for batch in batches]),
+            numpy.concatenate([batch.denominator for batch in batches]),
+            numpy.concatenate([batch.blendshape_count for batch in batches]),
+            list(subjects), numpy.concatenate(subject_indices))
+
+
+    def __len__(self):
+        return len(self.blendshapes)
+
+
+    def __iter__(self):
+        for frame_index in range(0, len(self)):
+            yield self.frame(frame_index)
+
+
+    def frame(self, frame_index):
+        """
+        Materializes a single FaceFrame from the batch.
+        """
+        frame = FaceFrame()
+        frame.version, frame.device_id, frame.subject_name = self.subjects[self.subject_index[frame_index]]
+        frame.frame_number = int(self.frame_number[frame_index])
+        frame.sub_frame = float(self.sub_frame[frame_index])
+        frame.numerator = int(self.numerator[frame_index])
+        frame.denominator = int(self.denominator[frame_index])
+        frame.blendshape_count = int(self.blendshape_count[frame_index])
+        frame._blendshape_values = array('f', numpy.asarray(self.blendshapes[frame_index], dtype=numpy.float32).tobytes())
+        return frame
+
+
+    def scale(self, factors):
+        """
+        Multiplies every blendshape channel by its factor, given in order of
+        FACE_BLENDSHAPE_NAMES.
+        """
+        self.blendshapes *= numpy.asarray(factors, dtype=numpy.float32)
+        return self
+
+
+    def packets(self):
+        """
+        Yields every frame of the batch as raw network packet.
+        """
+        content = memoryview(self.to_packed(with_size = False))
+        starts, sizes = self._packet_layout(with_size = False)
+        for start, size in zip(starts.tolist(), sizes.tolist()):
+            yield content[start:start + size]
+
+
+    def _subject_headers(self):
+        headers = []
+        for version, device_id, subject_name in self.subjects:
+            device_id_bytes = device_id.encode('utf8')
+            subject_name_bytes = subject_name.encode('utf8')
+            headers.append(_VERSION_AND_LENGTH.pack(version, len(device_id_bytes)) + device_id_bytes
+                + _LENGTH.pack(len(subject_name_bytes)) + subject_name_bytes)
+        return headers
+
+
+    def _packet_layout(self, with_size, headers = None):
+        headers = headers if headers is not None else self._subject_headers()
+        header_length = numpy.array([len(header) for header in headers], dtype=numpy.int64)
+        sizes = header_length[self.subject_index] + _FRAMETIME_AND_COUNT.size \
+            + self.blendshape_count.astype(numpy.int64) * _FLOAT_SIZE
+        rows = sizes + (_SIZE.size if with_size else 0)
+        starts = numpy.cumsum(rows) - rows + (_SIZE.size if with_size else 0)
+        return starts, sizes
+
+
+    def to_packed(self, with_size = True):
+        """
+        Encodes all frames into one buffer of consecutive packets, by default
+        each prefixed with its size as stored in recordings. Frames sharing
+        subject and blendshape count are assembled as one uint8 matrix.
+        """
+        frame_total = len(self)
+        headers = self._subject_headers()
+        starts, sizes = self._packet_layout(with_size, headers)
+        prefix_size = _SIZE.size if with_size else 0
+
+        frame_time = numpy.empty(frame_total, dtype=_FRAMETIME_DTYPE)
+        frame_time['frame_number'] = self.frame_number
+        frame_time['sub_frame'] = self.sub_frame
+        frame_time['numerator'] = self.numerator
+        frame_time['denominator'] = self.denominator
+        frame_time['count'] = self.blendshape_count
+        frame_time = frame_time.view(numpy.uint8).reshape(frame_total, _FRAMETIME_AND_COUNT.size)
+        floats = numpy.ascontiguousarray(self.blendshapes, dtype='>f4').view(numpy.uint8)
+
+        groups = self.subject_index.astype(numpy.int64) * 256 + self.blendshape_count
+        if 0 < frame_total and (groups == groups[0]).all():
+            group_keys = [int(groups[0])]
+        else:
+            group_keys = numpy.unique(groups).tolist()
+
+        content = numpy.empty(int(starts[-1] + sizes[-1]) if 0 < frame_total else 0, dtype=numpy.uint8)
+        for group_key in group_keys:
+            subject_index, count = divmod(group_key, 256)
+            header = headers[subject_index]
+            rows = numpy.flatnonzero(groups == group_key) if 1 < len(group_keys) else slice(None)
+            packet_size = len(header) + _FRAMETIME_AND_COUNT.size + count * _FLOAT_SIZE
+
+            block = numpy.empty((frame_total if 1 == len(group_keys) else len(rows), prefix_size + packet_size), dtype=numpy.uint8)
+            if with_size:
+                block[:, :prefix_size] = numpy.frombuffer(_SIZE.pack(packet_size), dtype=numpy.uint8)
+            position = prefix_size
+            block[:, position:position + len(header)] = numpy.frombuffer(header, dtype=numpy.uint8)
+            position += len(header)
+            block[:, position:position + _FRAMETIME_AND_COUNT.size] = frame_time[rows]
+            position += _FRAMETIME_AND_COUNT.size
+            block[:, position:] = floats[rows, :count * _FLOAT_SIZE]
+
+            if 1 == len(group_keys):
+                return block.tobytes()
+            content[(starts[rows] - prefix_size)[:, None] + numpy.arange(block.shape[1])] = block
+
+        return content.tobytes()
+
+
+_FRAMETIME_DTYPE = [('frame_number', '>i4'), ('sub_frame', '>f4'), ('numerator', '>i4'), ('denominator', '>i4'), ('count', 'u1')]
+
+
+def _gather_rows(raw, offsets, width):
+    """
+    Gathers width bytes starting at each offset into a (N, width) matrix.
+    Indices beyond the end of raw are clipped, callers mask those values.
+    """
+    indices = offsets[:, None] + numpy.arange(width)
+    numpy.clip(indices, 0, len(raw) - 1, out=indices)
+    return raw[indices]
+
+
+def decode_batch(packets):
+    """
+    Decodes a sequence of raw frame packets into a FrameBatch.
+    """
+    _require_numpy()
+    packets = packets if isinstance(packets, (list, tuple)) else list(packets)
+    frame_total = len(packets)
+
+    sizes = numpy.fromiter(map(len, packets), dtype=numpy.int64, count=frame_total)
+    starts = numpy.zeros(frame_total, dtype=numpy.int64)
+    numpy.cumsum(sizes[:-1], out=starts[1:])
+    return decode_packed(b''.join(packets), starts, sizes)
+
+
+def decode_packed(buffer, starts, sizes):
+    """
+    Decodes packets located at starts (with the given sizes) within buffer
+    into a FrameBatch, e.g. the decompressed content of a recording.
+    """
+    _require_numpy()
+    frame_total = len(starts)
+    if 0 == frame_total:
+        return FrameBatch(numpy.empty((0, FaceFrame.FACE_BLENDSHAPE_COUNT), dtype=numpy.float32),
+            numpy.empty(0, dtype=numpy.int32), numpy.empty(0, dtype=numpy.float32),
+            numpy.empty(0, dtype=numpy.int32), numpy.empty(0, dtype=numpy.int32))
+
+    if (sizes < FaceFrame.PACKET_MIN_SIZE).any() or (sizes > FaceFrame.PACKET_MAX_SIZE).any():
+        size = int(sizes[(sizes < FaceFrame.PACKET_MIN_SIZE) | (sizes > FaceFrame.PACKET_MAX_SIZE)][0])
+        raise Exception(f"Trying to read frame (size: {size}) outside of valid frame sizes ({FaceFrame.PACKET_MIN_SIZE} - {FaceFrame.PACKET_MAX_SIZE} bytes)!")
+
+    raw = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    count_max = FaceFrame.FACE_BLENDSHAPE_COUNT
+    float_block_size = count_max * _FLOAT_SIZE
+
+    # Frames of one device share size and header, so the whole recording can be
+    # viewed as fixed stride rows and every column decoded in a single pass.
+    steps = numpy.diff(starts)
+    size = int(sizes[0])
+    if (size == sizes).all() and (0 == len(steps) or (steps[0] == steps).all()):
+        step = int(steps[0]) if 0 < len(steps) else size
+        rows = numpy.lib.stride_tricks.as_strided(raw[int(starts[0]):], shape=(frame_total, size),
+            strides=(step, 1), writeable=False)
+        first_start = int(starts[0])
+        version, device_id, subject_name, *_, offset = decode_header(buffer[first_start:first_start + size], size)
+        offset -= _FRAMETIME_AND_COUNT.size
+        headers = rows[:, :offset]
+        if (headers == headers[0]).all():
+            frame_time = rows[:, offset:offset + _FRAMETIME_AND_COUNT.size].copy().view(_FRAMETIME_DTYPE).ravel()
+            blendshape_count = frame_time['count']
+            float_offset = offset + _FRAMETIME_AND_COUNT.size
+            if (count_max == blendshape_count).all() and float_offset + float_block_size <= size:
+                blendshapes = rows[:, float_offset:float_offset + float_block_size].view('>f4').astype(numpy.float32)
+                return FrameBatch(blendshapes,
+                    frame_time['frame_number'].astype(numpy.int32), frame_time['sub_frame'].astype(numpy.float32),
+                    frame_time['numerator'].astype(numpy.int32), frame_time['denominator'].astype(numpy.int32),
+                    blendshape_count.astype(numpy.uint8), [(version, device_id, subject_name)],
+                    numpy.zeros(frame_total, dtype=numpy.int32))
+
+    ends = starts + sizes
+    device_id_length = _gather_rows(raw, starts + 1, 4).view('>i4').ravel().astype(numpy.int64)
+    subject_name_length = _gather_rows(raw, starts + 5 + device_id_length, 4).view('>i4').ravel().astype(numpy.int64)
+    header_length = 9 + device_id_length + subject_name_length
+    if (device_id_length < 0).any() or (subject_name_length < 0).any() \
+        or (starts + header_length + _FRAMETIME_AND_COUNT.size > ends).any():
+        raise Exception("Read invalid string length in batch!")
+    frametime_offset = starts + header_length
+
+    frame_time = _gather_rows(raw, frametime_offset, _FRAMETIME_AND_COUNT.size).view(_FRAMETIME_DTYPE).ravel()
+    blendshape_count = frame_time['count']
+    if (blendshape_count > count_max).any():
+        raise Exception(f"Read invalid blendshape count! ({int(blendshape_count.max())} > {count_max})")
+    if (frametime_offset + _FRAMETIME_AND_COUNT.size + blendshape_count.astype(numpy.int64) * _FLOAT_SIZE > ends).any():
+        raise Exception("Trying to access beyond package size in batch!")
+
+    float_bytes = _gather_rows(raw, frametime_offset + _FRAMETIME_AND_COUNT.size, float_block_size)
+    blendshapes = float_bytes.view('>f4').astype(numpy.float32)
+    if (blendshape_count < count_max).any():
+        blendshapes[numpy.arange(count_max)[None, :] >= blendshape_count[:, None]] = 0.0
+
+    subject_lookup = {}
+    subject_index = numpy.empty(frame_total, dtype=numpy.int32)
+    for frame_index in range(0, frame_total):
+        start = int(starts[frame_index])
+        header = bytes(buffer[start:start + int(header_length[frame_index])])
+        subject_index[frame_index] = subject_lookup.setdefault(header, len(subject_lookup))
+    subjects = [_decode_subject(header) for header in subject_lookup]
+
+    return FrameBatch(blendshapes,
+        frame_time['frame_number'].astype(numpy.int32), frame_time['sub_frame'].astype(numpy.float32),
+        frame_time['numerator'].astype(numpy.int32), frame_time['denominator'].astype(numpy.int32),
+        blendshape_count.astype(numpy.uint8), subjects, subject_index)
+
+
+def _decode_subject(header):
+    version, device_id, subject_name, *_ = decode_header(header + _ZERO_FRAMETIME_AND_COUNT, len(header) + _FRAMETIME_AND_COUNT.size)
+    return version, device_id, subject_name
@@ -0,0 +1,271 @@
+"""
+    Filtering of blendshape values in live and played back frame streams.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import math
+from .gesicht import FaceFrame, _BLENDSHAPE_INDICES, _FRAMETIME_AND_COUNT, _require_numpy, numpy
+from .zwischenbild import Zwischenbild, _frame_values
+
+
+FILTER_ONE_EURO = 'one-euro'
+FILTER_EXPONENTIAL = 'exponential'
+FILTER_MEDIAN = 'median'
+FILTER_DEAD_ZONE = 'dead-zone'
+FILTER_CLAMP = 'clamp'
+
+# Head and eye rotations follow the face blendshapes and range from -1 to 1.
+_ROTATION_INDEX = _BLENDSHAPE_INDICES['HeadYaw']
+
+
+def _channels(channels):
+    """
+    Returns the index of the channels named, as blendshape names joined by
+    '+', or all channels if not given.
+    """
+    if channels is None:
+        return slice(None)
+    names = channels.split('+') if isinstance(channels, str) else channels
+    unknown = [name for name in names if name not in _BLENDSHAPE_INDICES]
+    if unknown:
+        raise Exception(f'Unknown blendshapes {", ".join(unknown)}!')
+    return numpy.array([_BLENDSHAPE_INDICES[name] for name in names], dtype=numpy.intp)
+
+
+def _alpha(cutoff, dt):
+    """
+    Returns the smoothing factor of a first order low-pass with the cutoff
+    frequency (in Hz, scalar or per channel) at the time step dt (in seconds).
+    """
+    return 1.0 / (1.0 + 1.0 / (2.0 * math.pi * cutoff * dt))
+
+
+class OneEuro:
+    """
+    One-Euro filter (Casiez et al.): an exponential low-pass whose cutoff
+    rises with the speed of the channel, smoothing jitter at rest while
+    following fast motion with little lag. min_cutoff (Hz) sets the
+    smoothing at rest, beta how quickly the cutoff rises with speed.
+    """
+
+    def __init__(self, min_cutoff = 1.0, beta = 0.0, d_cutoff = 1.0, channels = None):
+        if 0 >= min_cutoff or 0 >= d_cutoff or 0 > beta:
+            raise Exception(f'Invalid One-Euro parameters! (min_cutoff: {min_cutoff}, beta: {beta}, d_cutoff: {d_cutoff})')
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.channels = _channels(channels)
+        self.value = None
+        self.speed = None
+
+
+    def __call__(self, values, dt):
+        x = values[self.channels]
+        if self.value is None:
+            self.value = x.copy()
+            self.speed = numpy.zeros_like(x)
+            return
+        speed = (x - self.value) / dt
+        self.speed += _alpha(self.d_cutoff, dt) * (speed - self.speed)
+        cutoff = self.min_cutoff + self.beta * numpy.abs(self.speed)
+        self.value += _alpha(cutoff, dt) * (x - self.value)
+        values[self.channels] = self.value
+
+
+class Exponential:
+    """
+    Exponential moving average, moving alpha of the way towards every new
+    value.
+    """
+
+    def __init__(self, alpha = 0.5, channels = None):
+        if not (0 < alpha <= 1):
+            raise Exception(f'Smoothing factor alpha has to be in (0, 1]! ({alpha})')
+        self.alpha = alpha
+        self.channels = _channels(channels)
+        self.value = None
+
+
+    def __call__(self, values, dt):
+        x = values[self.channels]
+        if self.value is None:
+            self.value = x.copy()
+            return
+        self.value += self.alpha * (x - self.value)
+        values[self.channels] = self.value
+
+
+class Median:
+    """
+    Median of the last n values, removing single frame spikes. Delays the
+    channel by n // 2 frames.
+    """
+
+    def __init__(self, n = 3, channels = None):
+        n = int(n)
+        if 1 > n:
+            raise Exception(f'Median needs at least one value! ({n})')
+        self.n = n
+        self.channels = _channels(channels)
+        self.history = None
+        self.index = 0
+
+
+    def __call__(self, values, dt):
+        x = values[self.channels]
+        if self.history is None:
+            self.history = numpy.repeat(x[numpy.newaxis], self.n, axis=0)
+        self.history[self.index] = x
+        self.index = (self.index + 1) % self.n
+        # Partial sort of the middle value(s) only, cheaper than numpy.median.
+        middle = self.n // 2
+        if self.n % 2:
+            values[self.channels] = numpy.partition(self.history, middle, axis=0)[middle]
+        else:
+            ordered = numpy.partition(self.history, (middle - 1, middle), axis=0)
+            values[self.channels] = 0.5 * (ordered[middle - 1] + ordered[middle])
+
+
+class DeadZone:
+    """
+    Zeroes values within width around zero and moves the others towards
+    zero by width, scaled back up to their range, so the output does not
+    jump at the edge of the dead zone.
+    """
+
+    def __init__(self, width = 0.02, channels = None):
+        if not (0 <= width < 1):
+            raise Exception(f'Dead zone width has to be in [0, 1)! ({width})')
+        self.width = width
+        self.scale = 1.0 / (1.0 - width)
+        self.channels = _channels(channels)
+
+
+    def __call__(self, values, dt):
+        x = values[self.channels]
+        values[self.channels] = numpy.copysign(numpy.maximum(numpy.abs(x) - self.width, 0.0) * self.scale, x)
+
+
+class Clamp:
+    """
+    Limits values to [min, max]. Without bounds given, face blendshapes are
+    limited to [0, 1] and head and eye rotations to [-1, 1].
+    """
+
+    def __init__(self, min = None, max = None, channels = None):
+        self.channels = _channels(channels)
+        self.lower = numpy.zeros(FaceFrame.FACE_BLENDSHAPE_COUNT, dtype=numpy.float32)
+        self.lower[_ROTATION_INDEX:] = -1.0
+        self.lower = self.lower[self.channels] if min is None else numpy.float32(min)
+        self.upper = numpy.float32(1.0 if max is None else max)
+        if numpy.any(self.lower > self.upper):
+            raise Exception(f'Lower bound of clamp above its upper bound! ({min} > {max})')
+
+
+    def __call__(self, values, dt):
+        values[self.channels] = numpy.clip(values[self.channels], self.lower, self.upper)
+
+
+FILTERS = {
+    FILTER_ONE_EURO: OneEuro,
+    FILTER_EXPONENTIAL: Exponential,
+    FILTER_MEDIAN: Median,
+    FILTER_DEAD_ZONE: DeadZone,
+    FILTER_CLAMP: Clamp,
+}
+
+
+def parse_filter(spec):
+    """
+    Splits a filter spec name:key=value,... into its name and parameters.
+    Values are taken as numbers where possible.
+    """
+    name, _, arguments = spec.partition(':')
+    if name not in FILTERS:
+        raise Exception(f'Unknown filter {name}! Use one of {", ".join(FILTERS)}.')
+    parameters = {}
+    for argument in filter(None, arguments.split(',')):
+        key, separator, value = argument.partition('=')
+        if not separator:
+            raise Exception(f'Invalid filter parameter {argument}! Use key=value.')
+        try:
+            parameters[key] = float(value)
+        except ValueError:
+            parameters[key] = value
+    return name, parameters
+
+
+class _Subject:
+    """
+    Filters and output packet of one subject.
+    """
+
+    def __init__(self, specs):
+        self.filters = [FILTERS[name](**parameters) for name, parameters in specs]
+        self.values = numpy.zeros(FaceFrame.FACE_BLENDSHAPE_COUNT, dtype=numpy.float32)
+        self.packet = None
+        self.time = None
+
+
+class Filterkette:
+    """
+    Chain of filters applied to the blendshape values of every frame, given
+    as specs (see parse_filter). Each subject, told apart by the packet
+    header, runs filters of its own. All channels of a frame are filtered
+    at once as float32 row. Time steps follow the frame time of the frames,
+    falling back to the frame rate if it does not advance.
+    """
+
+    def __init__(self, specs):
+        _require_numpy()
+        self.specs = [parse_filter(spec) if isinstance(spec, str) else spec for spec in specs]
+        try:
+            _Subject(self.specs)
+        except TypeError as e:
+            raise Exception(f'Invalid filter parameters! ({e})')
+        self.subjects = {}
+
+
+    def __len__(self):
+        return len(self.specs)
+
+
+    def apply(self, frame):
+        """
+        Returns the packet of a FaceFrameView with its blendshape values
+        filtered. The packet is only valid until the next frame of the same
+        subject is filtered.
+        """
+        header = frame.header
+        key = bytes(header)
+        subject = self.subjects.get(key)
+        if subject is None:
+            subject = self.subjects[key] = _Subject(self.specs)
+
+        count = frame.blendshape_count
+        packet = subject.packet
+        if packet is None or packet.count != count:
+            packet = subject.packet = Zwischenbild(header, count)
+
+        frame_number, sub_frame, numerator, denominator, _ = _FRAMETIME_AND_COUNT.unpack_from(frame.data, len(header))
+        rate = numerator / denominator if 0 < numerator and 0 < denominator else 60.0
+        time = (frame_number + sub_frame) / rate
+        dt = time - subject.time if subject.time is not None else 0.0
+        if not (0 < dt < 1):
+            dt = 1.0 / rate
+        subject.time = time
+
+        values = subject.values
+        values[:count] = _frame_values(frame)
+        values[count:] = 0.0
+        for step in subject.filters:
+            step(values, dt)
+
+        offset = packet.frametime_offset
+        packet.buffer[offset:offset + _FRAMETIME_AND_COUNT.size] = frame.data[offset:offset + _FRAMETIME_AND_COUNT.size]
+        packet.values[:] = values[:count]
+        return packet.data
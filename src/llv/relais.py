@@ -0,0 +1,124 @@
+"""
+    Relay of live frames to other hosts, optionally recording them on the way.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import time
+import threading
+from array import array
+from .gesicht import FaceFrame, FaceFrameView
+from .buchse import Empfang, Verteiler
+from .takt import percentiles_us
+
+
+class Relais:
+    """
+    Forwards the frames received by a server Buchse to targets. A relay
+    thread drains datagrams in batches and sends every valid packet on as
+    received, from the receive buffer itself, without decoding more than
+    the packet layout. With a Recorder given (not started), the batch is
+    handed to its writer thread afterwards, so recording never holds up
+    forwarding. With a Filterkette given, forwarded frames are filtered
+    first, the recording keeps them as received.
+
+    The time from draining a datagram to having sent it to all targets is
+    kept as forward latency.
+    """
+
+    def __init__(self, buchse, targets, recorder = None, multicast_ttl = 1, batch_size = 16, filters = None):
+        self.verteiler = Verteiler(targets, multicast_ttl)
+        self.recorder = recorder
+        self.filters = filters
+        # One spare byte tells oversized datagrams from frames of max size.
+        self.empfang = recorder.empfang if recorder is not None \
+            else Empfang(buchse, FaceFrame.PACKET_MAX_SIZE + 1, batch_size)
+
+        self.frames_forwarded = 0
+        self.frames_invalid = 0
+        self.last_error = None
+        self._latency_ns = array('q')
+        self._running = False
+        self._relay = None
+        self._started = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def start(self):
+        self._running = True
+        self._started = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.start(receive = False)
+        self._relay = threading.Thread(target = self._forward, name = 'llv-relay', daemon = True)
+        self._relay.start()
+
+
+    def stop(self):
+        """
+        Stops relaying, then writes and closes the recording, if any.
+        """
+        self._running = False
+        if self._relay is not None:
+            self._relay.join()
+            self._relay = None
+        if self.recorder is not None:
+            self.recorder.stop()
+        else:
+            self.empfang.close()
+
+
+    def _forward(self):
+        recorder = self.recorder
+        filters = self.filters
+        sprech = self.verteiler.sprech
+        latency_ns = self._latency_ns
+        targets = len(self.verteiler.targets)
+        while self._running:
+            pool = recorder.take_pool() if recorder is not None else None
+            packets = self.empfang.horch(0.1, pool)
+            received_ns = time.monotonic_ns()
+            for data in packets:
+                try:
+                    frame = FaceFrameView(data, len(data))
+                except Exception as e:
+                    self.frames_invalid += 1
+                    self.last_error = str(e)
+                    continue
+                if targets == sprech(frame.data if filters is None else filters.apply(frame), frame.size):
+                    self.frames_forwarded += 1
+                latency_ns.append(time.monotonic_ns() - received_ns)
+            if recorder is not None:
+                recorder.put(received_ns, pool, packets)
+
+
+    def print_progress(self):
+        elapsed = time.monotonic() - self._started
+        print(f'Forwarded {self.frames_forwarded} frames in {elapsed:.0f}s, {self.frames_invalid} invalid'
+            + (f' (last: {self.last_error})' if self.last_error else '') + ' ...')
+
+
+    def stats(self):
+        """
+        Returns receive batching, forwarded and invalid frames, the stats of
+        every target and the forward latency.
+        """
+        stats = self.empfang.stats()
+        stats.update({
+            'frames_forwarded': self.frames_forwarded,
+            'frames_invalid': self.frames_invalid,
+            'last_error': self.last_error,
+            'targets': self.verteiler.stats(),
+            'forward_latency_us': percentiles_us(self._latency_ns),
+        })
+        return stats
@@ -0,0 +1,140 @@
+"""
+    Columnar block codec for recordings. Frames of a block are stored as
+    columns, each delta encoded along time and byte shuffled, so that zlib
+    can collapse the runs of slowly changing values. Blendshapes are either
+    kept bit exact or quantized to 16 bit fixed point.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import struct
+from .gesicht import FaceFrame, FrameBatch, numpy, _require_numpy, _decode_subject
+
+
+MODE_LOSSLESS = 0
+MODE_QUANTIZED = 1
+
+# Value ranges of the ARKit coefficients (0 - 1) and of the head and eye
+# rotations (-1 - 1). Blocks exceeding those ranges widen them as needed.
+ROTATION_CHANNELS = 9
+QUANTIZATION_LOW = [0.0] * (FaceFrame.FACE_BLENDSHAPE_COUNT - ROTATION_CHANNELS) + [-1.0] * ROTATION_CHANNELS
+QUANTIZATION_HIGH = [1.0] * FaceFrame.FACE_BLENDSHAPE_COUNT
+QUANTIZATION_STEPS = 0xFFFF
+
+_BLOCK_HEADER = struct.Struct('>BLH')
+_SUBJECT_LENGTH = struct.Struct('>H')
+
+
+def _delta_shuffle(columns, dtype):
+    """
+    Delta encodes every column of an (N, K) unsigned matrix along N (wrapping
+    around) and returns the big endian bytes grouped by column and byte plane.
+    """
+    columns = numpy.ascontiguousarray(columns, dtype=dtype)
+    deltas = numpy.diff(columns, axis=0, prepend=numpy.zeros((1, columns.shape[1]), dtype=dtype))
+    frame_total, column_total = deltas.shape
+    item_size = deltas.dtype.itemsize
+    planes = numpy.ascontiguousarray(deltas.T, dtype=deltas.dtype.newbyteorder('>')).view(numpy.uint8)
+    return planes.reshape(column_total, frame_total, item_size).transpose(0, 2, 1).tobytes()
+
+
+def _unshuffle_undelta(data, offset, frame_total, column_total, dtype):
+    item_size = numpy.dtype(dtype).itemsize
+    size = frame_total * column_total * item_size
+    planes = numpy.frombuffer(data, dtype=numpy.uint8, count=size, offset=offset)
+    deltas = planes.reshape(column_total, item_size, frame_total).transpose(0, 2, 1).copy() \
+        .view(numpy.dtype(dtype).newbyteorder('>')).reshape(column_total, frame_total).astype(dtype)
+    return numpy.cumsum(deltas, axis=1, dtype=dtype).T, offset + size
+
+
+def _quantization_range(blendshapes):
+    low = numpy.minimum(numpy.array(QUANTIZATION_LOW, dtype=numpy.float32), blendshapes.min(axis=0))
+    high = numpy.maximum(numpy.array(QUANTIZATION_HIGH, dtype=numpy.float32), blendshapes.max(axis=0))
+    return low, high
+
+
+def encode_columns(batch, mode = MODE_LOSSLESS):
+    """
+    Encodes a FrameBatch into a columnar block (before compression).
+    """
+    _require_numpy()
+    frame_total = len(batch)
+    headers = batch._subject_headers()
+
+    parts = [_BLOCK_HEADER.pack(mode, frame_total, len(headers))]
+    for header in headers:
+        parts.append(_SUBJECT_LENGTH.pack(len(header)))
+        parts.append(header)
+    if 1 < len(headers):
+        parts.append(batch.subject_index.astype('>u2').tobytes())
+    parts.append(batch.blendshape_count.astype(numpy.uint8).tobytes())
+
+    frame_time = numpy.empty((frame_total, 4), dtype=numpy.uint32)
+    frame_time[:, 0] = batch.frame_number.astype(numpy.int32).view(numpy.uint32)
+    frame_time[:, 1] = batch.sub_frame.astype(numpy.float32).view(numpy.uint32)
+    frame_time[:, 2] = batch.numerator.astype(numpy.int32).view(numpy.uint32)
+    frame_time[:, 3] = batch.denominator.astype(numpy.int32).view(numpy.uint32)
+    parts.append(_delta_shuffle(frame_time, numpy.uint32))
+
+    blendshapes = numpy.ascontiguousarray(batch.blendshapes, dtype=numpy.float32)
+    if MODE_QUANTIZED == mode:
+        low, high = _quantization_range(blendshapes)
+        scale = numpy.where(high > low, QUANTIZATION_STEPS / (high - low), 0.0).astype(numpy.float32)
+        quantized = numpy.rint((blendshapes - low) * scale).astype(numpy.uint16)
+        parts.append(low.astype('>f4').tobytes())
+        parts.append(high.astype('>f4').tobytes())
+        parts.append(_delta_shuffle(quantized, numpy.uint16))
+    else:
+        parts.append(_delta_shuffle(blendshapes.view(numpy.uint32), numpy.uint32))
+
+    return b''.join(parts)
+
+
+def decode_columns(data):
+    """
+    Decodes a columnar block (after decompression) into a FrameBatch.
+    """
+    _require_numpy()
+    mode, frame_total, subject_count = _BLOCK_HEADER.unpack_from(data, 0)
+    offset = _BLOCK_HEADER.size
+    count_max = FaceFrame.FACE_BLENDSHAPE_COUNT
+
+    subjects = []
+    for _ in range(0, subject_count):
+        header_length, = _SUBJECT_LENGTH.unpack_from(data, offset)
+        offset += _SUBJECT_LENGTH.size
+        subjects.append(_decode_subject(bytes(data[offset:offset + header_length])))
+        offset += header_length
+
+    if 1 < subject_count:
+        subject_index = numpy.frombuffer(data, dtype='>u2', count=frame_total, offset=offset).astype(numpy.int32)
+        offset += frame_total * 2
+    else:
+        subject_index = numpy.zeros(frame_total, dtype=numpy.int32)
+    blendshape_count = numpy.frombuffer(data, dtype=numpy.uint8, count=frame_total, offset=offset).copy()
+    offset += frame_total
+
+    frame_time, offset = _unshuffle_undelta(data, offset, frame_total, 4, numpy.uint32)
+
+    if MODE_QUANTIZED == mode:
+        low = numpy.frombuffer(data, dtype='>f4', count=count_max, offset=offset).astype(numpy.float32)
+        offset += count_max * 4
+        high = numpy.frombuffer(data, dtype='>f4', count=count_max, offset=offset).astype(numpy.float32)
+        offset += count_max * 4
+        quantized, offset = _unshuffle_undelta(data, offset, frame_total, count_max, numpy.uint16)
+        step = ((high - low) / QUANTIZATION_STEPS).astype(numpy.float32)
+        blendshapes = (quantized.astype(numpy.float32) * step + low).astype(numpy.float32)
+        blendshapes[numpy.arange(count_max)[None, :] >= blendshape_count[:, None]] = 0.0
+    else:
+        bits, offset = _unshuffle_undelta(data, offset, frame_total, count_max, numpy.uint32)
+        blendshapes = numpy.ascontiguousarray(bits).view(numpy.float32)
+
+    return FrameBatch(blendshapes,
+        numpy.ascontiguousarray(frame_time[:, 0]).view(numpy.int32),
+        numpy.ascontiguousarray(frame_time[:, 1]).view(numpy.float32),
+        numpy.ascontiguousarray(frame_time[:, 2]).view(numpy.int32),
+        numpy.ascontiguousarray(frame_time[:, 3]).view(numpy.int32),
+        blendshape_count, subjects, subject_index)
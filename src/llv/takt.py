@@ -0,0 +1,263 @@
+"""
+    Playback clock, scheduling frames against absolute deadlines.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import re
+import time
+from array import array
+from fractions import Fraction
+
+
+# Late frames are sent right away, back to back, until playback is on
+# schedule again.
+POLICY_CATCH_UP = 'catch-up'
+# Frames later than max_lateness are skipped, playback resumes at the frame
+# due next.
+POLICY_DROP = 'drop'
+
+POLICIES = (POLICY_CATCH_UP, POLICY_DROP)
+
+# Frames are sent at a fixed rate or at the times given by their recorded
+# frame time.
+TIMING_FIXED = 'fixed'
+TIMING_RECORDED = 'recorded'
+
+TIMINGS = (TIMING_FIXED, TIMING_RECORDED)
+
+_TIMECODE = re.compile(r'^(\d+)[:;](\d+)[:;](\d+)[:;.](\d+)$')
+
+
+def percentiles_us(values_ns, points = (0.5, 0.99, 1.0)):
+    """
+    Returns the percentiles of durations in nanoseconds as microseconds,
+    keyed p50, p99, ... and max.
+    """
+    values = sorted(values_ns)
+
+    def percentile(p):
+        if 0 == len(values):
+            return 0.0
+        return values[min(len(values) - 1, int(p * len(values)))] / 1000
+
+    return {'max' if 1.0 == p else f'p{round(p * 100)}': percentile(p) for p in points}
+
+
+class FrameClock:
+    """
+    Schedules frames against absolute time.monotonic_ns() deadlines, so
+    sending time, read stalls and sleep overshoot never accumulate. Waits
+    are a coarse sleep followed by a busy spin for the last SPIN_NS.
+    """
+    SPIN_NS = 500_000
+
+    def __init__(self, fps, policy = POLICY_CATCH_UP, max_lateness_ns = None, speed = 1):
+        if policy not in POLICIES:
+            raise Exception(f'Unknown playback policy {policy}! Use one of {", ".join(POLICIES)}.')
+        if 0 >= fps:
+            raise Exception(f'Playback rate has to be positive! ({fps})')
+        if 0 >= speed:
+            raise Exception(f'Playback speed has to be positive! ({speed})')
+        # Deadlines are computed from the exact rate, not an accumulated period.
+        self.fps = Fraction(fps).limit_denominator(1_000_000)
+        self.speed = Fraction(speed).limit_denominator(1_000_000)
+        self.policy = policy
+        self.period_ns = self.offset_ns(1) * self.speed.denominator // self.speed.numerator
+        self.max_lateness_ns = max_lateness_ns if max_lateness_ns is not None else self.period_ns
+        self.start_ns = None
+        self._origin_ns = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self._lateness_ns = array('q')
+        self._last_ns = None
+
+
+    def offset_ns(self, tick):
+        """
+        Returns the recording time of frame tick at the clock's fixed rate.
+        """
+        return tick * 1_000_000_000 * self.fps.denominator // self.fps.numerator
+
+
+    def start(self, start_ns = None):
+        """
+        Starts the schedule now, or at start_ns to share it with other clocks.
+        """
+        self.start_ns = self._origin_ns = start_ns if start_ns is not None else time.monotonic_ns()
+        return self.start_ns
+
+
+    def rebase(self, offset_ns, speed = None):
+        """
+        Moves the schedule so the frame at recording time offset_ns is due
+        now, optionally at another speed. Stats carry on from the start.
+        """
+        if speed is not None:
+            if 0 >= speed:
+                raise Exception(f'Playback speed has to be positive! ({speed})')
+            self.speed = Fraction(speed).limit_denominator(1_000_000)
+            self.period_ns = self.offset_ns(1) * self.speed.denominator // self.speed.numerator
+        now = time.monotonic_ns()
+        if self._origin_ns is None:
+            self._origin_ns = now
+        self.start_ns = now - offset_ns * self.speed.denominator // self.speed.numerator
+
+
+    def wait(self, offset_ns):
+        """
+        Waits until the frame at recording time offset_ns is due, which is
+        offset_ns / speed after start. Returns False if the frame is to be
+        dropped instead of sent, according to the policy.
+        """
+        if self.start_ns is None:
+            self.start()
+        deadline = self.start_ns + offset_ns * self.speed.denominator // self.speed.numerator
+
+        now = time.monotonic_ns()
+        remaining = deadline - now
+        if FrameClock.SPIN_NS < remaining:
+            time.sleep((remaining - FrameClock.SPIN_NS) / 1e9)
+        while now < deadline:
+            now = time.monotonic_ns()
+
+        lateness = now - deadline
+        if POLICY_DROP == self.policy and self.max_lateness_ns < lateness:
+            self.frames_dropped += 1
+            return False
+
+        self.frames_sent += 1
+        self._lateness_ns.append(lateness)
+        self._last_ns = now
+        return True
+
+
+    def wait_tick(self, tick):
+        """
+        Waits for frame tick at the clock's fixed rate.
+        """
+        return self.wait(self.offset_ns(tick))
+
+
+    def stats(self):
+        """
+        Returns achieved rate, drop count and lateness percentiles (in
+        microseconds) of all frames sent so far.
+        """
+        elapsed_ns = (self._last_ns - self._origin_ns) if self._last_ns is not None else 0
+        rate = (self.frames_sent - 1) * 1e9 / elapsed_ns if 0 < elapsed_ns else 0.0
+        return {
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'elapsed': elapsed_ns / 1e9,
+            'target_rate': float(self.fps * self.speed),
+            'rate': rate,
+            'lateness_us': percentiles_us(self._lateness_ns, (0.5, 0.9, 0.99, 1.0)),
+        }
+
+
+def frame_time_ns(frame_number, sub_frame, numerator, denominator):
+    """
+    Converts a recorded frame time into nanoseconds, exact for the frame
+    number at any recording length.
+    """
+    if 0 >= numerator or 0 >= denominator:
+        raise Exception(f'Invalid recorded frame rate {numerator}/{denominator}!')
+    return frame_number * 1_000_000_000 * denominator // numerator \
+        + round(sub_frame * 1_000_000_000 * denominator / numerator)
+
+
+class RecordedTimeline:
+    """
+    Presentation times of a recording, derived once from the recorded frame
+    times, given as frame number, sub frame, numerator and denominator of
+    every frame. Gaps in the capture are kept. Where the frame time runs backwards
+    (midnight wrap, joined takes), the frame follows one frame period after
+    its predecessor.
+    """
+
+    def __init__(self, frame_times):
+        # Recorded time, presentation offset from the first frame and frame
+        # period of every frame, in nanoseconds.
+        self.times_ns = array('q')
+        self.offsets_ns = array('q')
+        self.periods_ns = array('q')
+        self.numerator = 0
+        self.denominator = 0
+
+        offset = 0
+        previous = None
+        for frame_number, sub_frame, numerator, denominator in frame_times:
+            time_ns = frame_time_ns(frame_number, sub_frame, numerator, denominator)
+            period = 1_000_000_000 * denominator // numerator
+            if previous is None:
+                self.numerator, self.denominator = numerator, denominator
+            else:
+                delta = time_ns - previous
+                offset += delta if 0 <= delta else period
+            previous = time_ns
+            self.times_ns.append(time_ns)
+            self.offsets_ns.append(offset)
+            self.periods_ns.append(period)
+
+
+    def __len__(self):
+        return len(self.times_ns)
+
+
+    @property
+    def fps(self):
+        """
+        Recorded frame rate of the first frame.
+        """
+        return Fraction(self.numerator, self.denominator) if 0 < len(self) else Fraction(0)
+
+
+    def parse_timecode(self, timecode):
+        """
+        Converts a timecode (HH:MM:SS:FF) or frame number at the recorded
+        rate into nanoseconds.
+        """
+        match = _TIMECODE.match(timecode.strip())
+        if match is not None:
+            hours, minutes, seconds, frames = (int(group) for group in match.groups())
+            frame_number = ((hours * 60 + minutes) * 60 + seconds) * round(self.fps) + frames
+        elif timecode.strip().isdigit():
+            frame_number = int(timecode)
+        else:
+            raise Exception(f'Invalid timecode {timecode}! Use HH:MM:SS:FF or a frame number.')
+        return frame_time_ns(frame_number, 0.0, self.numerator, self.denominator)
+
+
+    def frame_range(self, start = None, end = None, start_frame = 0):
+        """
+        Returns the first and the end (exclusive) frame index of the frames
+        recorded from timecode start up to timecode end.
+        """
+        frame_count = len(self)
+        end_frame = frame_count
+        if start is not None:
+            start_ns = self.parse_timecode(start)
+            start_frame = next((frame_index for frame_index in range(start_frame, frame_count)
+                if start_ns <= self.times_ns[frame_index]), frame_count)
+        if end is not None:
+            # The frame at end is included, along with its sub frame.
+            end_ns = self.parse_timecode(end) + self.periods_ns[0]
+            end_frame = next((frame_index for frame_index in range(start_frame, frame_count)
+                if end_ns <= self.times_ns[frame_index]), frame_count)
+        if end_frame <= start_frame:
+            raise Exception(f'No frames recorded between {start or "start"} and {end or "end"}!')
+        return start_frame, end_frame
+
+
+    def pass_duration_ns(self, start_frame, end_frame):
+        """
+        Returns the presentation time of one pass over the frames from
+        start_frame up to end_frame (exclusive), including the period of
+        the last frame.
+        """
+        last_frame = end_frame - 1
+        return self.offsets_ns[last_frame] - self.offsets_ns[start_frame] + self.periods_ns[last_frame]
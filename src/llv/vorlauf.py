@@ -0,0 +1,200 @@
+"""
+    Read-ahead of recorded frames for playback.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import threading
+import collections
+from array import array
+from .gesicht import FaceFrameView
+from .aufnahme import read_frames
+
+
+class ReadAhead:
+    """
+    Reads and validates frames of a recording on a producer thread into a
+    bounded ring buffer, so the sending thread only pops ready packets. The
+    producer refills the buffer in bursts, once it drained to half its
+    depth. With cache set, the packets of the first pass are kept in memory
+    and all further loops are served from there, without any file I/O.
+    """
+    DEFAULT_DEPTH = 256
+
+    def __init__(self, filepath, loop = True, start_frame = 0, end_frame = None, depth = DEFAULT_DEPTH,
+        cache = False):
+        if 1 > depth:
+            raise Exception(f'Read-ahead buffer needs room for at least one frame! ({depth})')
+        self.filepath = filepath
+        self.loop = loop
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.depth = depth
+        self.cache = cache
+
+        self.underruns = 0
+        self.frames_read = 0
+        self.min_depth = None
+        self.cached_frames = 0
+        self.cached_passes = 0
+
+        self._ring = collections.deque()
+        self._changed = threading.Condition()
+        self._low_water = depth // 2
+        self._running = False
+        self._finished = False
+        self._error = None
+        self._depth_total = 0
+        self._pops = 0
+        self._thread = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+
+    def start(self):
+        """
+        Starts the producer and waits until the buffer is filled.
+        """
+        self._running = True
+        self._thread = threading.Thread(target = self._produce, name = 'llv-read-ahead', daemon = True)
+        self._thread.start()
+        with self._changed:
+            while len(self._ring) < self.depth and not self._finished:
+                self._changed.wait()
+
+
+    def stop(self):
+        with self._changed:
+            self._running = False
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def get(self):
+        """
+        Returns the next frame view, frame index, frame count and version,
+        or None once the recording is exhausted.
+        """
+        with self._changed:
+            if not self._ring:
+                if self._finished:
+                    self._raise_error()
+                    return None
+                self.underruns += 1
+                while not self._ring and not self._finished:
+                    self._changed.wait()
+                if not self._ring:
+                    self._raise_error()
+                    return None
+
+            # The buffer drains naturally at the end of the recording, which
+            # is no shortage.
+            if not self._finished:
+                depth = len(self._ring)
+                self.min_depth = depth if self.min_depth is None else min(self.min_depth, depth)
+                self._depth_total += depth
+                self._pops += 1
+
+            item = self._ring.popleft()
+            if self._low_water >= len(self._ring):
+                self._changed.notify_all()
+            return item
+
+
+    def stats(self):
+        """
+        Returns buffer depth, fill level and underrun count, along with the
+        size of the loop cache.
+        """
+        return {
+            'depth': self.depth,
+            'min_depth': self.min_depth or 0,
+            'mean_depth': self._depth_total / self._pops if 0 < self._pops else 0.0,
+            'underruns': self.underruns,
+            'frames_read': self.frames_read,
+            'cached_frames': self.cached_frames,
+            'cached_passes': self.cached_passes,
+        }
+
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+    def _put(self, item):
+        """
+        Appends to the ring, waiting for the sender to drain it to the low
+        water mark when full. Returns False once stopped.
+        """
+        with self._changed:
+            if self.depth <= len(self._ring):
+                while self._running and self._low_water < len(self._ring):
+                    self._changed.wait()
+            if not self._running:
+                return False
+            self._ring.append(item)
+            self._changed.notify_all()
+            return True
+
+
+    def _produce(self):
+        try:
+            self._produce_frames()
+        except Exception as error:
+            self._error = error
+        finally:
+            with self._changed:
+                self._finished = True
+                self._changed.notify_all()
+
+
+    def _produce_frames(self):
+        frames = read_frames(self.filepath, loop = self.loop and not self.cache,
+            start_frame = self.start_frame, end_frame = self.end_frame)
+
+        content = bytearray()
+        offsets = array('Q', [0])
+        frame_count = version = None
+        for frame_data, frame_index, frame_count, version in frames:
+            frame = FaceFrameView(frame_data, len(frame_data))
+            self.frames_read += 1
+            if self.cache and self.loop:
+                content += frame.data
+                offsets.append(len(content))
+            if not self._put((frame, frame_index, frame_count, version)):
+                return
+
+        if not (self.cache and self.loop) or 1 == len(offsets):
+            return
+
+        # Every further pass is served from memory.
+        self.cached_frames = len(offsets) - 1
+        content = memoryview(content)
+        while True:
+            self.cached_passes += 1
+            for frame_index, (start, end) in enumerate(zip(offsets, offsets[1:]), self.start_frame):
+                frame = FaceFrameView(content[start:end], end - start)
+                if not self._put((frame, frame_index, frame_count, version)):
+                    return
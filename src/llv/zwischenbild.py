@@ -0,0 +1,144 @@
+"""
+    Resampling of frame streams to another rate by interpolating blendshapes.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+from fractions import Fraction
+from .gesicht import FaceFrame, _FRAMETIME_AND_COUNT, _require_numpy, numpy
+
+
+# Straight blend between the two frames around the output time.
+INTERPOLATION_LINEAR = 'linear'
+# Uniform cubic B-spline over the four frames around the output time. The
+# curve is smooth in velocity and acceleration and stays within the range of
+# its frames, which also damps capture jitter. It does not pass exactly
+# through the recorded values.
+INTERPOLATION_CUBIC = 'cubic'
+
+INTERPOLATIONS = (INTERPOLATION_LINEAR, INTERPOLATION_CUBIC)
+
+
+class Zwischenbild:
+    """
+    Output packet of a subject, rebuilt in place for every output frame. The
+    blendshape values are written through a big endian numpy view onto the
+    packet buffer.
+    """
+
+    def __init__(self, header, count):
+        self.frametime_offset = len(header)
+        values_offset = self.frametime_offset + _FRAMETIME_AND_COUNT.size
+        self.buffer = bytearray(values_offset + count * 4)
+        self.buffer[:self.frametime_offset] = header
+        self.data = memoryview(self.buffer)
+        self.count = count
+        self.values = numpy.frombuffer(self.buffer, dtype='>f4', count=count, offset=values_offset)
+
+
+def _frame_values(frame):
+    count = frame.blendshape_count
+    return numpy.frombuffer(frame.data, dtype='>f4', count=count, offset=frame.size - count * 4)
+
+
+def interpolate(frames, fps, mode = INTERPOLATION_LINEAR):
+    """
+    Resamples a stream of (offset_ns, FaceFrameView) tuples, in order of
+    their presentation offset, to fps. Yields (offset_ns, packet) for every
+    output frame, from the first up to the last source frame. Frame times
+    continue the recorded time of the first frame at the output rate. The
+    packet is only valid until the next frame is requested.
+    """
+    _require_numpy()
+    if mode not in INTERPOLATIONS:
+        raise Exception(f'Unknown interpolation {mode}! Use one of {", ".join(INTERPOLATIONS)}.')
+    fps = Fraction(fps).limit_denominator(1_000_000)
+    if 0 >= fps:
+        raise Exception(f'Output rate has to be positive! ({fps})')
+
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return
+
+    # Window over the frames around the output time t, with
+    # offsets[1] <= t < offsets[2]. The stream is padded with its first and
+    # last frame at the ends.
+    window = numpy.zeros((4, FaceFrame.FACE_BLENDSHAPE_COUNT), dtype=numpy.float32)
+    offsets = [first[0]] * 4
+    views = [first[1]] * 4
+    values = _frame_values(first[1])
+    window[:, :len(values)] = values
+    end_offset = None
+
+    def advance():
+        nonlocal end_offset
+        window[:-1] = window[1:]
+        del offsets[0], views[0]
+        frame = next(frames, None) if end_offset is None else None
+        if frame is None:
+            if end_offset is None:
+                end_offset = offsets[-1]
+            # Pad after the end at the last frame spacing.
+            offsets.append(offsets[-1] + max(1, offsets[-1] - offsets[-2]))
+            views.append(views[-1])
+            return
+        offset, view = frame
+        offsets.append(offset)
+        views.append(view)
+        values = _frame_values(view)
+        window[3, :len(values)] = values
+        window[3, len(values):] = 0.0
+
+    advance()
+    advance()
+
+    frame_time = first[1].frame_time
+    if 0 >= frame_time['numerator'] or 0 >= frame_time['denominator']:
+        raise Exception(f'Invalid recorded frame rate {frame_time["numerator"]}/{frame_time["denominator"]}!')
+    position = (frame_time['frame_number'] + Fraction(frame_time['sub_frame'])) \
+        * Fraction(frame_time['denominator'], frame_time['numerator']) * fps
+    frame_number = int(position)
+    sub_frame = float(position - frame_number)
+
+    packets = {}
+    view = packet = None
+    weights = numpy.zeros(4, dtype=numpy.float32)
+    tick = 0
+    while True:
+        offset = first[0] + tick * 1_000_000_000 * fps.denominator // fps.numerator
+        while offsets[2] <= offset and (end_offset is None or offsets[1] < end_offset):
+            advance()
+        if end_offset is not None and end_offset < offset:
+            return
+
+        span = offsets[2] - offsets[1]
+        u = min(1.0, (offset - offsets[1]) / span) if 0 < span else 0.0
+        if INTERPOLATION_LINEAR == mode:
+            weights[1] = 1.0 - u
+            weights[2] = u
+        else:
+            u2 = u * u
+            u3 = u2 * u
+            weights[0] = (1.0 - u) ** 3 / 6.0
+            weights[1] = (3.0 * u3 - 6.0 * u2 + 4.0) / 6.0
+            weights[2] = (-3.0 * u3 + 3.0 * u2 + 3.0 * u + 1.0) / 6.0
+            weights[3] = u3 / 6.0
+
+        # Subject and blendshape count follow the frame at or before t.
+        if views[1] is not view:
+            view = views[1]
+            header = view.header
+            key = (bytes(header), view.blendshape_count)
+            packet = packets.get(key)
+            if packet is None:
+                packet = packets[key] = Zwischenbild(header, view.blendshape_count)
+        packet.values[:] = weights.dot(window)[:packet.count]
+        _FRAMETIME_AND_COUNT.pack_into(packet.buffer, packet.frametime_offset,
+            frame_number + tick, sub_frame, fps.numerator, fps.denominator, packet.count)
+
+        yield offset, packet.data
+        tick += 1
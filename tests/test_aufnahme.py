@@ -0,0 +1,115 @@
+"""
+    Tests of writing and reading recording containers.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from llv.aufnahme import RecordingWriter, RecordingReader, read_frames, recording_length, segment_filepath
+from llv.aufnahme import CODEC_ZLIB, CODEC_STORED
+
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'dao.gesichter')
+
+
+def example_packets():
+    return [bytes(frame) for frame, _, _, _ in read_frames(EXAMPLE)]
+
+
+class RecordingContainerTest(unittest.TestCase):
+    """
+    Writes the example recording into containers and reads it back.
+    """
+
+    def setUp(self):
+        self.packets = example_packets()
+        self.directory = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.directory.name, 'take.gesichter')
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def write(self, filepath, packets, codec = CODEC_ZLIB, block_size = 16):
+        with RecordingWriter(filepath, block_size = block_size, codec = codec) as writer:
+            for packet in packets:
+                writer.write(packet)
+
+
+    def test_round_trip(self):
+        for codec in (CODEC_ZLIB, CODEC_STORED):
+            with self.subTest(codec = codec):
+                self.write(self.filepath, self.packets, codec)
+                with RecordingReader(self.filepath) as reader:
+                    self.assertEqual(len(self.packets), len(reader))
+                    self.assertEqual(len(self.packets) // 16 + 1, len(reader.index))
+                    self.assertEqual(self.packets, [bytes(packet) for packet, _ in reader.frames()])
+                    self.assertEqual(self.packets[37], bytes(reader.frame(37)))
+                    self.assertEqual(list(range(100, len(self.packets))),
+                        [frame_index for _, frame_index in reader.frames(100)])
+                self.assertEqual(self.packets[20:50],
+                    [bytes(frame) for frame, _, _, _ in read_frames(self.filepath, start_frame = 20, end_frame = 50)])
+
+
+    def test_recover_unclosed(self):
+        writer = RecordingWriter(self.filepath, block_size = 16)
+        for packet in self.packets[:100]:
+            writer.write(packet)
+        # Written blocks reach the file, the index and header never do.
+        writer.file.close()
+
+        self.assertEqual(96, recording_length(self.filepath))
+        with RecordingReader(self.filepath) as reader:
+            self.assertEqual(6, len(reader.index))
+            self.assertEqual(self.packets[:96], [bytes(packet) for packet, _ in reader.frames()])
+            self.assertEqual(self.packets[50], bytes(reader.frame(50)))
+
+
+    def test_recover_truncated(self):
+        writer = RecordingWriter(self.filepath, block_size = 16)
+        for packet in self.packets:
+            writer.write(packet)
+        writer.flush()
+        writer.file.close()
+        # Cut the last block in half, it is dropped on recovery.
+        with RecordingReader(self.filepath) as reader:
+            last = reader.index[-1]
+        with open(self.filepath, 'r+b') as file:
+            file.truncate(last.offset + last.payload_size // 2)
+
+        with RecordingReader(self.filepath) as reader:
+            self.assertEqual(last.first_frame, len(reader))
+            self.assertEqual(self.packets[:last.first_frame], [bytes(packet) for packet, _ in reader.frames()])
+
+
+    def test_segments(self):
+        for segment_index, first_frame in enumerate(range(0, len(self.packets), 70)):
+            self.write(segment_filepath(self.filepath, segment_index), self.packets[first_frame:first_frame + 70])
+
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertEqual(len(self.packets), recording_length(self.filepath))
+        frames = list(read_frames(self.filepath))
+        self.assertEqual(self.packets, [bytes(frame) for frame, _, _, _ in frames])
+        self.assertEqual(list(range(len(self.packets))), [frame_index for _, frame_index, _, _ in frames])
+        self.assertEqual({len(self.packets)}, {frame_count for _, _, frame_count, _ in frames})
+
+        # Ranges and loops run across segment boundaries.
+        self.assertEqual(self.packets[60:150],
+            [bytes(frame) for frame, _, _, _ in read_frames(self.filepath, start_frame = 60, end_frame = 150)])
+        looped = read_frames(self.filepath, loop = True, start_frame = 130)
+        self.assertEqual(self.packets[130:] + self.packets[130:150],
+            [bytes(frame) for frame, _, _, _ in (next(looped) for _ in range(70))])
+
+
+if __name__ == '__main__':
+    unittest.main()
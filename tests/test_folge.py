@@ -0,0 +1,117 @@
+"""
+    Tests of sequence tracking: reordering, late packets, duplicates and
+    wraparound of frame numbers.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import sys
+import random
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from llv.folge import Folge
+
+
+FRAME_NUMBER = struct.Struct('>l')
+FRAME_NUMBER_MAX = (1 << 31) - 1
+FRAME_NUMBER_MIN = -(1 << 31)
+
+
+class FolgeTest(unittest.TestCase):
+    """
+    Pushes frame numbers, each as its own packet, and checks what is written.
+    """
+
+    def track(self, frame_numbers, window = 8):
+        written = []
+        folge = Folge(lambda packet: written.append(FRAME_NUMBER.unpack(packet)[0]), window)
+        for frame_number in frame_numbers:
+            folge.push(frame_number, FRAME_NUMBER.pack(frame_number))
+        folge.flush()
+        stats = folge.stats()
+        self.assertEqual(stats['received'], stats['written'] + stats['late'] + stats['duplicates'])
+        self.assertEqual(len(written), stats['written'])
+        return written, stats
+
+
+    def test_in_order(self):
+        written, stats = self.track(range(100, 200))
+        self.assertEqual(list(range(100, 200)), written)
+        self.assertEqual((100, 199, 0, 0), (stats['first_frame'], stats['last_frame'], stats['lost'], stats['late']))
+
+
+    def test_reordered_within_window(self):
+        written, stats = self.track([0, 1, 3, 2, 4, 7, 5, 6, 8, 12, 11, 10, 9, 13])
+        self.assertEqual(list(range(0, 14)), written)
+        self.assertEqual(6, stats['reordered'])
+        self.assertEqual(3, stats['max_held'])
+        self.assertEqual((0, 0, 0), (stats['lost'], stats['late'], stats['duplicates']))
+
+
+    def test_late_after_window(self):
+        written, stats = self.track([0, 2, 3, 4, 5, 1, 6], window = 4)
+        self.assertEqual([0, 2, 3, 4, 5, 6], written)
+        self.assertEqual(1, stats['late'])
+        self.assertEqual(1, stats['lost'])
+        self.assertEqual([[1, 1]], stats['gaps'])
+
+
+    def test_duplicates(self):
+        written, stats = self.track([0, 1, 1, 2, 0, 4, 4, 3, 2, 5])
+        self.assertEqual(list(range(0, 6)), written)
+        self.assertEqual(4, stats['duplicates'])
+        self.assertEqual((0, 0), (stats['late'], stats['lost']))
+
+
+    def test_wraparound(self):
+        frame_numbers = [FRAME_NUMBER_MAX - 2, FRAME_NUMBER_MAX, FRAME_NUMBER_MAX - 1, FRAME_NUMBER_MIN + 1,
+            FRAME_NUMBER_MIN, FRAME_NUMBER_MIN + 1, FRAME_NUMBER_MIN + 3, FRAME_NUMBER_MIN + 4]
+        written, stats = self.track(frame_numbers)
+        self.assertEqual([FRAME_NUMBER_MAX - 2, FRAME_NUMBER_MAX - 1, FRAME_NUMBER_MAX, FRAME_NUMBER_MIN,
+            FRAME_NUMBER_MIN + 1, FRAME_NUMBER_MIN + 3, FRAME_NUMBER_MIN + 4], written)
+        self.assertEqual((FRAME_NUMBER_MAX - 2, FRAME_NUMBER_MIN + 4), (stats['first_frame'], stats['last_frame']))
+        self.assertEqual([[FRAME_NUMBER_MIN + 2, 1]], stats['gaps'])
+        self.assertEqual((0, 1, 0), (stats['restarts'], stats['duplicates'], stats['late']))
+
+
+    def test_restart(self):
+        written, stats = self.track([500, 501, 502, 10, 11, 12])
+        self.assertEqual([500, 501, 502, 10, 11, 12], written)
+        self.assertEqual((1, 0, 500, 12), (stats['restarts'], stats['lost'], stats['first_frame'],
+            stats['last_frame']))
+
+
+    def test_lossy_delivery(self):
+        generator = random.Random(23)
+        first_frame = FRAME_NUMBER_MAX - 2000
+        sent = [(first_frame + index + (1 << 31)) % (1 << 32) - (1 << 31) for index in range(5000)]
+        received = [frame_number for frame_number in sent if 0.03 < generator.random()]
+        for index in range(1, len(received) - 6, 7):
+            shift = generator.randrange(1, 6)
+            received[index], received[index + shift] = received[index + shift], received[index]
+        for index in generator.sample(range(len(received)), 100):
+            received.insert(index, received[index])
+        for index in generator.sample(range(100, len(received)), 20):
+            received.insert(index, received[index - 50])
+
+        written, stats = self.track(received)
+
+        self.assertEqual(len(received), stats['received'])
+        self.assertEqual(0, stats['restarts'])
+        self.assertEqual(len(set(written)), len(written))
+        order = {frame_number: index for index, frame_number in enumerate(sent)}
+        positions = [order[frame_number] for frame_number in written]
+        self.assertEqual(sorted(positions), positions)
+        self.assertEqual(positions[-1] - positions[0] + 1, stats['written'] + stats['lost'])
+        self.assertEqual(stats['lost'], len(set(sent[:positions[-1] + 1]) - set(written)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+    Loopback load test of receiving and recording frames.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from llv.gesicht import FaceFrameView, _FRAMETIME_AND_COUNT
+from llv.buchse import Buchse
+from llv.aufnahme import read_frames, recording_length
+from llv.aufzeichnung import Recorder
+
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'dao.gesichter')
+
+
+def numbered_packets(count, first_frame = 1000):
+    """
+    Returns count packets of the example recording, looped, with
+    consecutive frame numbers.
+    """
+    frames = [bytes(frame) for frame, _, _, _ in read_frames(EXAMPLE)]
+    packets = []
+    for index in range(count):
+        packet = bytearray(frames[index % len(frames)])
+        offset = len(FaceFrameView(packet, len(packet)).header)
+        _, sub_frame, numerator, denominator, blendshape_count = _FRAMETIME_AND_COUNT.unpack_from(packet, offset)
+        _FRAMETIME_AND_COUNT.pack_into(packet, offset, first_frame + index, sub_frame, numerator, denominator,
+            blendshape_count)
+        packets.append(bytes(packet))
+    return packets
+
+
+def send(port, packets, fps, burst = 1):
+    """
+    Sends packets to port on loopback, burst packets back to back at a time,
+    keeping fps on average.
+    """
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(('127.0.0.1', port))
+    start = time.monotonic()
+    for index in range(0, len(packets), burst):
+        delay = start + index / fps - time.monotonic()
+        if 0 < delay:
+            time.sleep(delay)
+        for packet in packets[index:index + burst]:
+            sender.send(packet)
+    sender.close()
+
+
+class LoopbackLoadTest(unittest.TestCase):
+    """
+    Sends frames at rates well above the phone's over 127.0.0.1 into a
+    Recorder and expects every frame to be written, in order.
+    """
+    FRAMES = 1800
+
+    def record(self, fps, burst):
+        packets = numbered_packets(LoopbackLoadTest.FRAMES)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'take.gesichter')
+            buchse = Buchse('127.0.0.1', 0, as_server = True, receive_buffer_size = 4 * 1024 * 1024)
+            port = buchse.connection_info['local'][1]
+            recorder = Recorder(buchse, output, len(packets))
+            sender = threading.Thread(target = send, args = (port, packets, fps, burst))
+            with recorder:
+                sender.start()
+                done = recorder.wait(2 * len(packets) / fps + 5)
+                sender.join()
+
+            stats = recorder.stats()
+            self.assertTrue(done, f'Recorded only {stats["frames_written"]}/{len(packets)} frames.')
+            self.assertEqual(len(packets), stats['datagrams'])
+            self.assertEqual(0, stats['frames_invalid'])
+            self.assertEqual(len(packets), recording_length(output))
+            self.assertEqual(packets, [bytes(frame) for frame, _, _, _ in read_frames(output)])
+
+            with open(recorder.report_filepath) as report_file:
+                subject, = json.load(report_file)['subjects']
+            self.assertEqual(0, subject['lost'])
+            self.assertEqual(0, subject['duplicates'])
+
+
+    def test_steady_600fps(self):
+        self.record(600, 1)
+
+
+    def test_bursts_at_240fps(self):
+        self.record(240, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
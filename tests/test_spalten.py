@@ -0,0 +1,85 @@
+"""
+    Tests of the columnar block codec.
+
+    2021-∞ (c) blurryroots innovation qanat OÜ. All rights reserved.
+    See license.md for details.
+
+    https://think-biq.com
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from llv.gesicht import numpy
+from llv.aufnahme import read_frames, load_recording
+from llv.spalten import encode_columns, decode_columns, MODE_LOSSLESS, MODE_QUANTIZED
+from llv.spalten import QUANTIZATION_LOW, QUANTIZATION_HIGH, QUANTIZATION_STEPS
+
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'dao.gesichter')
+
+
+@unittest.skipIf(numpy is None, 'Columnar blocks need numpy.')
+class ColumnarCodecTest(unittest.TestCase):
+    """
+    Round trips the example recording through columnar blocks.
+    """
+
+    def setUp(self):
+        self.batch = load_recording(EXAMPLE)
+
+
+    def test_lossless_is_bit_exact(self):
+        decoded = decode_columns(encode_columns(self.batch, MODE_LOSSLESS))
+
+        self.assertEqual(self.batch.blendshapes.view(numpy.uint32).tolist(),
+            decoded.blendshapes.view(numpy.uint32).tolist())
+        packets = [bytes(frame) for frame, _, _, _ in read_frames(EXAMPLE)]
+        self.assertEqual(packets, [bytes(packet) for packet in decoded.packets()])
+
+
+    def test_lossless_keeps_special_values(self):
+        # Signed zeros, subnormals, infinities and NaN payloads.
+        self.batch.blendshapes[3, :4] = numpy.array([0x80000000, 0x00000001, 0x7FC00123, 0xFF800000],
+            dtype=numpy.uint32).view(numpy.float32)
+
+        decoded = decode_columns(encode_columns(self.batch, MODE_LOSSLESS))
+
+        self.assertEqual(self.batch.blendshapes.view(numpy.uint32).tolist(),
+            decoded.blendshapes.view(numpy.uint32).tolist())
+        self.assertEqual(self.batch.to_packed(), decoded.to_packed())
+
+
+    def assertQuantized(self, batch):
+        values = batch.blendshapes.astype(numpy.float64)
+        low = numpy.minimum(QUANTIZATION_LOW, values.min(axis=0))
+        high = numpy.maximum(QUANTIZATION_HIGH, values.max(axis=0))
+
+        decoded = decode_columns(encode_columns(batch, MODE_QUANTIZED))
+
+        error = numpy.abs(decoded.blendshapes.astype(numpy.float64) - values).max(axis=0)
+        bound = (high - low) / QUANTIZATION_STEPS
+        self.assertTrue((error <= bound).all(),
+            f'Quantization error above a step in channels {numpy.flatnonzero(error > bound).tolist()}!')
+        self.assertEqual(batch.frame_number.tolist(), decoded.frame_number.tolist())
+        self.assertEqual(batch.blendshape_count.tolist(), decoded.blendshape_count.tolist())
+
+
+    def test_quantized_error_within_a_step(self):
+        self.assertQuantized(self.batch)
+
+
+    def test_quantized_error_beyond_default_ranges(self):
+        blendshapes = self.batch.blendshapes
+        blendshapes[:, 0] = blendshapes[:, 0] * 7.0 - 2.5
+        blendshapes[:, 10] = -blendshapes[:, 10]
+        blendshapes[:, 60] = blendshapes[:, 60] * 40.0 + 3.0
+        blendshapes[:, 30] = 0.25
+        self.assertQuantized(self.batch)
+
+
+if __name__ == '__main__':
+    unittest.main()